@@ -0,0 +1,172 @@
+import pandas as pd
+
+import zlib
+
+
+SEPARATOR = ':'
+
+# Order categories are shown in, a parent comes where its first listed
+# child does and anything not listed comes after by name
+CATEGORY_ORDER = ['Accomodation', 'Food & Drink', 'Activities',
+                  'Transportation:Plane', 'Transportation:Boat',
+                  'Transportation:Bus', 'Transportation:Train',
+                  'Transportation:City Transit', 'Untracked Cash',
+                  'ATM Fees', 'Visa Fees', 'Insurance', 'Purchases', 'Misc']
+
+CATEGORY_COLORS = {'Accomodation': '#3366CC',
+                   'Food & Drink': '#DC3912',
+                   'Activities': '#FF9900',
+                   'Transportation:Plane': '#109618',
+                   'Transportation:Boat': '#0099C6',
+                   'Transportation:Bus': '#B82E2E',
+                   'Transportation:Train': '#EECA3B',
+                   'Transportation:City Transit': '#DD4477',
+                   'Untracked Cash': '#66AA00',
+                   'ATM Fees': '#990099',
+                   'Purchases': '#316395',
+                   'Misc': '#8C564B'}
+
+# Name of the node holding what a parent has besides its children
+OTHER = '(other)'
+
+# Accounts without a color of their own always get the same one of these
+PALETTE = ['#AAAA11', '#6633CC', '#E67300', '#8B0707', '#651067',
+           '#329262', '#5574A6', '#3B3EAC', '#22AA99', '#994499']
+
+
+def account_parents(account):
+    """List an account and every account above it, 'A:B:C' gives ['A', 'A:B', 'A:B:C']"""
+
+    parts = account.split(SEPARATOR)
+
+    return [SEPARATOR.join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+
+
+def node_rank(node):
+    """Rank a node among its siblings, by its place in CATEGORY_ORDER then by name"""
+
+    # What a parent has besides its children comes after them
+    if node.rpartition(SEPARATOR)[2] == OTHER:
+        return (len(CATEGORY_ORDER) + 1, node)
+
+    listed = [i for i, category in enumerate(CATEGORY_ORDER)
+              if category == node or category.startswith(node + SEPARATOR)]
+
+    return (min(listed) if listed else len(CATEGORY_ORDER), node)
+
+
+def node_color(node):
+    """Get a node's color from CATEGORY_COLORS, or a palette color picked by its name"""
+
+    if node in CATEGORY_COLORS:
+        return CATEGORY_COLORS[node]
+
+    return PALETTE[zlib.crc32(node.encode('utf-8')) % len(PALETTE)]
+
+
+def build_account_tree(accounts):
+    """Build a df with a row for every account and every account above them.
+
+    Columns are Node (the full name), Name, Parent, Depth from 1, IsLeaf,
+    Order and Color. Rows are sorted in Order, every parent just before
+    its children.
+    """
+
+    nodes = set()
+    for account in pd.unique(pd.Series(accounts).dropna().astype(str)):
+        nodes.update(account_parents(account))
+
+    # Sorting on the ranks of the whole path keeps children under their parent
+    nodes = sorted(nodes, key=lambda node: [node_rank(parent) for parent in account_parents(node)])
+    parents = {node.rpartition(SEPARATOR)[0] for node in nodes}
+
+    return pd.DataFrame({'Node': nodes,
+                         'Name': [node.rpartition(SEPARATOR)[2] for node in nodes],
+                         'Parent': [node.rpartition(SEPARATOR)[0] or None for node in nodes],
+                         'Depth': [node.count(SEPARATOR) + 1 for node in nodes],
+                         'IsLeaf': [node not in parents for node in nodes],
+                         'Order': range(len(nodes)),
+                         'Color': [node_color(node) for node in nodes]})
+
+
+def rollup_tree(df, group_columns=(), value_column='Amount', account_column='Category'):
+    """Sum value_column at every depth of the account tree in one pass.
+
+    Each row counts towards its account and every account above it, so
+    Transportation holds the sum of Transportation:Bus and the rest. The
+    prefixes of every depth are built with vectorized string ops and summed
+    by a single groupby. Returns a df of group_columns, Node, Depth and the
+    summed value_column.
+    """
+
+    group_columns = list(group_columns)
+    parts = df[account_column].str.split(SEPARATOR, expand=True)
+
+    frames = []
+    prefix = None
+    for depth in range(parts.shape[1]):
+        prefix = parts[depth] if prefix is None else prefix + SEPARATOR + parts[depth]
+
+        # Only accounts that go this deep have a node at this depth
+        has_depth = prefix.notna()
+        frames.append(df.loc[has_depth, group_columns + [value_column]]
+                        .assign(Node=prefix[has_depth], Depth=depth + 1))
+
+    nodes = pd.concat(frames, ignore_index=True)
+
+    return nodes.groupby(group_columns + ['Node', 'Depth'], sort=False)[value_column].sum().reset_index()
+
+
+def rollup_level(rollups, depth=None, value_column='Amount'):
+    """Pick one level of the tree out of rollup_tree's output, in tree order.
+
+    Accounts that stop short of depth are kept at their own depth. A parent
+    that is split into its children but has postings of its own gets an
+    OTHER child holding them, like Transportation:(other), so the level
+    still adds up to the total. With no depth the leaves are picked.
+    """
+
+    group_columns = [c for c in rollups.columns if c not in ('Node', 'Depth', value_column)]
+    tree = build_account_tree(rollups['Node']).set_index('Node')
+    node_depth = rollups['Node'].map(tree['Depth'])
+    is_leaf = rollups['Node'].map(tree['IsLeaf'])
+
+    if depth is None:
+        picked = is_leaf
+        split = ~is_leaf
+    else:
+        picked = (node_depth == depth) | (is_leaf & (node_depth < depth))
+        split = ~is_leaf & (node_depth < depth)
+
+    # Whatever a split parent has that its children don't is its own postings
+    split = rollups[split]
+    children = (rollups[node_depth > 1]
+                .assign(Node=rollups['Node'].map(tree['Parent']))
+                .groupby(group_columns + ['Node'], sort=False)[value_column].sum()
+                .rename('_children'))
+    split = split.join(children, on=group_columns + ['Node'])
+    residual = split[value_column] - split['_children'].fillna(0)
+    other = (split[residual.round(9) != 0]
+             .assign(Node=lambda d: d['Node'] + SEPARATOR + OTHER, Depth=lambda d: d['Depth'] + 1)
+             .drop('_children', axis=1))
+    other[value_column] = residual[other.index]
+
+    level = pd.concat([rollups[picked], other], ignore_index=True)
+    tree = build_account_tree(level['Node']).set_index('Node')
+
+    return level.iloc[level['Node'].map(tree['Order']).argsort(kind='stable')]
+
+
+def order_key(accounts):
+    """Sort key for a column of accounts, giving each its place in the account tree"""
+
+    tree = build_account_tree(accounts).set_index('Node')
+
+    # Categoricals would map to a categorical of orders, which doesn't sort by them
+    return accounts.astype(object).map(tree['Order'])
+
+
+def node_colors(accounts):
+    """Map each account to its color, for a chart's color map"""
+
+    return {node: node_color(node) for node in pd.unique(pd.Series(accounts).dropna().astype(str))}
@@ -0,0 +1,250 @@
+import numpy as np
+import pandas as pd
+
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import clean_and_export_ledger_data
+import dashboard_data
+import expense_queries
+import expenses_storage
+import ledger_journal
+import moneywallet_csv_import
+import result_cache
+import synthetic_data
+
+
+# Postings in the synthetic journal of each scale
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000}
+
+# Timings are only comparable on the machine they were taken on, regenerate
+# the baseline with --save-baseline after moving to another one
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'ledger-tools-benchmarks')
+
+# How much slower or bigger than its baseline a benchmark can get before
+# it is flagged, and the changes too small to flag either way
+TOLERANCE = 0.5
+MIN_SECONDS = 0.025
+MIN_BYTES = 1024 * 1024
+
+# Timed runs of each benchmark, the best of which is kept
+REPEAT = 5
+
+# Fixed workload run with every benchmark run, the baseline times are
+# scaled by how much faster or slower it got since they were saved
+CALIBRATION = 'calibration'
+
+
+def calibrate():
+    """Sort and group a fixed million random numbers, a workload that never changes"""
+
+    values = np.random.default_rng(0).random(1000000)
+    pd.Series(values).groupby((values * 1000).astype(int)).sum().sort_values()
+
+
+def measure(fn, repeat=REPEAT):
+    """Time fn repeat times, then run it once more under tracemalloc for its peak memory.
+
+    Memory is traced on its own run since tracing slows everything down.
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'Seconds': min(times), 'Median': statistics.median(times), 'PeakBytes': peak}
+
+
+def make_benchmarks(paths, work_dir):
+    """Get the benchmarks to run on the synthetic files in paths, by name.
+
+    Frames the dashboards are built from are made up front, so only the
+    function named is timed. transform_data gets the transactions in the
+    compact schema, the other charts dollar frames like the rollups. The
+    figure builders need plotly and dash and are left out when they are
+    not installed.
+    """
+
+    expenses = pd.concat(synthetic_data.iter_expenses(paths['postings'], paths['seed']),
+                         ignore_index=True)
+    compact = expenses_storage.compact_expenses(expenses)
+    nights = clean_and_export_ledger_data.read_days_toml(paths['days_toml'])
+    with open(paths['convert_output']) as f:
+        convert_output = f.read()
+
+    # Fill the result cache so the cached benchmark only times a hit
+    clean_and_export_ledger_data.get_ledger_csv(paths['journal'], None)
+
+    # A database of its own for the reads, the sync benchmark rewrites its one
+    query_db = os.path.join(work_dir, 'query.db')
+    clean_and_export_ledger_data.sync_ledger_sqlite(paths['journal'], paths['days_toml'], query_db, full=True)
+    city = expense_queries.query_expenses(query_db, ['City'], [('City', '!=', None)])['City'].iloc[0]
+
+    benchmarks = {
+        'read_journal': lambda: ledger_journal.read_journal(paths['journal'], account_pattern='^Expenses'),
+        'read_ledger_csv': lambda: clean_and_export_ledger_data.read_ledger_csv(paths['journal']),
+        'get_ledger_csv (cached)': lambda: clean_and_export_ledger_data.get_ledger_csv(paths['journal'], None),
+        'compact_expenses': lambda: expenses_storage.compact_expenses(expenses),
+        'read_days_toml': lambda: clean_and_export_ledger_data.read_days_toml(paths['days_toml']),
+        'sync_ledger_sqlite (full)': lambda: clean_and_export_ledger_data.sync_ledger_sqlite(
+            paths['journal'], paths['days_toml'], os.path.join(work_dir, 'expenses.db'), full=True),
+        'read_expenses': lambda: expenses_storage.read_expenses(expenses_storage.get_connection(query_db)),
+        'query_expenses (one city)': lambda: expense_queries.query_expenses(
+            query_db, ['Date', 'Category', 'Amount'], [('City', '==', city)]),
+        'query_expenses (city totals)': lambda: expense_queries.query_expenses(
+            query_db, group_by=['City', 'Category']),
+        'clean_ledger_file': lambda: moneywallet_csv_import.clean_ledger_file(convert_output),
+        'convert_moneywallet_csv': lambda: moneywallet_csv_import.convert_moneywallet_csv(
+            paths['moneywallet_csv'], os.path.join(work_dir, 'moneywallet.ledger')),
+    }
+
+    try:
+        import create_graphs
+    except ImportError:
+        return benchmarks
+
+    bar_df = dashboard_data.transform_data(compact, nights, per_day=True, city_or_country='City')
+    country_df = dashboard_data.transform_data(compact, nights, per_day=False, city_or_country='Country')
+    cities = [city for city in nights['City'] if isinstance(city, str) and city != 'International']
+
+    benchmarks.update({
+        'transform_data': lambda: dashboard_data.transform_data(compact, nights, per_day=True,
+                                                                city_or_country='City'),
+        'make_gauge': lambda: create_graphs.make_gauge(expenses[['Date', 'Amount']].copy()),
+        'make_bar_graph': lambda: create_graphs.make_bar_graph(bar_df, cities, use_trip_order=True,
+                                                               use_per_day=True, city_or_country='City'),
+        'make_category_bar': lambda: create_graphs.make_category_bar(expenses[['Category', 'Amount']]),
+        'make_total_graphs': lambda: create_graphs.make_total_graphs('Country', country_df),
+        'make_specific_chart': lambda: create_graphs.make_specific_chart('City', cities[0], 'pie',
+                                                                         expenses, nights, per_day=True),
+    })
+
+    return benchmarks
+
+
+def run_benchmarks(scale='10k', repeat=REPEAT, only=None, data_dir=DATA_DIR, seed=0):
+    """Run the benchmarks on a synthetic journal of scale, returning a df of timings and memory peaks.
+
+    The synthetic files are generated once per scale and seed and kept in
+    data_dir. Everything the benchmarks write goes to a temporary
+    directory, the result cache included. The CALIBRATION benchmark is
+    always run.
+    """
+
+    paths = synthetic_data.generate(data_dir, SCALES[scale], seed)
+    paths.update(postings=SCALES[scale], seed=seed)
+
+    work_dir = tempfile.mkdtemp(prefix='ledger-tools-benchmark-')
+    cache_dir = result_cache.CACHE_DIR
+    result_cache.CACHE_DIR = os.path.join(work_dir, 'cache')
+    try:
+        benchmarks = make_benchmarks(paths, work_dir)
+
+        results = {CALIBRATION: measure(calibrate, repeat)}
+        for name, fn in benchmarks.items():
+            if only and name not in only:
+                continue
+            results[name] = measure(fn, repeat)
+    finally:
+        result_cache.CACHE_DIR = cache_dir
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return pd.DataFrame.from_dict(results, orient='index').rename_axis('Benchmark')
+
+
+def read_baseline(baseline_file=BASELINE_FILE):
+    """Read the stored baselines, a dict of scale to benchmark to its results"""
+
+    if not os.path.exists(baseline_file):
+        return {}
+
+    with open(baseline_file) as f:
+        return json.load(f)
+
+
+def save_baseline(results, scale, baseline_file=BASELINE_FILE):
+    """Store results as the baseline of scale, keeping the baselines of other scales and benchmarks"""
+
+    baselines = read_baseline(baseline_file)
+    baselines.setdefault(scale, {}).update(results[['Seconds', 'PeakBytes']].to_dict(orient='index'))
+
+    with open(baseline_file, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare_baseline(results, baseline, tolerance=TOLERANCE):
+    """Add each benchmark's change from its baseline and flag the ones that regressed.
+
+    A benchmark regressed when it got slower or used more memory than its
+    baseline by more than tolerance, ignoring changes under MIN_SECONDS
+    and MIN_BYTES. Baseline times are scaled by the change in the
+    CALIBRATION benchmark, so a slower or busier machine doesn't flag
+    everything. Benchmarks without a baseline are never flagged.
+    """
+
+    baseline = pd.DataFrame.from_dict(baseline, orient='index', columns=['Seconds', 'PeakBytes'])
+    if CALIBRATION in baseline.index and CALIBRATION in results.index:
+        speed = results.loc[CALIBRATION, 'Seconds'] / baseline.loc[CALIBRATION, 'Seconds']
+        baseline['Seconds'] = baseline['Seconds'] * speed
+    df = results.join(baseline.add_prefix('Baseline'))
+
+    df['SecondsChange'] = df['Seconds'] / df['BaselineSeconds'] - 1
+    df['PeakChange'] = df['PeakBytes'] / df['BaselinePeakBytes'] - 1
+
+    slower = ((df['SecondsChange'] > tolerance)
+              & (df['Seconds'] - df['BaselineSeconds'] > MIN_SECONDS))
+    bigger = ((df['PeakChange'] > tolerance)
+              & (df['PeakBytes'] - df['BaselinePeakBytes'] > MIN_BYTES))
+    df['Regressed'] = slower | bigger
+
+    return df
+
+
+def format_results(df):
+    """Format the results for printing, seconds in ms and memory in MiB"""
+
+    table = pd.DataFrame({'ms': (df['Seconds'] * 1000).round(1),
+                          'median ms': (df['Median'] * 1000).round(1),
+                          'peak MiB': (df['PeakBytes'] / 2 ** 20).round(1)}, index=df.index)
+    if 'Regressed' in df:
+        table['time'] = df['SecondsChange'].map('{:+.0%}'.format, na_action='ignore')
+        table['memory'] = df['PeakChange'].map('{:+.0%}'.format, na_action='ignore')
+        table['regressed'] = df['Regressed'].map({True: 'REGRESSED', False: ''})
+
+    return table.fillna('').to_string()
+
+
+def main(scale='10k', repeat=REPEAT, only=None, save=False, baseline_file=BASELINE_FILE,
+         data_dir=DATA_DIR, tolerance=TOLERANCE):
+    """Run the benchmarks at scale, print them against the baseline and return the regressions"""
+
+    results = run_benchmarks(scale, repeat, only, data_dir)
+
+    baseline = read_baseline(baseline_file).get(scale, {})
+    results = compare_baseline(results, baseline, tolerance)
+    print(f'{scale} postings, best of {repeat}')
+    print(format_results(results))
+
+    if save:
+        save_baseline(results, scale, baseline_file)
+        print(f'Saved the {scale} baseline to {baseline_file}')
+        return []
+
+    return results.index[results['Regressed']].to_list()
@@ -1,88 +1,637 @@
 import pandas as pd
-import sqlite3
 
 import tomllib
 from io import StringIO
 import subprocess
 import os 
+import hashlib
+import json
+import asyncio
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 # import argparse
 
+import expense_rollups
+import expenses_storage
+import ledger_journal
+import parquet_archive
+import pipeline
+import result_cache
+import stage_metrics
 
-def get_ledger_csv(ledger_file, output_path):
-    """Get a csv file of all ledger expenses transactions and clean it."""
+
+# Postings a streaming export cleans and writes at a time
+STREAM_BATCH_ROWS = 50000
+
+# Readers a streaming export can get the postings from
+STREAM_BACKENDS = ['python', 'ledger', 'arrow']
+
+
+def get_ledger_csv(ledger_file, output_path, backend='python'):
+    """Get a df of all ledger expenses transactions and clean it.
+
+    The python backend reads the journal in-process, the ledger backend runs
+    the ledger csv command and is kept as a reference to diff results against.
+    The arrow backend also runs ledger but parses its output with the arrow
+    csv reader, keeping typed arrow backed columns. With a result_cache
+    directory set, results are cached on the contents of the journal and
+    its includes.
+    """
+
+    if backend not in ('python', 'ledger', 'arrow'):
+        raise ValueError(f'Unknown backend "{backend}", use "python", "ledger" or "arrow"')
+
+    # An unchanged journal loads the last result instead of being parsed again,
+    # results cached in an older schema are left to be evicted
+    return result_cache.cached('ledger_csv', [backend, '^Expenses', expenses_storage.SCHEMA_VERSION],
+                               lambda: read_ledger_csv(ledger_file, backend),
+                               ledger_file=ledger_file)
+
+
+def read_ledger_csv(ledger_file, backend='python'):
+    """Read and clean the expenses transactions with one of the get_ledger_csv backends"""
+
+    if backend == 'ledger':
+        return get_ledger_csv_from_ledger(ledger_file)
+    if backend == 'arrow':
+        # pyarrow's csv reader is only loaded for the arrow backend
+        import ledger_arrow
+        transaction_df = ledger_arrow.arrow_to_pandas(ledger_arrow.read_ledger_arrow(ledger_file))
+        return expenses_storage.compact_expenses(order_expenses_columns(transaction_df))
+
+    postings_df, prices_df = ledger_journal.read_journal(ledger_file, account_pattern='^Expenses')
+
+    return clean_postings(postings_df, prices_df)
+
+
+def clean_postings(postings_df, prices_df):
+    """Turn expenses postings from ledger_journal into the ledger_expenses columns, in the compact schema"""
+
+    with stage_metrics.stage('clean_postings') as metrics:
+        metrics['RowsIn'] = len(postings_df)
+
+        # Value the postings in dollars like ledger -X $, keeping what was actually paid
+        transaction_df = ledger_journal.exchange_amounts(postings_df, prices_df, '$')
+        transaction_df['NativeAmount'] = postings_df['Amount'].to_numpy()
+        transaction_df['Commodity'] = postings_df['Commodity'].to_numpy()
+
+        # Remove the Expenses: prefix
+        transaction_df = transaction_df.rename(columns={'Account': 'Category'})
+        transaction_df['Category'] = transaction_df['Category'].str.replace('^Expenses:?', '', regex=True)
+
+        transaction_df = order_expenses_columns(transaction_df.drop(['File', 'Offset'], axis=1))
+        transaction_df = expenses_storage.compact_expenses(transaction_df)
+        metrics['RowsOut'] = len(transaction_df)
+
+    return transaction_df
+
+
+def order_expenses_columns(transaction_df):
+    """Put the ledger_expenses columns in order, any other tags go at the end"""
+
+    columns = ['Date', 'Payee', 'Category', 'Amount', 'NativeAmount', 'Commodity',
+               'Note', 'Country', 'City']
+    for column in columns:
+        if column not in transaction_df.columns:
+            transaction_df[column] = None
+    tag_columns = [c for c in transaction_df.columns if c not in columns]
+
+    return transaction_df[columns + tag_columns]
+
+
+def ledger_csv_command(ledger_file):
+    """Build the ledger csv command that prints one expenses posting per line"""
 
     # Run the ledger csv command with the format string specifying output
     format_string_csv = ''' ' %(quoted(date))␟ %(quoted(payee))␟ %(quoted(display_account))␟ %(quoted(quantity(scrub(display_amount))))␟ %(quoted(join(note | xact.note)))\n' '''
 
-    report_cmd = r'ledger -f /home/carson/Files/accounting/asia-trip.ledger csv -X $ ^Expenses'
+    report_cmd = r'ledger -f ' + ledger_file + r' csv -X $ ^Expenses'
+
+    return report_cmd + ' --csv-format ' + format_string_csv
+
 
-    report_cmd = report_cmd + ' --csv-format ' + format_string_csv
+def get_ledger_csv_from_ledger(ledger_file):
+    """Get a df of all ledger expenses transactions from the ledger csv command."""
 
     # Run the command and turn the output into a df
-    csv_output = subprocess.check_output(report_cmd, shell=True).decode('utf-8')
-    transaction_df = pd.read_csv(StringIO(csv_output), sep='␟', header=None, engine='python')
-    transaction_df.columns = ['Date', 'Payee', 'Category', 'Amount', 'metadata']
-
-    # Trim quotes off both ends of all columns
-    transaction_df[transaction_df.columns] = transaction_df.apply(lambda x: x.str.strip())
-    transaction_df[transaction_df.columns] = transaction_df.apply(lambda x: x.str.lstrip('"'))
-    transaction_df[transaction_df.columns] = transaction_df.apply(lambda x: x.str.rstrip('"'))
-
-    # Replace all \n with real newline characters then split on them
-    transaction_df['metadata'] = transaction_df['metadata'].str.replace('\\n', '\n')
-
-    metadata_df = pd.DataFrame(columns=['Note', 'Country', 'City'])
-    metadata_df[['Note', 'Country', 'City']] = transaction_df['metadata'].str.split('\n', expand=True)
-
-    transaction_df = transaction_df.drop('metadata', axis=1)
-
-    # Strip quotes and spaces off all metadata columns
-    # Must strip whitespace, then quotes then whitespace again
-    metadata_df[metadata_df.columns] = metadata_df.apply(lambda x: x.str.strip())
-    metadata_df[metadata_df.columns] = metadata_df.apply(lambda x: x.str.strip('"'))
-    metadata_df[metadata_df.columns] = metadata_df.apply(lambda x: x.str.strip())
-
-    # Find the rows without notes, shift them one to the right
-    no_note_rows = metadata_df.loc[metadata_df['Note']
-                                   .str.startswith('City:', na=False)]
-    no_note_rows = no_note_rows.shift(1, axis=1)
-    metadata_df.loc[no_note_rows.index] = no_note_rows
-
-    # Do it again for ones starting with Country:
-    no_note_rows = metadata_df.loc[metadata_df['Note']
-                                   .str.startswith('Country:', na=False)]
-    no_note_rows = no_note_rows.shift(1, axis=1)
-    metadata_df.loc[no_note_rows.index] = no_note_rows
-    
-    # Find the rows where city is in the country column, swap them
-    rows_to_swap = metadata_df.loc[metadata_df['Country']
-                                   .str.startswith('City:', na=False)]
-    rows_to_swap[['City', 'Country']] = rows_to_swap[['Country', 'City']]
-    metadata_df.loc[rows_to_swap.index] = rows_to_swap
-
-    # Concat the metadata_df onto the transaction_df
-    transaction_df = pd.concat([transaction_df, metadata_df],
-                               axis=1)
-
-    # Remove the City: Country: and Expenses: prefixes
-    transaction_df['City'] = transaction_df['City'].str.lstrip('City')
-    transaction_df['City'] = transaction_df['City'].str.lstrip(':')
-    transaction_df['City'] = transaction_df['City'].str.strip()
-
-    transaction_df['Country'] = transaction_df['Country'].str.lstrip('Country')
-    transaction_df['Country'] = transaction_df['Country'].str.lstrip(':')
-    transaction_df['Country'] = transaction_df['Country'].str.strip()
-
-    transaction_df['Category'] = transaction_df['Category'].str.lstrip('Expenses')
-    transaction_df['Category'] = transaction_df['Category'].str.lstrip(':')
-    transaction_df['Category'] = transaction_df['Category'].str.strip()
-
-    # Change the dtypes on date and amount
-    transaction_df['Date'] = pd.to_datetime(transaction_df['Date'])
-    transaction_df['Amount'] = pd.to_numeric(transaction_df['Amount'])
+    with stage_metrics.stage('ledger csv') as metrics:
+        csv_output = subprocess.check_output(ledger_csv_command(ledger_file), shell=True)
+        metrics['BytesRead'] = len(csv_output)
+
+    return clean_ledger_csv(csv_output.decode('utf-8'))
+
+
+def clean_ledger_csv(csv_text):
+    """Turn lines printed by ledger_csv_command into the ledger_expenses columns, in the compact schema"""
+
+    with stage_metrics.stage('read_csv') as metrics:
+        transaction_df = pd.read_csv(StringIO(csv_text), sep='␟', header=None,
+                                     engine='python', dtype=str)
+        transaction_df.columns = ['Date', 'Payee', 'Category', 'Amount', 'metadata']
+        metrics['RowsOut'] = len(transaction_df)
+
+    with stage_metrics.stage('metadata') as metrics:
+        metrics['RowsIn'] = len(transaction_df)
+
+        # Trim spaces and quotes off both ends of all columns
+        for column in transaction_df.columns:
+            transaction_df[column] = transaction_df[column].str.strip(' "')
+
+        # Split the note block on its escaped newlines into the Note and a column per tag
+        metadata_df = ledger_journal.extract_note_tags(transaction_df.pop('metadata'), line_sep='\\n')
+        transaction_df = transaction_df.join(metadata_df)
+
+        # Remove the Expenses: prefix
+        transaction_df['Category'] = transaction_df['Category'].str.replace('^Expenses:?', '', regex=True)
+
+        # Change the dtypes on date, amount and the repeated text columns
+        transaction_df = expenses_storage.compact_expenses(order_expenses_columns(transaction_df))
+        metrics['RowsOut'] = len(transaction_df)
 
     return transaction_df
 
+
+def diff_backends(ledger_file):
+    """Return the rows that only one of the python and ledger backends produce"""
+
+    columns = ['Date', 'Payee', 'Category', 'Amount', 'Note', 'Country', 'City']
+
+    python_df = get_ledger_csv(ledger_file, None, backend='python')[columns]
+    ledger_df = get_ledger_csv(ledger_file, None, backend='ledger')[columns]
+
+    # Ledger reports revaluations as their own postings, the python backend doesn't
+    ledger_df = ledger_df[~ledger_df['Category'].str.contains('<Revalued>|<Adjustment>')]
+
+    # Compare on the amounts in hundredths and empty strings for missing values
+    for df in (python_df, ledger_df):
+        df[['Payee', 'Category', 'Country', 'City']] = df[['Payee', 'Category', 'Country', 'City']].astype(object)
+        df[['Note', 'Country', 'City']] = df[['Note', 'Country', 'City']].fillna('')
+
+    diff_df = pd.merge(python_df, ledger_df, how='outer', indicator='Backend')
+    diff_df = diff_df[diff_df['Backend'] != 'both']
+    diff_df['Backend'] = diff_df['Backend'].map({'left_only': 'python',
+                                                 'right_only': 'ledger'})
+
+    return diff_df
+
+
+def hash_file(path, checkpoint_size=None):
+    """Return the sha256 of a file, and of its first checkpoint_size bytes if given"""
+
+    hasher = hashlib.sha256()
+    checkpoint_hash = None
+
+    with open(path, 'rb') as f:
+        if checkpoint_size is not None:
+            remaining = checkpoint_size
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+            checkpoint_hash = hasher.hexdigest()
+
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest(), checkpoint_hash
+
+
+def read_sync_state(connection, ledger_file):
+    """Get the checkpoint from the last sync of ledger_file, or None"""
+
+    cursor = connection.execute('SELECT * FROM ledger_sync WHERE "Journal" = ?',
+                                (os.path.abspath(ledger_file),))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+
+    state = dict(zip([c[0] for c in cursor.description], row))
+    state['Includes'] = json.loads(state['Includes'])
+
+    return state
+
+
+def write_sync_state(connection, state):
+    """Save the sync checkpoint for a journal"""
+
+    state = dict(state, Includes=json.dumps(state['Includes']))
+    columns = ', '.join(f'"{k}"' for k in state)
+    connection.execute(f'INSERT OR REPLACE INTO ledger_sync ({columns}) '
+                       f'VALUES ({", ".join("?" * len(state))})',
+                       tuple(state.values()))
+
+
+def read_journal_prices(ledger_file):
+    """Read every price in a journal, cached on its contents when result_cache has a directory"""
+
+    return result_cache.cached('journal_prices', [expenses_storage.SCHEMA_VERSION],
+                               lambda: ledger_journal.read_prices(ledger_file), ledger_file=ledger_file)
+
+
+def read_journal_expenses(ledger_file, files):
+    """Read a whole journal's expenses postings and prices, cached on its contents like read_journal_prices.
+
+    files is filled in with the journal's includes, like read_journal does.
+    A rebuild of a journal that is unchanged since the last one, like
+    after clearing the database, loads both frames instead of parsing.
+    """
+
+    parsed = {}
+
+    def read_postings():
+        parsed['postings'], parsed['prices'] = ledger_journal.read_journal(ledger_file, '^Expenses')
+        return parsed['postings']
+
+    postings_df = result_cache.cached('journal_expenses', ['^Expenses', expenses_storage.SCHEMA_VERSION],
+                                      read_postings, ledger_file=ledger_file)
+    if 'prices' in parsed:
+        # Parsed just now, store the prices that came with the postings
+        prices_df = result_cache.cached('journal_prices', [expenses_storage.SCHEMA_VERSION],
+                                        lambda: parsed['prices'], ledger_file=ledger_file)
+    else:
+        prices_df = read_journal_prices(ledger_file)
+    files.extend(ledger_journal.include_files(ledger_file))
+
+    return postings_df, prices_df
+
+
+def plan_ledger_sync(ledger_file, sqlite_path, full=False):
+    """Work out what changed in the journal since the last sync and parse it.
+
+    Only what was appended to the journal since the last sync is read, from
+    the start of the last transaction synced in case it was extended.
+    Everything is read when earlier history or an included file changed,
+    when a new price could change the value of rows already stored, or when
+    full is True. Returns a dict of what write_ledger_sync needs, Postings
+    is None when nothing was appended.
+    """
+
+    ledger_file = os.path.abspath(ledger_file)
+    connection = expenses_storage.get_connection(sqlite_path)
+    state = None if full else read_sync_state(connection, ledger_file)
+
+    size = os.path.getsize(ledger_file)
+    if state is not None and size >= state['Size']:
+        journal_hash, checkpoint_hash = hash_file(ledger_file, state['Size'])
+        includes_changed = any(not os.path.exists(path) or hash_file(path)[0] != file_hash
+                               for path, file_hash in state['Includes'].items())
+        if checkpoint_hash != state['Hash'] or includes_changed:
+            # Earlier history was edited
+            state = None
+    else:
+        journal_hash = hash_file(ledger_file)[0]
+        state = None
+
+    files = []
+    if state is None:
+        # Full rebuild
+        postings_df, prices_df = read_journal_expenses(ledger_file, files)
+        start_offset = 0
+        includes = {}
+        toml_hash = None
+    elif size == state['Size']:
+        # Nothing appended to the journal
+        postings_df = prices_df = start_offset = None
+        includes = state['Includes']
+        toml_hash = state['TomlHash']
+    else:
+        # Read from the start of the last transaction synced
+        postings_df, prices_df = ledger_journal.read_journal(ledger_file, '^Expenses',
+                                                             start_offset=state['LastOffset'],
+                                                             files=files)
+        start_offset = state['LastOffset']
+        includes = state['Includes']
+        toml_hash = state['TomlHash']
+
+        # A new price dated inside the history already stored would change its value
+        new_prices = prices_df[prices_df['Offset'] >= state['Size']]
+        if (new_prices['Date'] <= pd.Timestamp(state['LastDate'])).any():
+            return plan_ledger_sync(ledger_file, sqlite_path, full=True)
+
+    return {'Journal': ledger_file,
+            'State': state,
+            'Postings': postings_df,
+            'Prices': prices_df,
+            'StartOffset': start_offset,
+            'Files': files,
+            'Includes': includes,
+            'Size': size,
+            'Hash': journal_hash,
+            'TomlHash': toml_hash}
+
+
+def read_nights(days_toml):
+    """Hash the days toml and read it into the nights df"""
+
+    return hash_file(days_toml)[0], read_days_toml(days_toml)
+
+
+def write_ledger_sync(sqlite_path, plan, nights):
+    """Write a sync planned by plan_ledger_sync and the nights from read_nights.
+
+    The rows of a rebuild replace the whole table, otherwise the rows of the
+    last transaction synced are replaced along with what was appended. The
+    nights table is only rewritten when the toml changed. Everything is
+    committed in one transaction. Returns the number of transaction rows written.
+    """
+
+    connection = expenses_storage.get_connection(sqlite_path)
+    ledger_file = plan['Journal']
+    trip = journal_trip(ledger_file)
+    state = plan['State']
+    postings_df = plan['Postings']
+    prices_df = plan['Prices']
+    start_offset = plan['StartOffset']
+    files = plan['Files']
+    includes = plan['Includes']
+    toml_hash = plan['TomlHash']
+
+    rows = 0
+    with expenses_storage.transaction(connection):
+        claim_trip(connection, ledger_file)
+
+        if postings_df is not None:
+            if state is None:
+                # Rows with no trip are from before the Trip key and get replaced too
+                connection.execute('DELETE FROM ledger_expenses WHERE "Trip" = ? OR "Trip" IS NULL', (trip,))
+                connection.execute('DELETE FROM ledger_prices WHERE "Trip" = ? OR "Trip" IS NULL', (trip,))
+            else:
+                # Replace the rows and prices read again, value the new rows with every price
+                connection.execute('DELETE FROM ledger_expenses WHERE "Trip" = ? AND "Id" >= ?',
+                                   (trip, state['LastRowid']))
+                connection.execute('DELETE FROM ledger_prices WHERE "Trip" = ? AND "Offset" >= ?',
+                                   (trip, start_offset))
+                stored_prices_df = pd.read_sql_query('SELECT "Date", "Commodity", "Price", "PriceCommodity", "Offset" '
+                                                     'FROM ledger_prices WHERE "Trip" = ?', connection,
+                                                     params=(trip,), parse_dates=['Date'],
+                                                     dtype={'Price': float})
+                prices_df = pd.concat([stored_prices_df, prices_df], ignore_index=True)
+
+            first_rowid = connection.execute('SELECT COALESCE(MAX("Id"), 0) + 1 FROM ledger_expenses').fetchone()[0]
+
+            df = clean_postings(postings_df, prices_df).assign(Trip=trip)
+            expenses_storage.insert_rows(connection, 'ledger_expenses', df)
+            expenses_storage.insert_rows(connection, 'ledger_prices',
+                                         prices_df[prices_df['Offset'] >= start_offset].assign(Trip=trip))
+            rows = len(df)
+
+            # Checkpoint at the last transaction so it can be replaced if it is extended
+            last_offset = ledger_journal.last_entry_offset(ledger_file, start_offset)
+            includes = dict(includes, **{path: hash_file(path)[0] for path in files})
+            last_date = connection.execute('SELECT MAX("Date") FROM ledger_expenses WHERE "Trip" = ?',
+                                           (trip,)).fetchone()[0]
+            state = {'Journal': ledger_file,
+                     'Size': plan['Size'],
+                     'Hash': plan['Hash'],
+                     'LastOffset': last_offset,
+                     'LastRowid': first_rowid + int((postings_df['Offset'] < last_offset).sum()),
+                     'LastDate': last_date or '0001-01-01',
+                     'Includes': includes,
+                     'TomlHash': toml_hash}
+
+        # Only rewrite the nights table when the toml changed
+        new_toml_hash, nights_df = nights
+        toml_changed = new_toml_hash != state['TomlHash']
+        if toml_changed:
+            connection.execute('DELETE FROM city_nights WHERE "Trip" = ? OR "Trip" IS NULL', (trip,))
+            expenses_storage.insert_rows(connection, 'city_nights', nights_df.assign(Trip=trip))
+            state['TomlHash'] = new_toml_hash
+
+        # Refresh the rollups in the same transaction as the tables they summarise
+        has_rollups = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'rollup_daily'").fetchone()[0]
+        if postings_df is not None or toml_changed or not has_rollups:
+            expense_rollups.refresh_rollups(connection)
+
+        write_sync_state(connection, state)
+
+    return rows
+
+
+def journal_trip(ledger_file):
+    """Name the trip a journal's rows are kept under, the journal's file name"""
+
+    return os.path.splitext(os.path.basename(ledger_file))[0]
+
+
+def check_journal_trips(journals):
+    """Raise a ValueError if two of the journals would be kept under the same trip"""
+
+    trips = {}
+    for ledger_file in journals:
+        trip = journal_trip(ledger_file)
+        if trip in trips:
+            raise ValueError(f'{trips[trip]} and {ledger_file} would both be exported as trip "{trip}", '
+                             f'rename one of them')
+        trips[trip] = ledger_file
+
+
+def claim_trip(connection, ledger_file):
+    """Make sure no other journal has been synced as the trip of ledger_file.
+
+    A journal still on disk under another path with the same file name
+    raises a ValueError, its rows would be replaced. The checkpoint of one
+    that no longer exists is dropped, the journal was moved.
+    """
+
+    ledger_file = os.path.abspath(ledger_file)
+    trip = journal_trip(ledger_file)
+
+    for (journal,) in connection.execute('SELECT "Journal" FROM ledger_sync').fetchall():
+        if journal == ledger_file or journal_trip(journal) != trip:
+            continue
+        if os.path.exists(journal):
+            raise ValueError(f'{journal} is already exported as trip "{trip}", '
+                             f'rename {ledger_file} to export it too')
+        connection.execute('DELETE FROM ledger_sync WHERE "Journal" = ?', (journal,))
+
+
+def journal_days_toml(ledger_file):
+    """Find the nights toml kept next to a journal, city-days-<trip>.toml"""
+
+    return os.path.join(os.path.dirname(ledger_file), f'city-days-{journal_trip(ledger_file)}.toml')
+
+
+async def sync_journals(journals, sqlite_path, full=False, max_concurrent=4):
+    """Sync several journals into one database, parsing up to max_concurrent at once.
+
+    journals maps each journal to its nights toml. Each journal is parsed
+    and its toml read in a worker process, and its rows are written as soon
+    as it is done while the others are still parsing. Sqlite has a single
+    writer, so the writes take turns on the event loop's thread.
+    Returns the number of rows written for each trip.
+    """
+
+    check_journal_trips(journals)
+
+    # Create the schema once, before the workers open their own connections
+    expenses_storage.get_connection(sqlite_path)
+
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(max_concurrent)
+
+    with ProcessPoolExecutor(max_workers=max_concurrent) as executor:
+
+        async def sync(ledger_file, days_toml):
+            trip = journal_trip(ledger_file)
+            async with limit:
+                (plan, parse_metrics), nights = await asyncio.gather(
+                    loop.run_in_executor(executor, stage_metrics.call_in_stage, f'parse {trip}',
+                                         plan_ledger_sync, ledger_file, sqlite_path, full),
+                    loop.run_in_executor(executor, read_nights, days_toml))
+
+            # The journal was parsed in a worker, so its stage is recorded from here
+            if plan['Postings'] is not None:
+                parse_metrics['RowsOut'] = len(plan['Postings'])
+                parse_metrics['BytesRead'] = plan['Size'] - plan['StartOffset']
+            stage_metrics.record(parse_metrics)
+
+            with stage_metrics.stage(f'to_sql {trip}') as metrics:
+                metrics['RowsIn'] = 0 if plan['Postings'] is None else len(plan['Postings'])
+                metrics['RowsOut'] = write_ledger_sync(sqlite_path, plan, nights)
+
+            return metrics['RowsOut']
+
+        rows = await asyncio.gather(*(sync(ledger_file, days_toml)
+                                      for ledger_file, days_toml in journals.items()))
+
+    return {journal_trip(ledger_file): count for ledger_file, count in zip(journals, rows)}
+
+
+def sync_ledger_sqlite(ledger_file, days_toml, sqlite_path, full=False):
+    """Bring the ledger_expenses and city_nights tables up to date, one stage after another.
+
+    Returns the number of transaction rows written.
+    """
+
+    plan = plan_ledger_sync(ledger_file, sqlite_path, full=full)
+
+    return write_ledger_sync(sqlite_path, plan, read_nights(days_toml))
+
+
+def iter_ledger_csv_batches(ledger_file, batch_rows=STREAM_BATCH_ROWS):
+    """Stream the ledger csv command's output as cleaned dfs of up to batch_rows rows.
+
+    ledger's stdout is read from a pipe while it prints, so only one batch
+    of lines is held at a time however long the journal is.
+    """
+
+    report_cmd = ledger_csv_command(ledger_file)
+
+    with subprocess.Popen(report_cmd, shell=True, stdout=subprocess.PIPE) as process:
+        while True:
+            with stage_metrics.stage('ledger csv') as metrics:
+                csv_output = b''.join(itertools.islice(process.stdout, batch_rows))
+                metrics['BytesRead'] = len(csv_output)
+            if not csv_output:
+                break
+            yield clean_ledger_csv(csv_output.decode('utf-8'))
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, report_cmd)
+
+
+def iter_ledger_arrow_batches(ledger_file, batch_rows=STREAM_BATCH_ROWS):
+    """Stream ledger's output through the arrow csv reader as cleaned dfs of about batch_rows rows"""
+
+    # pyarrow's csv reader is only loaded for the arrow backend
+    import ledger_arrow
+
+    for table in ledger_arrow.iter_ledger_arrow(ledger_file, batch_rows):
+        with stage_metrics.stage('arrow batch') as metrics:
+            metrics['RowsIn'] = table.num_rows
+            df = expenses_storage.compact_expenses(order_expenses_columns(ledger_arrow.arrow_to_pandas(table)))
+        yield df
+
+
+def iter_journal_batches(ledger_file, prices_df, batch_rows=STREAM_BATCH_ROWS):
+    """Stream a journal parsed in-process as cleaned dfs of up to batch_rows rows.
+
+    The postings are valued with prices_df, which has to hold every price in
+    the journal since a posting can be valued by a price further down it.
+    """
+
+    for postings_df in ledger_journal.iter_postings(ledger_file, '^Expenses', batch_rows):
+        if len(postings_df):
+            yield clean_postings(postings_df, prices_df)
+
+
+def stream_ledger_sqlite(ledger_file, days_toml, sqlite_path, backend='python',
+                         batch_rows=STREAM_BATCH_ROWS):
+    """Rebuild a journal's rows in sqlite a batch at a time, holding one batch in memory.
+
+    The python backend reads the journal's prices in a first pass, then
+    parses and values its postings in batches. The ledger backend reads the
+    ledger csv command's output from a pipe, and the arrow backend reads
+    the same with the arrow csv reader. ledger values the postings itself
+    so there are no prices to store for either. Every batch is written in one
+    transaction with the nights and rollups. The sync checkpoint left is
+    from the start of the journal, so the next sync skips it if nothing
+    changed and reads it all again otherwise. Returns the number of
+    transaction rows written.
+    """
+
+    if backend not in STREAM_BACKENDS:
+        raise ValueError(f'Unknown backend "{backend}", use one of {STREAM_BACKENDS}')
+
+    ledger_file = os.path.abspath(ledger_file)
+    trip = journal_trip(ledger_file)
+    connection = expenses_storage.get_connection(sqlite_path)
+
+    # Hash before reading, a journal edited during the run is read again next time
+    size = os.path.getsize(ledger_file)
+    journal_hash = hash_file(ledger_file)[0]
+    includes = {path: hash_file(path)[0] for path in ledger_journal.include_files(ledger_file)}
+    toml_hash, nights_df = read_nights(days_toml)
+
+    if backend == 'python':
+        with stage_metrics.stage(f'prices {trip}') as metrics:
+            prices_df = read_journal_prices(ledger_file)
+            metrics['RowsOut'] = len(prices_df)
+        batches = iter_journal_batches(ledger_file, prices_df, batch_rows)
+    elif backend == 'arrow':
+        prices_df = None
+        batches = iter_ledger_arrow_batches(ledger_file, batch_rows)
+    else:
+        prices_df = None
+        batches = iter_ledger_csv_batches(ledger_file, batch_rows)
+
+    rows = 0
+    with expenses_storage.transaction(connection):
+        claim_trip(connection, ledger_file)
+
+        # Rows with no trip are from before the Trip key and get replaced too
+        for table in ('ledger_expenses', 'ledger_prices', 'city_nights'):
+            connection.execute(f'DELETE FROM {table} WHERE "Trip" = ? OR "Trip" IS NULL', (trip,))
+
+        first_rowid = connection.execute('SELECT COALESCE(MAX("Id"), 0) + 1 FROM ledger_expenses').fetchone()[0]
+
+        for df in batches:
+            with stage_metrics.stage(f'to_sql {trip}') as metrics:
+                metrics['RowsIn'] = len(df)
+                expenses_storage.insert_rows(connection, 'ledger_expenses', df.assign(Trip=trip))
+            rows += len(df)
+
+        if prices_df is not None:
+            expenses_storage.insert_rows(connection, 'ledger_prices', prices_df.assign(Trip=trip))
+        expenses_storage.insert_rows(connection, 'city_nights', nights_df.assign(Trip=trip))
+        expense_rollups.refresh_rollups(connection)
+
+        last_date = connection.execute('SELECT MAX("Date") FROM ledger_expenses WHERE "Trip" = ?',
+                                       (trip,)).fetchone()[0]
+        write_sync_state(connection, {'Journal': ledger_file,
+                                      'Size': size,
+                                      'Hash': journal_hash,
+                                      'LastOffset': 0,
+                                      'LastRowid': first_rowid,
+                                      'LastDate': last_date or '0001-01-01',
+                                      'Includes': includes,
+                                      'TomlHash': toml_hash})
+
+    return rows
+
+
 def read_days_toml(days_toml):
     """Read the toml file to a list, fix place names, export to sqlite"""
 
@@ -111,33 +660,127 @@ def read_days_toml(days_toml):
     return nights_df
 
 
+def export_ledger(journals, sqlite_path, csv_output=None, archive_dir=None, full=False,
+                  max_concurrent=4):
+    """Sync the journals into sqlite, then write the csv copy and refresh the parquet archive.
+
+    journals maps each journal to its nights toml. Runs as a DAG of stages,
+    the journals are synced concurrently by sync_journals, then the csv and
+    parquet sinks run at the same time once every sync is committed.
+    Returns the number of rows written for each trip.
+    """
+
+    check_journal_trips(journals)
+
+    def stale_trips(rows):
+        if archive_dir is None:
+            return []
+        return [trip for trip, count in rows.items()
+                if count or not os.path.exists(os.path.join(archive_dir, f'Trip={trip}'))]
+
+    def archive_stale(rows):
+        return bool(stale_trips(rows))
+
+    def read_synced(rows):
+        # Only read the table back when a sink needs it
+        if csv_output is None and not archive_stale(rows):
+            return None
+        return expenses_storage.read_expenses(expenses_storage.get_connection(sqlite_path))
+
+    def write_csv(df):
+        with stage_metrics.stage('to_csv') as metrics:
+            metrics['RowsIn'] = len(df)
+            # The csv copy keeps amounts in dollars like it always has
+            expenses_storage.expenses_in_units(df).to_csv(csv_output, index=False)
+            metrics['BytesWritten'] = os.path.getsize(csv_output)
+
+    def write_archive(rows, df):
+        # Only the partitions of trips that changed are rewritten
+        for trip in stale_trips(rows):
+            with stage_metrics.stage(f'to_parquet {trip}') as metrics:
+                trip_df = df[df['Trip'] == trip]
+                metrics['RowsIn'] = len(trip_df)
+                parquet_archive.write_parquet_archive(trip_df, archive_dir, trip)
+
+    # Export to sqlite, only reading what changed since the last run
+    stages = {'sqlite': (lambda: asyncio.run(sync_journals(journals, sqlite_path, full=full,
+                                                           max_concurrent=max_concurrent)), []),
+              'expenses': (read_synced, ['sqlite'])}
+
+    # Write the csv copy and parquet archive from the synced table
+    if csv_output is not None:
+        stages['csv'] = (write_csv, ['expenses'])
+    if archive_dir is not None:
+        stages['archive'] = (write_archive, ['sqlite', 'expenses'])
+
+    results = pipeline.run_pipeline(stages)
+
+    return results['sqlite']
+
+
+def stream_export_ledger(journals, sqlite_path, csv_output=None, archive_dir=None, backend='python',
+                         batch_rows=STREAM_BATCH_ROWS):
+    """Export like export_ledger, holding one batch of batch_rows rows in memory however long the journals are.
+
+    Each journal is rebuilt by stream_ledger_sqlite, one after another so
+    only one batch is ever in memory. The csv copy and the trips' parquet
+    partitions are then written from the synced table a batch at a time.
+    The connection runs with the STREAM_PRAGMAS until the export is done.
+    Returns the number of rows written for each trip.
+    """
+
+    check_journal_trips(journals)
+
+    connection = expenses_storage.get_connection(sqlite_path)
+    for pragma, value in expenses_storage.STREAM_PRAGMAS.items():
+        connection.execute(f'PRAGMA {pragma} = {value}')
+
+    rows = {}
+    try:
+        for ledger_file, days_toml in journals.items():
+            trip = journal_trip(ledger_file)
+            with stage_metrics.stage(f'stream {trip}') as metrics:
+                rows[trip] = metrics['RowsOut'] = stream_ledger_sqlite(ledger_file, days_toml, sqlite_path,
+                                                                       backend, batch_rows)
+
+        if csv_output is not None:
+            with stage_metrics.stage('to_csv') as metrics:
+                metrics['RowsIn'] = 0
+                for df in expenses_storage.iter_expenses(connection, batch_rows):
+                    # The csv copy keeps amounts in dollars like it always has
+                    expenses_storage.expenses_in_units(df).to_csv(csv_output, index=False,
+                                                                  mode='a' if metrics['RowsIn'] else 'w',
+                                                                  header=not metrics['RowsIn'])
+                    metrics['RowsIn'] += len(df)
+                metrics['BytesWritten'] = os.path.getsize(csv_output) if metrics['RowsIn'] else 0
+
+        if archive_dir is not None:
+            for trip in rows:
+                with stage_metrics.stage(f'to_parquet {trip}') as metrics:
+                    metrics['RowsIn'] = 0
+                    for df in expenses_storage.iter_expenses(connection, batch_rows, trip):
+                        parquet_archive.write_parquet_archive(df, archive_dir, trip,
+                                                              replace=not metrics['RowsIn'])
+                        metrics['RowsIn'] += len(df)
+    finally:
+        for pragma in expenses_storage.STREAM_PRAGMAS:
+            connection.execute(f'PRAGMA {pragma} = {expenses_storage.PRAGMAS[pragma]}')
+
+    return rows
+
+
 def main():
 
     ledger_file = "/home/carson/Files/accounting/asia-trip.ledger"
     days_toml = "/home/carson/Files/accounting/city-days-asia-trip.toml"
     csv_output = '/home/carson/Files/expenses.csv'
 
-    df = get_ledger_csv(ledger_file, csv_output)
-
-    df.to_csv(csv_output, index=False)
-
     # Get path of directory python file is in and make path for sqlite database
     dir_path = os.getcwd()
     sqlite_path = os.path.join(dir_path, 'expenses.db')
-    
-    # Export to sqlite
-    sqliteConnection = sqlite3.connect(sqlite_path)
-    df.to_sql('ledger_expenses', sqliteConnection,
-              if_exists="replace", index=False)
-
-    nights_df = read_days_toml(days_toml)
-    # Export to sqlite
-    sqliteConnection = sqlite3.connect(sqlite_path)
-    nights_df.to_sql('city_nights', sqliteConnection,
-                     if_exists="replace", index=False)
 
+    export_ledger({ledger_file: days_toml}, sqlite_path, csv_output)
 
-main()
 
 if __name__ == "__main__":
 
@@ -1,72 +1,22 @@
 import pandas as pd
-import sqlite3
 import plotly.express as px
 import plotly.graph_objects as go
 from dash import Dash, html, dash_table, dcc, callback, Output, Input
 from datetime import datetime
+import functools
+import itertools
+import json
+import os
 
+import account_tree
+import currency_conversion
+import dashboard_data
+import expense_queries
+import expense_rollups
+import expenses_storage
 
-def get_sqlite_data(database_name):
-    # Create connection
-    cnx = sqlite3.connect(database_name)
 
-    # Read the data into dfs
-    trans_df = pd.read_sql_query("SELECT * FROM ledger_expenses", cnx)
-    nights_df = pd.read_sql_query("SELECT * FROM city_nights", cnx)
-
-    return trans_df, nights_df
-
-
-def transform_data(trans_df, nights_df, per_day, city_or_country):
-    # Filter out revalued and adjustment transactions
-    trans_df = trans_df[~trans_df['Category'].str.contains("<Revalued>|<Adjustment>")]
-
-    # Group by city and category and find sum of amounts
-    aggregated = trans_df.groupby([city_or_country, 'Category']) \
-                         .agg({'Amount': ['sum']}) \
-                         .reset_index()
-    aggregated.columns = [city_or_country, 'Category', 'Amount']
-
-    # If making per day graph, divide all amounts by days in that city
-    if per_day:
-        # Create a column of nights spent
-        aggregated = pd.merge(aggregated, nights_df, on=city_or_country, how='left')
-
-        # Divide the amount column by the nights column
-        aggregated['Amount'] = aggregated['Amount']/aggregated['Nights']
-
-        # Round again
-        aggregated['Amount'] = aggregated['Amount'].round(decimals=2)
-
-    # Sort the categories by a manual list -----------------------------
-    try:
-        sorter = ['Accomodation', 'Food & Drink', 'Activities',
-                  'Transportation:Plane', 'Transportation:Boat',
-                  'Transportation:Bus', 'Transportation:Train',
-                  'Transportation:City Transit', 'Untracked Cash',
-                  'ATM Fees', 'Visa Fees', 'Insurance', 'Purchases', 'Misc']
-
-        sorted_df = aggregated.sort_values(by="Category",
-                                           key=lambda column: column.map(lambda e: sorter.index(e)))
-    except ValueError:
-        # If there are values not in the manual list, sort by the total sum instead
-        # Sort the categories by largest total amount ----------------------
-        # https://stackoverflow.com/questions/14941366/
-        # pandas-sort-by-group-aggregate-and-column
-        print('Error in manual sorting, sorting categories automatically by sum')
-
-        # Group by category and sort by sum of amount
-        grp = aggregated.groupby('Category')
-        grp[['Amount']].transform(sum).sort_values('Amount', ascending=False)
-
-        # Sort the aggregated by the indexes we got from the sort above
-        sorted_df = aggregated.iloc[grp[['Amount']].transform(sum)
-                                    .sort_values('Amount', ascending=False).index]
-
-    return sorted_df
-
-
-def make_bar_graph(df, cities_order, use_trip_order, use_per_day, city_or_country):
+def make_bar_graph(df, cities_order, use_trip_order, use_per_day, city_or_country, currency='$'):
 
     # Filter out international transactions
     df = df[~df[city_or_country].str.contains("International", na=False)]
@@ -75,7 +25,7 @@ def make_bar_graph(df, cities_order, use_trip_order, use_per_day, city_or_countr
     fig = px.bar(df,
                  x=city_or_country, y=["Amount"],
                  color='Category',
-                 color_discrete_map=category_color_dict,
+                 color_discrete_map=account_tree.node_colors(df['Category']),
                  category_orders={"Category": 'total_descending'},
                  )
 
@@ -88,19 +38,35 @@ def make_bar_graph(df, cities_order, use_trip_order, use_per_day, city_or_countr
 
     # If per day, add constant line at $65 per day and new title
     if use_per_day:
-        fig.add_hline(y=65)
+        if currency == '$':
+            fig.add_hline(y=65)
         fig.update_layout(title="Per Day Expenses by City")
     else:
         fig.update_layout(title="Total Expenses by City")
 
     # Style the chart
     fig.update_layout(font={'size': 18})
-    fig.update_layout(yaxis_tickprefix='$')
+    if len(currency) == 1:
+        fig.update_layout(yaxis_tickprefix=currency)
+    else:
+        fig.update_layout(yaxis_ticksuffix=' ' + currency)
     fig.update_xaxes(tickangle=315)
 
     return fig
 
 
+def get_specific_data(sqlite_path, city_or_country, name):
+    """Get the category totals and nights of just one city or country, filtered and summed in sqlite"""
+
+    filters = [(city_or_country, '==', name)]
+    trans_df = expense_queries.query_expenses(sqlite_path, filters=filters,
+                                              group_by=[city_or_country, 'Category'])
+    nights_df = expense_queries.query_nights(sqlite_path, city_or_country, filters=filters)
+
+    # The charts are in dollars
+    return expenses_storage.expenses_in_units(trans_df), nights_df
+
+
 def make_specific_chart(use_country_or_city, name, chart_type, trans_df, nights_df, per_day):
     """Make a chart for data on just one Country or City, can be bar, pie, or table"""
 
@@ -183,7 +149,7 @@ def make_category_bar(df):
     df = df[~df['Category'].str.contains("<Revalued>|<Adjustment>")]
 
     # Group by city and category and find sum of amounts
-    df = df.groupby('Category').sum('Amount').reset_index()
+    df = df.groupby('Category')['Amount'].sum().reset_index()
 
     # Sort by sum descending
     df = df.sort_values(by=['Amount'], ascending=False)
@@ -191,7 +157,7 @@ def make_category_bar(df):
     fig = px.bar(df,
                  x='Category', y=["Amount"],
                  color='Category',
-                 color_discrete_map=category_color_dict,
+                 color_discrete_map=account_tree.node_colors(df['Category']),
                  )
 
     fig.update_layout(title="Total Expenses by Category")
@@ -261,65 +227,100 @@ def make_gauge(df):
     return fig
 
 
-category_color_dict = {'Accomodation': '#3366CC', 
-                       'Food & Drink': '#DC3912',
-                       'Activities': '#FF9900',
-                       'Transportation:Plane': '#109618',
-                       'Transportation:Boat':'#0099C6',
-                       'Transportation:Bus':'#B82E2E',
-                       'Transportation:Train':'#EECA3B',
-                       'Transportation:City Transit':'#DD4477',
-                       'Untracked Cash': '#66AA00',
-                       'ATM Fees': '#990099',
-                       'Purchases': '#316395',
-                       'Misc': '#8C564B'
-                       }
+@functools.lru_cache(maxsize=2)
+def load_dashboard_data(sqlite_path, data_version):
+    """Load the rollups and the frames the charts use, once per data version"""
+
+    # Only the small rollup tables the exporter keeps are loaded
+    rollups = expense_rollups.get_rollup_data(sqlite_path)
+    nights_df = expenses_storage.read_city_nights(expenses_storage.get_connection(sqlite_path))
+
+    # Get a df for city and country totals and per day values
+    bar_dfs = {}
+    for city_or_country, rollup in [('City', 'rollup_city_category'),
+                                    ('Country', 'rollup_country_category')]:
+        for per_day in [True, False]:
+            bar_dfs[(city_or_country, per_day)] = dashboard_data.transform_rollup(
+                rollups[rollup], per_day=per_day, city_or_country=city_or_country)
+
+    return {'rollups': rollups,
+            'nights_df': nights_df,
+            'bar_dfs': bar_dfs,
+            'trip_orders': dashboard_data.trip_orders(nights_df)}
+
+
+@functools.lru_cache(maxsize=8)
+def load_currency_bar_dfs(sqlite_path, data_version, currency):
+    """Get the bar chart frames in another currency, converted from the native amounts"""
+
+    data = load_dashboard_data(sqlite_path, data_version)
+    trans_df = currency_conversion.read_expenses_in(sqlite_path, data_version, currency)
 
+    return {(city_or_country, per_day): dashboard_data.transform_data(trans_df, data['nights_df'],
+                                                                      per_day=per_day,
+                                                                      city_or_country=city_or_country)
+            for city_or_country in ['City', 'Country'] for per_day in [True, False]}
 
-def main():
 
-    # Get path of directory python file is in and make path for sqlite database
-    dir_path = os.getcwd()
-    sqlite_path = os.path.join(dir_path, 'expenses.db')
+@functools.lru_cache(maxsize=32)
+def get_bar_figure(sqlite_path, data_version, use_trip_order, use_per_day, city_or_country,
+                   currency='$'):
+    """Get the bar chart for one combination of the pickers as a serialized figure.
 
-    trans_df, nights_df = get_sqlite_data(sqlite_path)
+    Cached on the picker values and the data version, so repeat selections
+    skip plotly express entirely and an export invalidates every figure.
+    The least recently used figures are evicted past 32.
+    """
+
+    data = load_dashboard_data(sqlite_path, data_version)
+
+    # Dollars come straight from the rollups, other currencies from the native amounts
+    if currency == currency_conversion.REPORTING_CURRENCY:
+        bar_dfs = data['bar_dfs']
+    else:
+        bar_dfs = load_currency_bar_dfs(sqlite_path, data_version, currency)
+
+    fig = make_bar_graph(bar_dfs[(city_or_country, use_per_day)],
+                         data['trip_orders'][city_or_country],
+                         use_trip_order=use_trip_order,
+                         use_per_day=use_per_day,
+                         city_or_country=city_or_country,
+                         currency=currency)
+
+    return json.loads(fig.to_json())
 
-    trans_df['Amount'] = trans_df['Amount'].round(decimals=2)
 
-    # Get a df for city totals and per day values
-    city_totals_df = transform_data(trans_df, nights_df,
-                                    per_day=False, city_or_country='City')
-    city_per_day_df = transform_data(trans_df, nights_df,
-                                     per_day=True, city_or_country='City')
 
-    # Get a df for country totals and per day values
-    country_totals_df = transform_data(trans_df, nights_df,
-                                       per_day=False, city_or_country='Country')
-    country_per_day_df = transform_data(trans_df, nights_df,
-                                        per_day=True, city_or_country='Country')
+def main(sqlite_path=None):
 
+    # Default to the sqlite database in the directory the dashboard is run from
+    if sqlite_path is None:
+        sqlite_path = os.path.join(os.getcwd(), 'expenses.db')
 
-    # Get list of cities in trip order
-    cities_trip_order = nights_df['City'].to_list()
-    cities_trip_order = [i for i in cities_trip_order if i is not None]
-    cities_trip_order.remove('International')
+    # Load the data and warm the figure cache with every combination of the pickers
+    data_version = expenses_storage.get_data_version(sqlite_path)
+    data = load_dashboard_data(sqlite_path, data_version)
+    rollups = data['rollups']
+    nights_df = data['nights_df']
 
-    # Get list of countries in trip order
-    country_trip_order = nights_df['Country'].to_list()
-    country_trip_order = [i for i in country_trip_order if i is not None]
+    for use_trip_order, use_per_day, city_or_country in itertools.product([True, False], [True, False],
+                                                                         ['City', 'Country']):
+        get_bar_figure(sqlite_path, data_version, use_trip_order, use_per_day, city_or_country)
 
-    bar_fig = make_bar_graph(city_per_day_df, cities_trip_order,
-                             use_trip_order=True, use_per_day=True,
-                             city_or_country='City')
+    bar_fig = get_bar_figure(sqlite_path, data_version, True, True, 'City')
 
+    # Only the one city's category totals are read for the pie chart
+    spec_trans_df, spec_nights_df = get_specific_data(sqlite_path, 'City', 'Da Lat')
     spec_chart = make_specific_chart('City', 'Da Lat', 'pie',
-                                     trans_df, nights_df, per_day=True)
+                                     spec_trans_df, spec_nights_df, per_day=True)
 
-    total_chart = make_total_graphs('Country', country_totals_df)
+    total_chart = make_total_graphs('Country', data['bar_dfs'][('Country', False)])
 
-    cat_bar_fig = make_category_bar(trans_df)
+    cat_bar_fig = make_category_bar(rollups['rollup_category'])
 
-    gauge_chart = make_gauge(trans_df)
+    gauge_chart = make_gauge(rollups['rollup_daily'][['Date', 'Amount']])
+
+    currencies = currency_conversion.get_currencies(sqlite_path, data_version)
 
     # Dash app ############################################
 
@@ -366,6 +367,14 @@ def main():
                                   'border': '2px solid black',
                                   'padding': '8px',
                                   'margin': '8px'}),
+
+            dcc.Dropdown(options=currencies, value=currencies[0], id='currency-picker',
+                         clearable=False,
+                         style={'display': 'inline-block',
+                                'text-align': 'left',
+                                'width': '180px',
+                                'margin': '8px',
+                                'vertical-align': 'middle'}),
                                   
         ]),
         
@@ -401,11 +410,12 @@ def main():
         Output(component_id='bar_fig', component_property='figure'),
         [Input(component_id='order-picker', component_property='value'),
          Input(component_id='per-day-picker', component_property='value'),
-         Input(component_id='city-country-picker', component_property='value')]
+         Input(component_id='city-country-picker', component_property='value'),
+         Input(component_id='currency-picker', component_property='value')]
         
     )
     # Set how to update the graph
-    def update_graph(order_chosen, total_chosen, location_chosen):
+    def update_graph(order_chosen, total_chosen, location_chosen, currency_chosen):
         if order_chosen == 'Trip Order':
             chosen_trip_order = True
         else:
@@ -414,31 +424,16 @@ def main():
             per_day = True
         else:
             per_day = False
-        if location_chosen == 'City':
-            order = cities_trip_order
-            if per_day:
-                df_to_use = city_per_day_df
-            else:
-                df_to_use = city_totals_df
-        else:
-            order = country_trip_order
-            if per_day:
-                df_to_use = country_per_day_df
-            else:
-                df_to_use = country_totals_df
-
-        bar_fig = make_bar_graph(df_to_use,
-                                 order,
-                                 use_trip_order=chosen_trip_order,
-                                 use_per_day=per_day,
-                                 city_or_country=location_chosen)
+
+        # Figures are only rebuilt for a combination not seen since the last export
+        data_version = expenses_storage.get_data_version(sqlite_path)
+        bar_fig = get_bar_figure(sqlite_path, data_version,
+                                 chosen_trip_order, per_day, location_chosen, currency_chosen)
 
         return bar_fig
 
     app.run()
 
 
-main()
-
 if __name__ == "__main__":
     main()
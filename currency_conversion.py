@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+import functools
+
+import expense_queries
+import expenses_storage
+
+
+# What the exporter values Amount in, like ledger -X $
+REPORTING_CURRENCY = '$'
+
+
+def make_rate_table(prices_df, pivot=REPORTING_CURRENCY):
+    """Get the price of every commodity in the pivot currency, sorted by date for as-of joins.
+
+    Prices quoted the other way round, like P 2023/06/01 $ 23500 VND, are
+    inverted so they count too. Prices on the same date keep journal order,
+    so the last one wins.
+    """
+
+    direct = prices_df.loc[prices_df['PriceCommodity'] == pivot, ['Date', 'Commodity', 'Price']]
+
+    inverse = prices_df.loc[prices_df['Commodity'] == pivot, ['Date', 'PriceCommodity', 'Price']]
+    inverse = inverse.rename(columns={'PriceCommodity': 'Commodity'})
+    inverse['Price'] = 1 / inverse['Price']
+
+    rates = pd.concat([direct, inverse], ignore_index=True)
+    rates['Date'] = pd.to_datetime(rates['Date'])
+
+    return rates.sort_values('Date', kind='stable').reset_index(drop=True)
+
+
+def rates_as_of(dates, commodities, rates, pivot=REPORTING_CURRENCY):
+    """Look up the latest price in pivot of each commodity on or before each date.
+
+    Returns an array lined up with dates, 1 for the pivot itself and NaN
+    where there is no price yet.
+    """
+
+    lookups = pd.DataFrame({'Date': pd.to_datetime(np.asarray(dates)),
+                            'Commodity': np.asarray(commodities),
+                            'Row': np.arange(len(dates))})
+
+    rates = rates.astype({'Date': lookups['Date'].dtype, 'Commodity': lookups['Commodity'].dtype})
+
+    # One as-of join for every row at once, then back into the original order
+    merged = pd.merge_asof(lookups.sort_values('Date', kind='stable'), rates,
+                           on='Date', by='Commodity', direction='backward')
+    rate = merged.sort_values('Row')['Price'].to_numpy(dtype=float, copy=True)
+
+    rate[lookups['Commodity'].to_numpy() == pivot] = 1.0
+
+    return rate
+
+
+def convert_amounts(amounts, commodities, dates, rates, target, pivot=REPORTING_CURRENCY):
+    """Convert amounts from their commodities into target as of their dates.
+
+    Amounts are converted through the pivot the rate table is priced in,
+    so any two commodities priced in it convert to each other. Amounts
+    without a price to convert them are NaN, so they are never summed with
+    converted ones. Returns a series lined up with amounts.
+    """
+
+    amounts = pd.Series(amounts).reset_index(drop=True).astype(float)
+    commodities = pd.Series(commodities).reset_index(drop=True)
+
+    to_pivot = rates_as_of(dates, commodities, rates, pivot)
+    target_to_pivot = rates_as_of(dates, [target] * len(amounts), rates, pivot)
+
+    converted = amounts * to_pivot / target_to_pivot
+    converted[commodities.to_numpy() == target] = amounts
+
+    return converted
+
+
+@functools.lru_cache(maxsize=2)
+def load_rate_table(database_name, data_version):
+    """Read the stored prices into a rate table, once per data version"""
+
+    prices_df = pd.read_sql_query('SELECT "Date", "Commodity", "Price", "PriceCommodity" FROM ledger_prices',
+                                  expenses_storage.get_connection(database_name), parse_dates=['Date'])
+
+    return make_rate_table(prices_df)
+
+
+def get_currencies(database_name, data_version):
+    """List the currencies expenses can be converted to, the reporting currency first"""
+
+    rates = load_rate_table(database_name, data_version)
+
+    return [REPORTING_CURRENCY] + sorted(set(rates['Commodity']) - {REPORTING_CURRENCY})
+
+
+@functools.lru_cache(maxsize=8)
+def read_expenses_in(database_name, data_version, currency):
+    """Read the expenses with Amount converted to currency, cached per data version and currency.
+
+    Only what the bar charts group by is read, with the real expenses of
+    each day, commodity, place and category summed in the database so every
+    sum still converts at its own day's rate. The dollar amounts stored by
+    the exporter are used as they are, and converted for the rows without a
+    native amount that the ledger csv backend writes. Rows with no price to
+    convert them are left out. Amounts stay in hundredths of their currency
+    like in storage. The returned df is shared, copy it before changing it.
+    """
+
+    df = expense_queries.query_expenses(database_name,
+                                        group_by=['Date', 'Commodity', 'Country', 'City', 'Category'],
+                                        aggregates={'Amount': ('sum', 'Amount'),
+                                                    'NativeAmount': ('sum', 'NativeAmount')})
+    if currency == REPORTING_CURRENCY:
+        return df
+
+    # Rows without a native amount only have their dollar value
+    no_native = df['NativeAmount'].isna()
+    amounts = df['NativeAmount'].where(~no_native, expenses_storage.from_minor_units(df['Amount']))
+    commodities = df['Commodity'].astype(object).where(~no_native, REPORTING_CURRENCY)
+
+    converted = convert_amounts(amounts, commodities, df['Date'],
+                                load_rate_table(database_name, data_version), currency).set_axis(df.index)
+
+    df = df[converted.notna()].copy()
+    df['Amount'] = expenses_storage.to_minor_units(converted.dropna())
+
+    return df
@@ -0,0 +1,76 @@
+import pandas as pd
+
+import account_tree
+import expense_queries
+import expenses_storage
+
+
+def get_sqlite_data(database_name, columns=None, filters=None):
+    # Get this thread's connection
+    cnx = expenses_storage.get_connection(database_name)
+
+    # Read the data into dfs, only the columns and rows needed
+    trans_df = expense_queries.query_expenses(database_name, columns, filters, real_expenses=False)
+    nights_df = expenses_storage.read_city_nights(cnx)
+
+    return trans_df, nights_df
+
+
+def transform_data(trans_df, nights_df, per_day, city_or_country):
+    # Filter out revalued and adjustment transactions
+    trans_df = trans_df[~trans_df['Category'].str.contains("<Revalued>|<Adjustment>")]
+
+    # Group by city and category on their category codes and sum the integer amounts
+    aggregated = trans_df.groupby([city_or_country, 'Category'], observed=True) \
+                         .agg({'Amount': ['sum']}) \
+                         .reset_index()
+    aggregated.columns = [city_or_country, 'Category', 'Amount']
+
+    # The few aggregated rows go back to plain names and dollars for the charts
+    aggregated[[city_or_country, 'Category']] = aggregated[[city_or_country, 'Category']].astype(object)
+    aggregated['Amount'] = expenses_storage.from_minor_units(aggregated['Amount'])
+
+    # If making per day graph, divide all amounts by days in that city
+    if per_day:
+        # Create a column of nights spent
+        aggregated = pd.merge(aggregated, nights_df, on=city_or_country, how='left')
+
+        # Divide the amount column by the nights column
+        aggregated['Amount'] = aggregated['Amount']/aggregated['Nights']
+
+        # Round again
+        aggregated['Amount'] = aggregated['Amount'].round(decimals=2)
+
+    return sort_categories(aggregated)
+
+
+def transform_rollup(rollup_df, per_day, city_or_country):
+    """Get the same df as transform_data from a precomputed rollup table"""
+
+    aggregated = rollup_df[[city_or_country, 'Category']].copy()
+
+    # The rollup already has the per day amounts divided by the nights
+    aggregated['Amount'] = rollup_df['PerDay'] if per_day else rollup_df['Amount']
+
+    return sort_categories(aggregated)
+
+
+def sort_categories(aggregated):
+    """Sort the rows by their category's place in the account tree"""
+
+    return aggregated.sort_values(by='Category', key=account_tree.order_key, kind='stable')
+
+
+def trip_orders(nights_df):
+    """List the cities and the countries in the order the trip visited them"""
+
+    # Get list of cities in trip order
+    cities_trip_order = nights_df['City'].to_list()
+    cities_trip_order = [i for i in cities_trip_order if i is not None]
+    cities_trip_order.remove('International')
+
+    # Get list of countries in trip order
+    country_trip_order = nights_df['Country'].to_list()
+    country_trip_order = [i for i in country_trip_order if i is not None]
+
+    return {'City': cities_trip_order, 'Country': country_trip_order}
@@ -0,0 +1,205 @@
+import pandas as pd
+
+import os
+
+import expense_rollups
+import expenses_storage
+
+
+# Filter operators, the same ones parquet_archive pushes down to parquet
+FILTER_OPERATORS = {'==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+                    'in': 'IN', 'not in': 'NOT IN'}
+
+AGGREGATES = {'sum': 'SUM', 'count': 'COUNT', 'min': 'MIN', 'max': 'MAX', 'mean': 'AVG'}
+
+ENGINES = ['sqlite', 'duckdb']
+
+# One DuckDB connection per database per process, like expenses_storage.connection_pool
+duckdb_pool = {}
+
+
+def table_columns(connection, table):
+    """List the columns a table has, the only names a query may use"""
+
+    return [r[1] for r in connection.execute(f'PRAGMA table_info({table})')]
+
+
+def quote_column(column, columns):
+    """Quote a column for sql, refusing names the table doesn't have since they can't be bound"""
+
+    if column not in columns:
+        raise ValueError(f'Unknown column {column!r}, expected one of {columns}')
+
+    return f'"{column}"'
+
+
+def quote_value(column, columns):
+    """Quote a column for comparing or summing, decimal text is read as a number"""
+
+    quoted = quote_column(column, columns)
+    if column in expenses_storage.DECIMAL_COLUMNS:
+        return f'CAST({quoted} AS DOUBLE)'
+
+    return quoted
+
+
+def compile_filter(column, op, value, columns):
+    """Compile one (column, op, value) filter into a condition and its parameters.
+
+    None compares as sql NULL, so ('City', '==', None) finds the rows
+    without a city.
+    """
+
+    if op not in FILTER_OPERATORS:
+        raise ValueError(f'Unknown filter operator {op!r}, expected one of {list(FILTER_OPERATORS)}')
+
+    quoted = quote_value(column, columns)
+    if column == 'Date' and value is not None and op not in ('in', 'not in'):
+        value = pd.Timestamp(value)
+
+    if op in ('in', 'not in'):
+        values = list(value)
+        if not values:
+            # Nothing is in an empty list
+            return ('0' if op == 'in' else '1'), []
+        placeholders = ', '.join('?' * len(values))
+        return f'{quoted} {FILTER_OPERATORS[op]} ({placeholders})', values
+
+    if value is None and op in ('==', '!='):
+        return f'{quoted} IS {"NOT " if op == "!=" else ""}NULL', []
+
+    return f'{quoted} {FILTER_OPERATORS[op]} ?', [value]
+
+
+def compile_query(table, columns, select=None, filters=None, group_by=None, aggregates=None,
+                  where=(), order_by=None):
+    """Compile a query on table into parameterized sql, returning the sql and its parameters.
+
+    columns are the table's columns, every name in the query is checked
+    against them and every value is bound as a parameter. select picks the
+    columns of plain rows, all of them by default. filters are
+    (column, op, value) tuples like parquet_archive's, all of which must
+    hold. group_by with aggregates, a dict of output column to
+    (function, column) like {'Amount': ('sum', 'Amount')}, sums or counts
+    the rows of each group instead. where adds trusted sql conditions.
+    """
+
+    grouped = group_by is not None or aggregates is not None
+    if grouped and select is not None:
+        raise ValueError('Give either select for plain rows or group_by with aggregates')
+
+    if not grouped:
+        selected = [quote_column(c, columns) for c in (select or columns)]
+    else:
+        group_by = list(group_by or [])
+        selected = [quote_column(c, columns) for c in group_by]
+        for output, (function, column) in (aggregates or {}).items():
+            if function not in AGGREGATES:
+                raise ValueError(f'Unknown aggregate {function!r}, expected one of {list(AGGREGATES)}')
+            quoted = quote_column(column, columns) if function == 'count' else quote_value(column, columns)
+            selected.append(f'{AGGREGATES[function]}({quoted}) AS "{output}"')
+
+    conditions = list(where)
+    params = []
+    for column, op, value in filters or []:
+        condition, values = compile_filter(column, op, value, columns)
+        conditions.append(condition)
+        params += values
+
+    sql = f'SELECT {", ".join(selected)} FROM {table}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(f'({c})' for c in conditions)
+    if group_by:
+        sql += ' GROUP BY ' + ', '.join(quote_column(c, columns) for c in group_by)
+    if order_by:
+        sql += ' ORDER BY ' + ', '.join(quote_column(c, columns) for c in order_by)
+
+    return sql, params
+
+
+def sqlite_params(params):
+    """Bind dates the way the exporter stores them, as text sqlite compares in order"""
+
+    return [p.strftime('%Y-%m-%d %H:%M:%S') if isinstance(p, pd.Timestamp) else p for p in params]
+
+
+def get_duckdb_connection(database_name):
+    """Get this process's DuckDB connection reading the sqlite database through its sqlite extension.
+
+    DuckDB is optional, it is only imported when a query asks for it.
+    """
+
+    import duckdb
+
+    key = (os.getpid(), os.path.abspath(database_name))
+    if key not in duckdb_pool:
+        connection = duckdb.connect()
+        path = os.path.abspath(database_name).replace("'", "''")
+        connection.execute(f"ATTACH '{path}' AS expenses (TYPE sqlite, READ_ONLY)")
+        connection.execute('USE expenses')
+        duckdb_pool[key] = connection
+
+    return duckdb_pool[key]
+
+
+def run_query(database_name, sql, params, engine='sqlite'):
+    """Run compiled sql on the database with sqlite or DuckDB, returning a df"""
+
+    # Opening the sqlite connection also brings the schema up to date for DuckDB
+    connection = expenses_storage.get_connection(database_name)
+
+    if engine == 'sqlite':
+        return pd.read_sql_query(sql, connection, params=sqlite_params(params))
+    if engine == 'duckdb':
+        params = [p.to_pydatetime() if isinstance(p, pd.Timestamp) else p for p in params]
+        return get_duckdb_connection(database_name).execute(sql, params).df()
+
+    raise ValueError(f'Unknown engine {engine!r}, expected one of {ENGINES}')
+
+
+def query_expenses(database_name, columns=None, filters=None, start=None, end=None, group_by=None,
+                   aggregates=None, real_expenses=True, engine='sqlite'):
+    """Read only the transactions and columns a chart needs, filtered and summed in the database.
+
+    columns picks the columns of plain rows, or give group_by to get one
+    row per group with aggregates, the Amount summed by default. filters
+    are (column, op, value) tuples like [('City', '==', 'Da Lat')], start
+    and end bound the Date with end left out. Revaluations and adjustments
+    are dropped unless real_expenses is False. Rows come back in the
+    compact schema of expenses_storage, summed amounts in hundredths too.
+    engine 'duckdb' runs the same sql in DuckDB over the same file.
+    """
+
+    connection = expenses_storage.get_connection(database_name)
+    names = [c for c in table_columns(connection, 'ledger_expenses') if c != 'Id']
+
+    filters = list(filters or [])
+    if start is not None:
+        filters.append(('Date', '>=', start))
+    if end is not None:
+        filters.append(('Date', '<', end))
+
+    grouped = group_by is not None or aggregates is not None
+    if not grouped and columns is None:
+        columns = names
+    if grouped and aggregates is None:
+        aggregates = {'Amount': ('sum', 'Amount')}
+
+    sql, params = compile_query('ledger_expenses', names + ['Id'], select=columns,
+                                filters=filters, group_by=group_by, aggregates=aggregates,
+                                where=[expense_rollups.REAL_EXPENSES] if real_expenses else [],
+                                order_by=None if grouped else ['Id'])
+
+    return expenses_storage.set_expenses_dtypes(run_query(database_name, sql, params, engine))
+
+
+def query_nights(database_name, city_or_country, filters=None, engine='sqlite'):
+    """Sum the nights of each city or country over every trip, only those the filters keep"""
+
+    connection = expenses_storage.get_connection(database_name)
+
+    sql, params = compile_query('city_nights', table_columns(connection, 'city_nights'),
+                                filters=[(city_or_country, '!=', None)] + list(filters or []),
+                                group_by=[city_or_country], aggregates={'Nights': ('sum', 'Nights')})
+
+    return run_query(database_name, sql, params, engine)
@@ -0,0 +1,86 @@
+import pandas as pd
+
+import expenses_storage
+
+
+# Revaluations and adjustments aren't real spending, the daily running
+# total keeps them like the gauge always has
+REAL_EXPENSES = """"Category" NOT LIKE '%<Revalued>%' AND "Category" NOT LIKE '%<Adjustment>%'"""
+
+# Nights in each city or country summed over every trip exported
+NIGHTS_BY = """
+    SELECT "{0}", SUM("Nights") AS "Nights" FROM city_nights
+    WHERE "{0}" IS NOT NULL GROUP BY "{0}"
+    """
+
+# Amounts are stored in integer hundredths, so sums are exact and only
+# turned back into dollars at the end
+DOLLARS = f'SUM(e."Amount") / {expenses_storage.AMOUNT_SCALE}.0'
+
+ROLLUP_QUERIES = {
+    'rollup_city_category': f"""
+        SELECT e."City", e."Category",
+               {DOLLARS} AS "Amount",
+               MAX(n."Nights") AS "Nights",
+               ROUND({DOLLARS} / MAX(n."Nights"), 2) AS "PerDay"
+        FROM ledger_expenses e LEFT JOIN ({NIGHTS_BY.format('City')}) n ON n."City" = e."City"
+        WHERE e."City" IS NOT NULL AND {REAL_EXPENSES}
+        GROUP BY e."City", e."Category"
+        """,
+
+    'rollup_country_category': f"""
+        SELECT e."Country", e."Category",
+               {DOLLARS} AS "Amount",
+               MAX(n."Nights") AS "Nights",
+               ROUND({DOLLARS} / MAX(n."Nights"), 2) AS "PerDay"
+        FROM ledger_expenses e LEFT JOIN ({NIGHTS_BY.format('Country')}) n ON n."Country" = e."Country"
+        WHERE e."Country" IS NOT NULL AND {REAL_EXPENSES}
+        GROUP BY e."Country", e."Category"
+        """,
+
+    'rollup_category': f"""
+        SELECT e."Category", {DOLLARS} AS "Amount"
+        FROM ledger_expenses e
+        WHERE {REAL_EXPENSES}
+        GROUP BY e."Category"
+        """,
+
+    'rollup_daily': f"""
+        SELECT date(e."Date") AS "Date",
+               {DOLLARS} AS "Amount",
+               SUM({DOLLARS}) OVER (ORDER BY date(e."Date")) AS "RunningTotal"
+        FROM ledger_expenses e
+        GROUP BY date(e."Date")
+        """,
+}
+
+
+def refresh_rollups(sqliteConnection):
+    """Rebuild the rollup tables from ledger_expenses and city_nights.
+
+    Runs inside the transaction the base tables were written in, so the
+    rollups are committed with them.
+    """
+
+    for table, query in ROLLUP_QUERIES.items():
+        sqliteConnection.execute(f'DROP TABLE IF EXISTS {table}')
+        sqliteConnection.execute(f'CREATE TABLE {table} AS {query}')
+
+
+def get_rollup_data(database_name):
+    """Read all the rollup tables into a dict of dfs"""
+
+    cnx = expenses_storage.get_connection(database_name)
+
+    # Databases exported before the rollups existed get them built once
+    tables = {r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not set(ROLLUP_QUERIES) <= tables:
+        with expenses_storage.transaction(cnx):
+            refresh_rollups(cnx)
+
+    rollups = {table: pd.read_sql_query(f'SELECT * FROM {table}', cnx)
+               for table in ROLLUP_QUERIES}
+
+    rollups['rollup_daily']['Date'] = pd.to_datetime(rollups['rollup_daily']['Date'])
+
+    return rollups
@@ -0,0 +1,441 @@
+import numpy as np
+import pandas as pd
+
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Columns every transaction has, tags found in the journal are added as TEXT columns.
+# Amount is in dollars, NativeAmount in the Commodity it was paid in, and
+# Trip is the name of the journal the transaction came from
+EXPENSES_COLUMNS = ['Date', 'Payee', 'Category', 'Amount', 'NativeAmount', 'Commodity',
+                    'Note', 'Country', 'City', 'Trip']
+
+# Dollar amounts are kept as integer cents, so sums are exact
+AMOUNT_COLUMNS = ['Amount']
+AMOUNT_SCALE = 100
+
+# Amounts in any commodity, which can have more decimals than cents like
+# fuel prices or BTC. Stored as exact decimal text and read as floats
+DECIMAL_COLUMNS = ['NativeAmount']
+
+# Columns with few distinct values, kept as categoricals in memory and
+# dictionary encoded in parquet
+CATEGORICAL_COLUMNS = ['Payee', 'Category', 'Commodity', 'Country', 'City', 'Trip']
+
+# Bumped when stored values change meaning, 1 is amounts in hundredths and
+# 2 native amounts as decimal text
+SCHEMA_VERSION = 2
+
+# Columns added to tables after they were first created
+ADDED_COLUMNS = {'ledger_expenses': {'Trip': 'TEXT', 'NativeAmount': 'TEXT', 'Commodity': 'TEXT'},
+                 'ledger_prices': {'Trip': 'TEXT'},
+                 'city_nights': {'Trip': 'TEXT'}}
+
+EXPENSES_TABLE = """
+CREATE TABLE IF NOT EXISTS ledger_expenses (
+    "Id" INTEGER PRIMARY KEY,
+    "Date" TIMESTAMP NOT NULL,
+    "Payee" TEXT,
+    "Category" TEXT NOT NULL,
+    "Amount" INTEGER NOT NULL,
+    "NativeAmount" TEXT,
+    "Commodity" TEXT,
+    "Note" TEXT,
+    "Country" TEXT,
+    "City" TEXT,
+    "Trip" TEXT
+)"""
+
+SCHEMA = EXPENSES_TABLE + """;
+CREATE INDEX IF NOT EXISTS ledger_expenses_date ON ledger_expenses ("Date");
+CREATE INDEX IF NOT EXISTS ledger_expenses_city ON ledger_expenses ("City", "Category");
+CREATE INDEX IF NOT EXISTS ledger_expenses_country ON ledger_expenses ("Country", "Category");
+CREATE INDEX IF NOT EXISTS ledger_expenses_category ON ledger_expenses ("Category");
+CREATE INDEX IF NOT EXISTS ledger_expenses_trip ON ledger_expenses ("Trip", "Id");
+
+CREATE TABLE IF NOT EXISTS city_nights (
+    "Order" INTEGER NOT NULL,
+    "City" TEXT,
+    "Nights" INTEGER NOT NULL,
+    "Country" TEXT,
+    "Trip" TEXT
+);
+CREATE INDEX IF NOT EXISTS city_nights_city ON city_nights ("City");
+CREATE INDEX IF NOT EXISTS city_nights_country ON city_nights ("Country");
+
+CREATE TABLE IF NOT EXISTS ledger_prices (
+    "Date" TIMESTAMP NOT NULL,
+    "Commodity" TEXT NOT NULL,
+    "Price" REAL NOT NULL,
+    "PriceCommodity" TEXT NOT NULL,
+    "Offset" INTEGER NOT NULL,
+    "Trip" TEXT
+);
+CREATE INDEX IF NOT EXISTS ledger_prices_commodity ON ledger_prices ("Commodity", "Date");
+CREATE INDEX IF NOT EXISTS ledger_prices_trip ON ledger_prices ("Trip", "Offset");
+
+CREATE TABLE IF NOT EXISTS ledger_sync (
+    "Journal" TEXT PRIMARY KEY,
+    "Size" INTEGER NOT NULL,
+    "Hash" TEXT NOT NULL,
+    "LastOffset" INTEGER NOT NULL,
+    "LastRowid" INTEGER NOT NULL,
+    "LastDate" TEXT NOT NULL,
+    "Includes" TEXT NOT NULL,
+    "TomlHash" TEXT
+);
+
+CREATE TABLE IF NOT EXISTS import_fingerprints (
+    "Fingerprint" TEXT PRIMARY KEY,
+    "Source" TEXT
+) WITHOUT ROWID;
+"""
+
+PRAGMAS = {'journal_mode': 'WAL',         # Readers don't block the exporter
+           'synchronous': 'NORMAL',       # Safe with WAL, far fewer fsyncs
+           'temp_store': 'MEMORY',
+           'cache_size': -64000,          # 64MB page cache
+           'mmap_size': 268435456,
+           'busy_timeout': 5000}
+
+# Set by a streaming export for its run, so the pages it maps and the
+# sorts of the rollups don't grow memory with the size of the table
+STREAM_PRAGMAS = {'mmap_size': 0,
+                  'temp_store': 'FILE'}
+
+# One connection per database per thread, so a thread's writes never land
+# in a transaction another thread has open on a shared connection
+connection_pool = {}
+_pool_lock = threading.Lock()
+
+# How deep each thread is in transaction() on each of its connections
+_local = threading.local()
+
+
+def get_connection(database_name='expenses.db'):
+    """Get this thread's connection to the database, creating the schema if needed.
+
+    The connection is in autocommit mode, wrap writes in transaction(). The
+    Dash server and the export pipeline run on several threads, each gets
+    a connection of its own and sqlite takes their writes in turn.
+    """
+
+    key = (os.getpid(), threading.get_ident(), os.path.abspath(database_name))
+    if key not in connection_pool:
+        # The first connections of two threads would both run the migrations
+        with _pool_lock:
+            connection = sqlite3.connect(database_name, isolation_level=None)
+            for pragma, value in PRAGMAS.items():
+                connection.execute(f'PRAGMA {pragma} = {value}')
+
+            migrate_legacy_tables(connection)
+            migrate_added_columns(connection)
+            migrate_amount_units(connection)
+            connection.executescript(SCHEMA)
+            connection_pool[key] = connection
+
+    return connection_pool[key]
+
+
+def close_connection(database_name='expenses.db'):
+    """Close this thread's connection, for threads that end long before the process does.
+
+    Each rerun of the Streamlit app runs on a thread of its own, their
+    connections would otherwise stay open in the pool.
+    """
+
+    key = (os.getpid(), threading.get_ident(), os.path.abspath(database_name))
+    connection = connection_pool.pop(key, None)
+    if connection is not None:
+        connection.close()
+
+
+def migrate_legacy_tables(connection):
+    """Move a ledger_expenses table written by df.to_sql into the typed schema"""
+
+    columns = [r[1] for r in connection.execute('PRAGMA table_info(ledger_expenses)')]
+    if not columns or 'Id' in columns:
+        return
+
+    with transaction(connection):
+        connection.execute('ALTER TABLE ledger_expenses RENAME TO ledger_expenses_legacy')
+        connection.execute(EXPENSES_TABLE)
+
+        # Keep any tag columns the old table had
+        for column in columns:
+            if column not in EXPENSES_COLUMNS:
+                connection.execute(f'ALTER TABLE ledger_expenses ADD COLUMN "{column}" TEXT')
+
+        quoted = ', '.join(f'"{c}"' for c in columns)
+        connection.execute(f'INSERT INTO ledger_expenses ({quoted}) '
+                           f'SELECT {quoted} FROM ledger_expenses_legacy')
+        connection.execute('DROP TABLE ledger_expenses_legacy')
+
+        # Rowids changed, so the incremental sync has to start over
+        connection.execute('DROP TABLE IF EXISTS ledger_sync')
+
+
+def migrate_added_columns(connection):
+    """Add the ADDED_COLUMNS to tables created before them.
+
+    Their rows are left empty in the new columns and the sync state is
+    dropped, the next export rebuilds every journal and replaces them.
+    """
+
+    with transaction(connection):
+        for table, added in ADDED_COLUMNS.items():
+            columns = [r[1] for r in connection.execute(f'PRAGMA table_info({table})')]
+            for column, column_type in added.items():
+                if columns and column not in columns:
+                    connection.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" {column_type}')
+                    connection.execute('DROP TABLE IF EXISTS ledger_sync')
+
+
+def migrate_amount_units(connection):
+    """Move amounts into the units of SCHEMA_VERSION 2.
+
+    Databases from before it have their ledger_expenses table rebuilt with
+    Amount in INTEGER cents and NativeAmount as decimal text, keeping every
+    row and its Id so the incremental sync carries on where it was.
+    Version 1 databases kept native amounts in hundredths, which lost the
+    decimals of commodities with more than two, so their sync state is
+    dropped and the next export reads every journal again.
+    """
+
+    if connection.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    with transaction(connection):
+        # Read again now the write lock is held, another process may have migrated first
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        columns = [r[1] for r in connection.execute('PRAGMA table_info(ledger_expenses)')]
+
+        if columns:
+            connection.execute('ALTER TABLE ledger_expenses RENAME TO ledger_expenses_old')
+            connection.execute(EXPENSES_TABLE)
+
+            # Keep any tag columns the old table had
+            for column in columns:
+                if column not in EXPENSES_COLUMNS + ['Id']:
+                    connection.execute(f'ALTER TABLE ledger_expenses ADD COLUMN "{column}" TEXT')
+
+            copied = [c for c in columns if c not in DECIMAL_COLUMNS]
+            quoted = ', '.join(f'"{c}"' for c in copied)
+            selected = ', '.join(f'CAST(ROUND("{c}" * {AMOUNT_SCALE}) AS INTEGER)'
+                                 if c in AMOUNT_COLUMNS and version < 1 else f'"{c}"' for c in copied)
+            connection.execute(f'INSERT INTO ledger_expenses ({quoted}) '
+                               f'SELECT {selected} FROM ledger_expenses_old')
+
+            # Decimal text is written in python, sqlite would cut it to 15 digits
+            if 'NativeAmount' in columns:
+                native = pd.read_sql_query('SELECT "Id", "NativeAmount" FROM ledger_expenses_old '
+                                           'WHERE "NativeAmount" IS NOT NULL', connection)
+                amounts = pd.to_numeric(native['NativeAmount'])
+                if version >= 1:
+                    amounts = amounts / AMOUNT_SCALE
+                connection.executemany('UPDATE ledger_expenses SET "NativeAmount" = ? WHERE "Id" = ?',
+                                       zip(to_decimal_text(amounts), native['Id'].tolist()))
+
+            connection.execute('DROP TABLE ledger_expenses_old')
+            if version >= 1:
+                connection.execute('DROP TABLE IF EXISTS ledger_sync')
+
+        connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+@contextmanager
+def transaction(connection):
+    """Run the block in one transaction, rolled back if it raises.
+
+    Nested blocks on the same thread join the outermost one, which commits
+    for them. The nesting is counted per thread, a transaction left open on
+    the connection by anything else is an error rather than joined.
+    """
+
+    if not hasattr(_local, 'depths'):
+        _local.depths = {}
+    depth = _local.depths.get(id(connection), 0)
+
+    if depth == 0 and connection.in_transaction:
+        raise RuntimeError('The connection is already in a transaction this thread did not open')
+
+    _local.depths[id(connection)] = depth + 1
+    try:
+        if depth:
+            # Already inside an outer transaction, it commits for us
+            yield connection
+            return
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        _local.depths[id(connection)] = depth
+
+
+def to_sqlite_values(df):
+    """Turn a df into row tuples sqlite can bind, dates as text and missing values as None"""
+
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+        elif column in DECIMAL_COLUMNS:
+            df[column] = to_decimal_text(df[column])
+        elif isinstance(df[column].dtype, pd.ArrowDtype) and pd.api.types.is_numeric_dtype(df[column].dtype):
+            # sqlite can't store decimals
+            df[column] = df[column].astype(float)
+
+    df = df.astype(object).where(df.notna(), None)
+
+    return list(df.itertuples(index=False, name=None))
+
+
+def insert_rows(connection, table, df):
+    """Bulk insert a df in one transaction, adding columns for any tags the table doesn't have"""
+
+    existing = {r[1] for r in connection.execute(f'PRAGMA table_info({table})')}
+
+    with transaction(connection):
+        for column in df.columns:
+            if column not in existing:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" TEXT')
+
+        columns = ', '.join(f'"{c}"' for c in df.columns)
+        placeholders = ', '.join('?' * len(df.columns))
+        connection.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})',
+                               to_sqlite_values(df))
+
+
+def replace_rows(connection, table, df):
+    """Replace all the rows of a table with a df, keeping its schema and indexes"""
+
+    with transaction(connection):
+        connection.execute(f'DELETE FROM {table}')
+        insert_rows(connection, table, df)
+
+
+def get_data_version(database_name='expenses.db'):
+    """Get a value that changes whenever the exporter writes new data"""
+
+    connection = get_connection(database_name)
+    hashes = connection.execute("""SELECT group_concat("Hash" || COALESCE("TomlHash", ''))
+                                   FROM (SELECT * FROM ledger_sync ORDER BY "Journal")""").fetchone()[0]
+    if hashes:
+        return hashlib.sha1(hashes.encode()).hexdigest()
+
+    # Never synced, fall back to when the database files last changed
+    return str(max(os.path.getmtime(path) for path in [database_name, database_name + '-wal']
+                   if os.path.exists(path)))
+
+
+def read_city_nights(connection):
+    """Read the nights spent in each city and country, summed over every trip in trip order"""
+
+    return pd.read_sql_query("""SELECT ROW_NUMBER() OVER (ORDER BY MIN(rowid)) - 1 AS "Order",
+                                       "City", SUM("Nights") AS "Nights", "Country"
+                                FROM city_nights
+                                GROUP BY "City", "Country"
+                                ORDER BY MIN(rowid)""", connection)
+
+
+def read_expenses(connection, columns=None):
+    """Read ledger_expenses into a df in the compact schema, without the Id key"""
+
+    if columns is None:
+        columns = [r[1] for r in connection.execute('PRAGMA table_info(ledger_expenses)')
+                   if r[1] != 'Id']
+
+    quoted = ', '.join(f'"{c}"' for c in columns)
+    parse_dates = ['Date'] if 'Date' in columns else None
+
+    df = pd.read_sql_query(f'SELECT {quoted} FROM ledger_expenses', connection,
+                           parse_dates=parse_dates)
+
+    return set_expenses_dtypes(df)
+
+
+def iter_expenses(connection, batch_rows, trip=None):
+    """Read ledger_expenses in dfs of up to batch_rows rows like read_expenses, only trip's rows if given.
+
+    Rows come in the order they were written and only one batch is held at
+    a time. Each batch has its own categories.
+    """
+
+    columns = [r[1] for r in connection.execute('PRAGMA table_info(ledger_expenses)') if r[1] != 'Id']
+    quoted = ', '.join(f'"{c}"' for c in columns)
+    where, params = ('WHERE "Trip" = ?', (trip,)) if trip is not None else ('', ())
+
+    for df in pd.read_sql_query(f'SELECT {quoted} FROM ledger_expenses {where} ORDER BY "Id"', connection,
+                                params=params, parse_dates=['Date'], chunksize=batch_rows):
+        yield set_expenses_dtypes(df)
+
+
+def to_minor_units(amounts, scale=AMOUNT_SCALE):
+    """Turn amounts in whole units into integer hundredths, nullable only if some are missing"""
+
+    units = (pd.to_numeric(amounts) * scale).round()
+
+    return units.astype('int64' if units.notna().all() else 'Int64')
+
+
+def from_minor_units(units):
+    """Turn integer hundredths back into amounts in whole units"""
+
+    return units.astype(float) / AMOUNT_SCALE
+
+
+def to_decimal_text(amounts):
+    """Write amounts as the shortest decimal text that reads back as the same float, never in exponent form"""
+
+    amounts = pd.to_numeric(amounts).astype(float)
+
+    return amounts.map(lambda amount: np.format_float_positional(amount, trim='-'), na_action='ignore')
+
+
+def set_expenses_dtypes(df):
+    """Give the columns of an expenses df with amounts already in hundredths their compact dtypes.
+
+    Date becomes datetime64, the CATEGORICAL_COLUMNS categoricals, the
+    AMOUNT_COLUMNS integers and the DECIMAL_COLUMNS floats, from their
+    stored text too. Columns the df doesn't have are skipped.
+    """
+
+    df = df.copy()
+    if 'Date' in df:
+        df['Date'] = pd.to_datetime(df['Date'])
+    for column in AMOUNT_COLUMNS:
+        if column in df:
+            df[column] = to_minor_units(df[column], scale=1)
+    for column in DECIMAL_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype(float)
+    for column in CATEGORICAL_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype('category')
+
+    return df
+
+
+def compact_expenses(df):
+    """Put an expenses df with amounts in whole units into the compact schema, see set_expenses_dtypes"""
+
+    df = df.assign(**{column: to_minor_units(df[column]) for column in AMOUNT_COLUMNS if column in df})
+
+    return set_expenses_dtypes(df)
+
+
+def expenses_in_units(df):
+    """Get a copy of a compact expenses df with its amounts back in whole units, for csv and reports"""
+
+    return df.assign(**{column: from_minor_units(df[column]) for column in AMOUNT_COLUMNS if column in df})
@@ -0,0 +1,118 @@
+import pandas as pd
+
+import hashlib
+
+import expenses_storage
+import ledger_journal
+
+
+# Tag the converter writes each fingerprint to. ledger convert wrote its own
+# hashes to a UUID tag, those are never taken for one of these
+FINGERPRINT_TAG = 'Fingerprint'
+
+# Columns an export may carry its own row id in
+ROW_ID_COLUMNS = ['id', 'uuid']
+
+
+def normalize_text(values):
+    """Collapse whitespace and case so cosmetic edits don't change a fingerprint"""
+
+    return values.fillna('').astype(str).str.split().str.join(' ').str.casefold()
+
+
+def make_fingerprints(dates, amounts, currencies, accounts, payees, notes, row_ids=None, repeats=None):
+    """Hash the normalized fields of each transaction into a series of fingerprints.
+
+    Only the date is used, since a journal keeps no time of day, and
+    amounts are written without trailing zeros. Identical transactions,
+    like two bus fares on the same day, are told apart by number_repeats,
+    pass the repeats dict of an earlier chunk of the same file so the
+    numbering carries on across chunks.
+    """
+
+    amounts = pd.to_numeric(amounts).map(lambda amount: f'{amount:.8f}'.rstrip('0').rstrip('.'))
+
+    fields = [pd.to_datetime(dates).dt.strftime('%Y-%m-%d'),
+              amounts,
+              currencies.fillna('').astype(str).str.strip(),
+              accounts.fillna('').astype(str).str.strip(),
+              normalize_text(payees),
+              normalize_text(notes)]
+    if row_ids is not None:
+        fields.append(row_ids.fillna('').astype(str).str.strip())
+
+    keys = number_repeats(fields[0].str.cat(fields[1:], sep='\x1f'), repeats)
+
+    return keys.map(lambda key: hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def number_repeats(keys, repeats=None):
+    """Add the occurrence number to every repeat of a key, so identical rows get their own fingerprints.
+
+    The first occurrence keeps its key as it is. repeats counts the keys
+    seen in earlier chunks and is updated with this one's.
+    """
+
+    if repeats is None:
+        repeats = {}
+
+    occurrence = keys.groupby(keys).cumcount() + keys.map(repeats).fillna(0).astype(int)
+    for key, count in keys.value_counts().items():
+        repeats[key] = repeats.get(key, 0) + count
+
+    return keys.where(occurrence == 0, keys + '\x1f' + occurrence.astype(str))
+
+
+def fingerprint_postings(postings_df):
+    """Get the fingerprint of each expense posting read from a journal.
+
+    Transactions the converter wrote keep the fingerprint in their tag,
+    older ones get it computed from their fields like a reimport of their
+    export would, with its row id if the export had one.
+    """
+
+    row_ids = next((postings_df[c] for c in ROW_ID_COLUMNS if c in postings_df), None)
+    computed = make_fingerprints(postings_df['Date'], postings_df['Amount'],
+                                 postings_df['Commodity'], postings_df['Account'],
+                                 postings_df['Payee'], postings_df['Note'], row_ids)
+
+    if FINGERPRINT_TAG in postings_df:
+        return postings_df[FINGERPRINT_TAG].fillna(computed)
+
+    return computed
+
+
+def load_fingerprints(connection):
+    """Read the whole index into a set for constant time lookups"""
+
+    return {r[0] for r in connection.execute('SELECT "Fingerprint" FROM import_fingerprints')}
+
+
+def add_fingerprints(connection, fingerprints, source):
+    """Add the fingerprints of newly imported transactions to the index"""
+
+    with expenses_storage.transaction(connection):
+        connection.executemany('INSERT OR IGNORE INTO import_fingerprints ("Fingerprint", "Source") '
+                               'VALUES (?, ?)',
+                               ((fingerprint, source) for fingerprint in fingerprints))
+
+
+def rebuild_fingerprints(connection, journals):
+    """Replace the index with the fingerprints of every expense in the journals.
+
+    Returns the number of fingerprints indexed.
+    """
+
+    frames = []
+    for journal in journals:
+        postings_df, prices_df = ledger_journal.read_journal(journal, account_pattern='^Expenses')
+        frames.append(pd.DataFrame({'Fingerprint': fingerprint_postings(postings_df),
+                                    'Source': postings_df['File']}))
+
+    df = pd.concat(frames, ignore_index=True).drop_duplicates('Fingerprint')
+
+    with expenses_storage.transaction(connection):
+        connection.execute('DELETE FROM import_fingerprints')
+        expenses_storage.insert_rows(connection, 'import_fingerprints', df)
+
+    return len(df)
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+import subprocess
+from io import BytesIO
+
+
+# Separate fields with the ASCII unit separator, a single byte the arrow
+# csv reader can split on, with no quoting so nothing has to be unescaped
+FIELD_SEPARATOR = '\x1f'
+
+LEDGER_FORMAT = FIELD_SEPARATOR.join(['%(format_date(date, "%Y-%m-%d"))',
+                                      '%(payee)',
+                                      '%(display_account)',
+                                      '%(quantity(scrub(display_amount)))',
+                                      '%(join(note | xact.note))']) + '\n'
+
+# Prices can push the display precision of $ well past cents
+AMOUNT_TYPE = pa.decimal128(28, 10)
+
+LEDGER_COLUMN_TYPES = {'Date': pa.date32(),
+                       'Payee': pa.dictionary(pa.int32(), pa.string()),
+                       'Category': pa.string(),
+                       'Amount': AMOUNT_TYPE,
+                       'metadata': pa.string()}
+
+# Metadata tag inside a note line, "Key: value"
+TAG_PATTERN = r'^(?P<key>[^\s:"]+):\s*(?P<value>.*)$'
+
+
+def ledger_export_command(ledger_file):
+    """Build the ledger csv command that prints the single byte separated format"""
+
+    return ['ledger', '-f', ledger_file, 'csv', '-X', '$', '^Expenses', '--csv-format', LEDGER_FORMAT]
+
+
+def run_ledger_export(ledger_file):
+    """Run the ledger csv command with the single byte separated format, return the raw bytes"""
+
+    return subprocess.check_output(ledger_export_command(ledger_file))
+
+
+def extract_note_tags_arrow(notes, line_sep='\\n'):
+    """Split an arrow array of note blocks into a Note array and a dict of tag arrays.
+
+    The arrow counterpart of ledger_journal.extract_note_tags, all lines of
+    all notes are flattened and matched at once, tags are dictionary encoded.
+    """
+
+    rows = len(notes)
+    lines = pc.split_pattern(pc.fill_null(notes, ''), line_sep)
+    parents = pc.list_parent_indices(lines).to_numpy()
+    flat = pc.utf8_trim(pc.list_flatten(lines), ' \t"')
+
+    # Non matching lines come back as null
+    parts = pc.extract_regex(flat, TAG_PATTERN)
+    is_tag = pc.is_valid(parts).to_numpy(zero_copy_only=False)
+    keys = pc.struct_field(parts, 'key')
+    values = pc.utf8_trim(pc.struct_field(parts, 'value'), ' \t"')
+
+    # Scatter each tag's values back onto the rows, the last one wins if repeated
+    tags = {}
+    for key in pc.unique(keys.filter(pa.array(is_tag))).to_pylist():
+        mask = pc.fill_null(pc.equal(keys, key), False).to_numpy(zero_copy_only=False)
+        positions = np.full(rows, -1)
+        positions[parents[mask]] = np.flatnonzero(mask)
+        tags[key] = pc.dictionary_encode(values.take(pa.array(positions, mask=positions < 0)))
+
+    # Join the remaining non empty lines of each row back into the note
+    is_text = ~is_tag & (pc.utf8_length(flat).to_numpy() > 0) \
+        & ~pc.match_substring_regex(flat, '^:.*:$').to_numpy(zero_copy_only=False)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(parents[is_text], minlength=rows))])
+    text = pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), flat.filter(pa.array(is_text)))
+    note = pc.binary_join(text, '\n')
+    note = pc.if_else(pc.equal(note, ''), pa.scalar(None, pa.string()), note)
+
+    return note, tags
+
+
+def csv_options():
+    """Get the read, parse and convert options of the arrow csv reader for ledger's output"""
+
+    return {'read_options': pa_csv.ReadOptions(column_names=list(LEDGER_COLUMN_TYPES)),
+            'parse_options': pa_csv.ParseOptions(delimiter=FIELD_SEPARATOR, quote_char=False),
+            'convert_options': pa_csv.ConvertOptions(column_types=LEDGER_COLUMN_TYPES,
+                                                     strings_can_be_null=True)}
+
+
+def read_ledger_arrow(ledger_file):
+    """Get an arrow table of all ledger expenses transactions.
+
+    Date is date32, Amount a decimal, and Payee, Category and every tag
+    are dictionary encoded.
+    """
+
+    return clean_ledger_table(pa_csv.read_csv(BytesIO(run_ledger_export(ledger_file)), **csv_options()))
+
+
+def iter_ledger_arrow(ledger_file, batch_rows):
+    """Stream ledger's output through the arrow csv reader as tables of about batch_rows rows.
+
+    ledger's stdout is read from a pipe while it prints, so only one batch
+    is held at a time. Each table is cleaned like read_ledger_arrow's, the
+    tag columns being the ones found in that batch.
+    """
+
+    with subprocess.Popen(ledger_export_command(ledger_file), stdout=subprocess.PIPE) as process:
+        batches = []
+        rows = 0
+        for batch in pa_csv.open_csv(process.stdout, **csv_options()):
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= batch_rows:
+                yield clean_ledger_table(pa.Table.from_batches(batches))
+                batches = []
+                rows = 0
+
+        if rows:
+            yield clean_ledger_table(pa.Table.from_batches(batches))
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def clean_ledger_table(table):
+    """Turn the columns read from ledger's output into the expenses columns"""
+
+    # Remove the Expenses: prefix
+    category = pc.replace_substring_regex(table['Category'], '^Expenses:?', '')
+    table = table.set_column(table.schema.get_field_index('Category'), 'Category',
+                             pc.dictionary_encode(category))
+
+    # Split the note block on its escaped newlines into the Note and a column per tag
+    note, tags = extract_note_tags_arrow(table['metadata'].combine_chunks())
+    table = table.drop_columns(['metadata']).append_column('Note', note)
+
+    for column in ['Country', 'City']:
+        tags.setdefault(column, pa.nulls(len(table), pa.dictionary(pa.int32(), pa.string())))
+    for key, values in tags.items():
+        table = table.append_column(key, values)
+
+    return table
+
+
+def arrow_to_pandas(table):
+    """Convert an arrow table to a df without going through object columns.
+
+    Dictionary columns become categoricals, dates datetime64, and strings
+    and decimals stay arrow backed.
+    """
+
+    def types_mapper(arrow_type):
+        if pa.types.is_string(arrow_type) or pa.types.is_decimal(arrow_type):
+            return pd.ArrowDtype(arrow_type)
+        return None
+
+    return table.to_pandas(types_mapper=types_mapper, date_as_object=False)
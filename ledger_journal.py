@@ -0,0 +1,499 @@
+import pandas as pd
+
+import glob
+import os
+import re
+from datetime import date
+
+
+# Transaction header: DATE[=AUX_DATE] [*|!] [(CODE)] PAYEE [; NOTE]
+XACT_RE = re.compile(r'^(?P<date>(?:\d{4}[/.-])?\d{1,2}[/.-]\d{1,2})(?:=\S+)?'
+                     r'\s*(?P<state>[*!])?\s*(?:\((?P<code>[^)]*)\))?'
+                     r'\s*(?P<payee>[^;]*?)\s*(?:;(?P<note>.*))?$')
+
+# Price directive: P DATE [TIME] COMMODITY PRICE
+PRICE_RE = re.compile(r'^P\s+(?P<date>\S+)(?:\s+\d{1,2}:\d{2}(?::\d{2})?)?'
+                      r'\s+(?P<commodity>"[^"]+"|\S+)\s+(?P<price>.+?)\s*$')
+
+# Amount with the commodity either before or after the quantity
+AMOUNT_RE = re.compile(r'^(?P<neg>-)?\s*(?P<pre>"[^"]+"|[^\s\d.,+\-"]+)?\s*(?P<neg2>-)?\s*'
+                       r'(?P<qty>\d[\d,]*(?:\.\d*)?|\.\d+)\s*(?P<post>"[^"]+"|[^\s\d.,+\-"]+)?$')
+
+# Lot annotations like {$1.10} [2023/06/21] (note) that ledger allows after an amount
+LOT_RE = re.compile(r'\{\{?[^}]*\}?\}|\[[^\]]*\]|\([^)]*\)')
+
+# Metadata tag inside a note, "Key: value"
+TAG_RE = re.compile(r'^(?P<key>[^\s:]+):\s*(?P<value>.*)$')
+
+
+def parse_date(date_string, year=None):
+    """Turn a ledger date (2023/06/21, 2023-6-21 or 06/21 with a year directive) into a date"""
+
+    parts = re.split(r'[/.-]', date_string)
+    if len(parts) == 2:
+        parts = [year or date.today().year] + parts
+
+    return date(int(parts[0]), int(parts[1]), int(parts[2]))
+
+
+def parse_amount(amount_string):
+    """Split a ledger amount like $-12.50 or 1,000 VND into (quantity, commodity)"""
+
+    match = AMOUNT_RE.match(amount_string.strip())
+    if match is None:
+        raise ValueError(f'Could not parse amount "{amount_string}"')
+
+    quantity = float(match['qty'].replace(',', ''))
+    if bool(match['neg']) != bool(match['neg2']):
+        quantity = -quantity
+
+    commodity = (match['pre'] or match['post'] or '').strip('"')
+
+    return quantity, commodity
+
+
+def split_note(note_lines):
+    """Split note lines into the free text note and a dict of Key: value tags"""
+
+    text = []
+    tags = {}
+    for line in note_lines:
+        line = line.strip().strip('"').strip()
+        if not line:
+            continue
+
+        tag = TAG_RE.match(line)
+        if tag:
+            tags[tag['key']] = tag['value'].strip().strip('"').strip()
+        elif not (line.startswith(':') and line.endswith(':')):
+            # :tag1:tag2: style tags carry no value so only the text is kept
+            text.append(line)
+
+    return '\n'.join(text), tags
+
+
+def extract_note_tags(notes, line_sep='\n'):
+    """Vectorized split_note for a Series of note blocks.
+
+    Every line of every note is matched in one regex pass, lines that look
+    like Key: value become a column per key and the rest are joined into a
+    Note column. Works with any number of lines and tags in any order.
+    """
+
+    sep = re.escape(line_sep)
+    line = rf'(?:(?!{sep}).)*?'
+
+    # The key stops at the separator, an escaped \n is made of key characters
+    key = rf'(?:(?!{sep})[^\s:"])+'
+    pattern = (rf'(?:^|{sep})[\s"]*(?:(?P<key>{key}):[ \t]*(?P<value>{line})'
+               rf'|:{line}:|(?P<text>{line}))[\s"]*(?={sep}|$)')
+
+    matches = notes.str.extractall(re.compile(pattern, re.S)).droplevel('match')
+
+    # One column per tag key, the last value wins if a key is repeated
+    tags = matches.dropna(subset=['key']).set_index('key', append=True)['value']
+    tags = tags[~tags.index.duplicated(keep='last')].unstack('key')
+    tags.columns.name = None
+
+    # Everything that isn't a tag is the note
+    text = matches['text'][matches['text'].fillna('') != '']
+    note = text.groupby(level=0).agg('\n'.join)
+
+    return pd.DataFrame({'Note': note}, index=notes.index).join(tags)
+
+
+def parse_posting(line):
+    """Parse an indented posting line into a dict, amount is None when elided"""
+
+    body, _, note = line.partition(';')
+    body = body.strip()
+
+    # Drop a posting level cleared/pending flag
+    if body[:1] in ('*', '!'):
+        body = body[1:].strip()
+
+    # The account name ends at two spaces or a tab
+    parts = re.split(r'\s{2,}|\t', body, maxsplit=1)
+    account = parts[0].strip().strip('()[]')
+
+    # Drop any balance assertion and lot annotations
+    amount_text = parts[1] if len(parts) > 1 else ''
+    amount_text = LOT_RE.sub('', amount_text.split('=')[0]).strip()
+
+    posting = {'account': account, 'amount': None, 'commodity': None,
+               'cost': None, 'cost_commodity': None,
+               'notes': [note] if note.strip() else []}
+
+    if not amount_text:
+        return posting
+
+    # Split off the per unit (@) or total (@@) cost
+    cost_text = None
+    is_total_cost = '@@' in amount_text
+    if '@' in amount_text:
+        amount_text, cost_text = re.split(r'@@?', amount_text, maxsplit=1)
+
+    posting['amount'], posting['commodity'] = parse_amount(amount_text)
+
+    if cost_text:
+        cost, posting['cost_commodity'] = parse_amount(cost_text)
+        if not is_total_cost:
+            cost = cost * abs(posting['amount'])
+        posting['cost'] = abs(cost) if posting['amount'] >= 0 else -abs(cost)
+
+    return posting
+
+
+def finish_transaction(xact, prices):
+    """Fill in an elided posting amount and record prices implied by costs"""
+
+    # Sum what every posting with an amount weighs, by commodity
+    balance = {}
+    elided = None
+    for posting in xact['postings']:
+        if posting['amount'] is None:
+            elided = posting
+            continue
+
+        if posting['cost'] is not None:
+            commodity, amount = posting['cost_commodity'], posting['cost']
+            if prices is not None and posting['amount']:
+                prices.append((xact['date'], posting['commodity'],
+                               abs(posting['cost'] / posting['amount']),
+                               posting['cost_commodity'], xact['offset']))
+        else:
+            commodity, amount = posting['commodity'], posting['amount']
+        balance[commodity] = balance.get(commodity, 0) + amount
+
+    if elided is None:
+        return xact
+
+    # The elided posting balances each commodity, one posting per commodity
+    postings = [p for p in xact['postings'] if p is not elided]
+    for commodity, amount in balance.items():
+        if round(amount, 9) != 0:
+            postings.append(dict(elided, amount=-amount, commodity=commodity))
+    xact['postings'] = postings
+
+    return xact
+
+
+def is_year_directive(stripped):
+    """Check if a line sets the default year, like year 2023, Y 2023 or Y2023"""
+
+    directive = stripped.partition(' ')[0]
+    return directive in ('year', 'Y') or stripped.startswith('Y2') or stripped.startswith('Y1')
+
+
+def parse_year(stripped):
+    """Read the year a year directive sets"""
+
+    return int(stripped.lstrip('Y').replace('year', '').strip())
+
+
+def year_before(ledger_file, end_offset):
+    """Find the default year in effect at end_offset in ledger_file.
+
+    Reading part way through a journal would otherwise miss a year
+    directive above the start and date short dates in the current year.
+    Only year directives and block comments are looked at.
+    """
+
+    year = None
+    in_comment = False
+    offset = 0
+
+    with open(ledger_file, 'rb') as f:
+        for raw_line in f:
+            if offset >= end_offset:
+                break
+            offset += len(raw_line)
+
+            if raw_line[:1] not in (b'y', b'Y', b'c', b't', b'e'):
+                continue
+            stripped = raw_line.decode('utf-8').strip()
+            if in_comment:
+                in_comment = stripped not in ('end comment', 'end test')
+            elif stripped in ('comment', 'test'):
+                in_comment = True
+            elif is_year_directive(stripped):
+                year = parse_year(stripped)
+
+    return year
+
+
+def iter_transactions(ledger_file, prices=None, start_offset=0, files=None):
+    """Stream the transactions of a journal and the files it includes.
+
+    Each transaction is a dict with the file it is in, the byte offset in
+    ledger_file it starts at (or of the include directive that brought it
+    in), its date, payee, notes and postings. If a prices list is given the
+    P directives and prices implied by posting costs are appended to it
+    as (date, commodity, price, price_commodity, offset) tuples. If a files
+    list is given every included file read is appended to it.
+    """
+
+    ledger_file = os.path.abspath(ledger_file)
+    year = year_before(ledger_file, start_offset) if start_offset else None
+    xact = None
+    in_block = False
+    in_comment = False
+    offset = start_offset
+
+    with open(ledger_file, 'rb') as f:
+        f.seek(start_offset)
+
+        for raw_line in f:
+            line_offset = offset
+            offset += len(raw_line)
+            line = raw_line.decode('utf-8').rstrip('\r\n')
+            stripped = line.strip()
+
+            # Skip block comments
+            if in_comment:
+                if stripped in ('end comment', 'end test'):
+                    in_comment = False
+                continue
+
+            # Indented lines belong to the transaction or block above them
+            if line[:1] in (' ', '\t'):
+                if in_block or xact is None or not stripped:
+                    continue
+                if stripped.startswith(';'):
+                    # A comment line is a note on the last posting, or the
+                    # transaction if there are no postings yet
+                    note = stripped[1:]
+                    if xact['postings']:
+                        xact['postings'][-1]['notes'].append(note)
+                    else:
+                        xact['notes'].append(note)
+                else:
+                    xact['postings'].append(parse_posting(stripped))
+                continue
+
+            # Any unindented line ends the current transaction
+            if xact is not None:
+                yield finish_transaction(xact, prices)
+                xact = None
+            in_block = False
+
+            if not stripped or stripped[0] in ';#%|*':
+                continue
+
+            if stripped in ('comment', 'test'):
+                in_comment = True
+                continue
+
+            if stripped[0].isdigit():
+                match = XACT_RE.match(stripped)
+                if match is None:
+                    raise ValueError(f'Could not parse transaction "{stripped}" in {ledger_file}')
+
+                xact = {'file': ledger_file,
+                        'offset': line_offset,
+                        'date': parse_date(match['date'], year),
+                        'payee': match['payee'],
+                        'notes': [match['note']] if match['note'] else [],
+                        'postings': []}
+                continue
+
+            directive, _, argument = stripped.partition(' ')
+
+            if directive == 'P':
+                price = PRICE_RE.match(stripped)
+                if price and prices is not None:
+                    amount, price_commodity = parse_amount(price['price'])
+                    prices.append((parse_date(price['date'], year),
+                                   price['commodity'].strip('"'),
+                                   amount, price_commodity, line_offset))
+            elif is_year_directive(stripped):
+                year = parse_year(stripped)
+            elif directive in ('include', '!include'):
+                include_pattern = os.path.join(os.path.dirname(ledger_file),
+                                               os.path.expanduser(argument.strip()))
+                for include_file in sorted(glob.glob(include_pattern)):
+                    if files is not None:
+                        files.append(os.path.abspath(include_file))
+
+                    # Everything in an included file sits at the include line
+                    prices_before = len(prices) if prices is not None else 0
+                    for included_xact in iter_transactions(include_file, prices, files=files):
+                        included_xact['offset'] = line_offset
+                        yield included_xact
+                    if prices is not None:
+                        prices[prices_before:] = [p[:4] + (line_offset,) for p in prices[prices_before:]]
+            else:
+                # Automated (=) and periodic (~) transactions and other
+                # directives, skip their indented lines
+                in_block = True
+
+        if xact is not None:
+            yield finish_transaction(xact, prices)
+
+
+def postings_frame(columns, tag_columns):
+    """Build a postings df from read_journal's column lists, with Date and Amount typed"""
+
+    postings_df = pd.DataFrame({**columns, **tag_columns})
+    postings_df['Date'] = pd.to_datetime(postings_df['Date'])
+    postings_df['Amount'] = postings_df['Amount'].astype(float)
+
+    return postings_df
+
+
+def prices_frame(prices):
+    """Build a prices df from the tuples iter_transactions collects"""
+
+    prices_df = pd.DataFrame(prices, columns=['Date', 'Commodity', 'Price', 'PriceCommodity', 'Offset'])
+    prices_df['Date'] = pd.to_datetime(prices_df['Date'])
+    prices_df['Price'] = prices_df['Price'].astype(float)
+
+    return prices_df
+
+
+def iter_postings(ledger_file, account_pattern=None, batch_rows=None, start_offset=0, files=None,
+                  prices=None):
+    """Stream the postings of a journal as dfs of up to batch_rows postings.
+
+    Each df has the columns read_journal returns, the tag columns being
+    the ones found in that batch. With no batch_rows every posting comes in
+    one df. At least one df is always yielded, even if it is empty. prices
+    and files are filled in like iter_transactions does.
+    """
+
+    account_re = re.compile(account_pattern) if account_pattern else None
+
+    def empty_columns():
+        return {'Date': [], 'Payee': [], 'Account': [], 'Amount': [],
+                'Commodity': [], 'Note': [], 'File': [], 'Offset': []}
+
+    columns = empty_columns()
+    tag_columns = {}
+    rows = 0
+    batches = 0
+
+    for xact in iter_transactions(ledger_file, prices, start_offset, files):
+        xact_note, xact_tags = split_note(xact['notes'])
+
+        for posting in xact['postings']:
+            if account_re is not None and not account_re.search(posting['account']):
+                continue
+
+            # The posting note wins over the transaction note, tags are inherited
+            note, tags = split_note(posting['notes'])
+            tags = {**xact_tags, **tags}
+
+            columns['Date'].append(xact['date'])
+            columns['Payee'].append(xact['payee'])
+            columns['Account'].append(posting['account'])
+            columns['Amount'].append(posting['amount'])
+            columns['Commodity'].append(posting['commodity'])
+            columns['Note'].append(note or xact_note or None)
+            columns['File'].append(xact['file'])
+            columns['Offset'].append(xact['offset'])
+
+            # Give every tag its own column, padded for rows without it
+            for key, value in tags.items():
+                if key not in tag_columns:
+                    tag_columns[key] = [None] * rows
+                tag_columns[key].append(value)
+            rows += 1
+            for values in tag_columns.values():
+                if len(values) < rows:
+                    values.append(None)
+
+            if rows == batch_rows:
+                yield postings_frame(columns, tag_columns)
+                batches += 1
+                columns = empty_columns()
+                tag_columns = {}
+                rows = 0
+
+    if rows or not batches:
+        yield postings_frame(columns, tag_columns)
+
+
+def read_journal(ledger_file, account_pattern=None, start_offset=0, files=None):
+    """Read the postings of a journal into typed columns in a single pass.
+
+    Returns a postings df with Date, Payee, Account, Amount, Commodity, Note
+    and a column per metadata tag, plus a prices df from the journal.
+    Postings are only kept if their account matches account_pattern.
+    Reading can start part way through ledger_file at start_offset, which
+    must be the start of a line, year directives above it still apply.
+    """
+
+    prices = []
+    postings_df = next(iter_postings(ledger_file, account_pattern, start_offset=start_offset,
+                                     files=files, prices=prices))
+
+    return postings_df, prices_frame(prices)
+
+
+def read_prices(ledger_file, files=None):
+    """Read only the prices of a journal, without keeping any of its postings"""
+
+    prices = []
+    for _ in iter_transactions(ledger_file, prices, files=files):
+        pass
+
+    return prices_frame(prices)
+
+
+def include_files(ledger_file):
+    """List every file ledger_file includes, following includes inside them, without parsing"""
+
+    files = []
+    with open(ledger_file, 'rb') as f:
+        for raw_line in f:
+            if not raw_line.startswith((b'include', b'!include')):
+                continue
+
+            argument = raw_line.decode('utf-8').partition(' ')[2].strip()
+            include_pattern = os.path.join(os.path.dirname(ledger_file),
+                                           os.path.expanduser(argument))
+            for include_file in sorted(glob.glob(include_pattern)):
+                files.append(os.path.abspath(include_file))
+                files.extend(include_files(include_file))
+
+    return files
+
+
+def last_entry_offset(ledger_file, start_offset=0):
+    """Find the byte offset of the last transaction or include line in ledger_file"""
+
+    last_offset = start_offset
+    offset = start_offset
+
+    with open(ledger_file, 'rb') as f:
+        f.seek(start_offset)
+        for raw_line in f:
+            if raw_line[:1].isdigit() or raw_line.startswith((b'include', b'!include')):
+                last_offset = offset
+            offset += len(raw_line)
+
+    return last_offset
+
+
+def exchange_amounts(postings_df, prices_df, commodity='$'):
+    """Value postings in commodity using the latest price on or before each posting date.
+
+    Like ledger -X, postings without a known price keep their own commodity.
+    """
+
+    df = postings_df.copy()
+    rates = prices_df.loc[prices_df['PriceCommodity'] == commodity,
+                          ['Date', 'Commodity', 'Price']]
+    rates = rates.astype({'Commodity': df['Commodity'].dtype, 'Date': df['Date'].dtype})
+
+    # As-of join needs both sides sorted by date, keep the original order to restore
+    df['_order'] = range(len(df))
+    df = pd.merge_asof(df.sort_values('Date'), rates.sort_values('Date'),
+                       on='Date', by='Commodity', direction='backward')
+    df = df.sort_values('_order').drop('_order', axis=1).reset_index(drop=True)
+
+    to_convert = (df['Commodity'] != commodity) & df['Price'].notna()
+    df.loc[to_convert, 'Amount'] = df.loc[to_convert, 'Amount'] * df.loc[to_convert, 'Price']
+    df.loc[to_convert, 'Commodity'] = commodity
+
+    return df.drop('Price', axis=1)
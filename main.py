@@ -1,27 +1,255 @@
-from moneywallet_csv_import import *
-from clean_and_export_ledger_data import *
-from create_graphs import *
+"""ledger-tools command line.
 
+    python main.py export [JOURNAL...] [--csv PATH] [--archive DIR] [--full] [--jobs N]
+                          [--stream [--backend ledger|arrow]]
+    python main.py import-moneywallet CSV|DIR|GLOB [--per-wallet] [--output PATH]
+    python main.py rebuild-fingerprints JOURNAL...
+    python main.py dashboard [--streamlit]
+    python main.py travel-report
+    python main.py generate OUTPUT_DIR [--postings N]
+    python main.py benchmark [--scale 10k|100k|1m|10m] [--save-baseline]
 
-def main():
-    ledger_file = "/home/carson/Files/accounting/asia-trip.ledger"
-    days_toml = "/home/carson/Files/accounting/city-days-asia-trip.toml"
-    csv_output = '/home/carson/Files/expenses.csv'
+Each subcommand imports only the modules it runs, so a cron export never
+loads plotly, dash, streamlit or matplotlib and --help needs none of them.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
 
-    df = get_ledger_csv(ledger_file, csv_output)
-    # Export to sqlite
-    sqliteConnection = sqlite3.connect('expenses.db')
-    df.to_sql('ledger_expenses', sqliteConnection,
-              if_exists="replace", index=False)
 
-    nights_df = read_days_toml(days_toml)
-    # Export to sqlite
-    sqliteConnection = sqlite3.connect('expenses.db')
-    nights_df.to_sql('city_nights', sqliteConnection,
-                     if_exists="replace", index=False)
+LEDGER_FILE = "/home/carson/Files/accounting/asia-trip.ledger"
+MONEYWALLET_CSV = "/home/carson/Downloads/MoneyWallet_export_2023-12-09_17-53-43.csv"
+
+
+def record_run(args):
+    """Record the stages of a command with stage_metrics, where the instrumentation options say"""
+
+    import stage_metrics
+
+    return stage_metrics.record_run(args.command, run_log=args.run_log or None,
+                                    textfile=args.prometheus, profile_dir=args.profile_dir,
+                                    trace_memory=args.trace_memory)
+
+
+def run_export(args):
+    """Sync the journals into expenses.db, and refresh the parquet archive if one is given"""
+
+    from clean_and_export_ledger_data import (STREAM_BATCH_ROWS, export_ledger, journal_days_toml,
+                                              stream_export_ledger)
+
+    # Each journal's nights toml is found next to it unless they are all given in order
+    ledger_files = args.ledger_files or [LEDGER_FILE]
+    if args.days_toml and len(args.days_toml) != len(ledger_files):
+        sys.exit('Give a --days-toml for every journal, or none to use city-days-<trip>.toml')
+    days_tomls = args.days_toml or [journal_days_toml(ledger_file) for ledger_file in ledger_files]
+
+    with record_run(args):
+        if args.stream:
+            rows = stream_export_ledger(dict(zip(ledger_files, days_tomls)), args.database,
+                                        csv_output=args.csv, archive_dir=args.archive,
+                                        backend=args.backend,
+                                        batch_rows=args.batch_rows or STREAM_BATCH_ROWS)
+        else:
+            rows = export_ledger(dict(zip(ledger_files, days_tomls)), args.database,
+                                 csv_output=args.csv, archive_dir=args.archive, full=args.full,
+                                 max_concurrent=args.jobs)
+    for trip, count in rows.items():
+        print(f'{trip}: {count} rows written to {args.database}')
+
+
+def run_import_moneywallet(args):
+    """Convert a MoneyWallet csv export to a ledger journal, or a directory or glob of them"""
+
+    import moneywallet_csv_import
+
+    if os.path.isfile(args.csv_path) and args.output is None and not args.per_wallet:
+        with record_run(args):
+            written, skipped = moneywallet_csv_import.convert_moneywallet_csv(args.csv_path,
+                                                                              database=args.database)
+        print(f'{written} transactions written, {skipped} already imported skipped')
+        return
+
+    output = args.output
+    if output is None:
+        output = 'moneywallet' if args.per_wallet else 'moneywallet.ledger'
+
+    with record_run(args):
+        report = moneywallet_csv_import.import_moneywallet_batch(args.csv_path, output,
+                                                                 per_wallet=args.per_wallet,
+                                                                 workers=args.workers,
+                                                                 database=args.database)
+    print(report.to_string(index=False))
+
+    failed = report['Error'].notna().sum()
+    written = report['Rows'].sum() - report['Skipped'].sum()
+    print(f'{written} transactions from {len(report) - failed} exports written to {output}, '
+          f'{report["Skipped"].sum()} already imported skipped')
+    if failed:
+        sys.exit(f'{failed} exports failed')
+
+
+def run_rebuild_fingerprints(args):
+    """Rebuild the import fingerprint index from the journals already imported into"""
+
+    import expenses_storage
+    import import_fingerprints
+
+    connection = expenses_storage.get_connection(args.database)
+    count = import_fingerprints.rebuild_fingerprints(connection, args.journals)
+    print(f'{count} fingerprints indexed in {args.database}')
+
+
+def run_dashboard(args):
+    """Serve the Dash dashboard, or the Streamlit one with --streamlit"""
+
+    if args.streamlit:
+        # Streamlit has to own the process, so hand the script to its runner
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'make_streamlit_dashboard.py')
+        subprocess.run([sys.executable, '-m', 'streamlit', 'run', script], check=True)
+        return
+
+    import create_graphs
+
+    create_graphs.main(args.database)
+
+
+def run_travel_report(args):
+    """Plot the per day travel report from the transactions in expenses.db"""
+
+    import old_travel_report
+
+    old_travel_report.main(args.database)
+
+
+def run_generate(args):
+    """Write a synthetic journal, MoneyWallet export and nights toml to benchmark and test with"""
+
+    import synthetic_data
+
+    paths = synthetic_data.generate(args.output_dir, args.postings, seed=args.seed, overwrite=True)
+    for kind, path in paths.items():
+        print(f'{kind}: {path}')
+
+
+def run_benchmark(args):
+    """Time the pipeline on a synthetic journal and flag regressions against the stored baseline"""
+
+    import benchmarks
+
+    regressions = benchmarks.main(args.scale, repeat=args.repeat, only=args.only,
+                                  save=args.save_baseline, baseline_file=args.baseline,
+                                  data_dir=args.data_dir, tolerance=args.tolerance)
+    if regressions:
+        sys.exit(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}')
+
+
+def make_parser():
+    """Build the argument parser with a subparser per command"""
+
+    parser = argparse.ArgumentParser(prog='ledger-tools',
+                                     description='Import, export and report on ledger accounting data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    database = os.path.join(os.getcwd(), 'expenses.db')
+
+    # Options of the commands whose stages are measured
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    instrumentation.add_argument('--run-log', default=None, metavar='JSONL',
+                                 help="append each run's stage metrics to this json lines log")
+    instrumentation.add_argument('--prometheus', default=None, metavar='TEXTFILE',
+                                 help='also write the stage metrics to this node exporter textfile')
+    instrumentation.add_argument('--profile-dir', default=None,
+                                 help='write a cProfile dump of each stage to this directory')
+    instrumentation.add_argument('--trace-memory', action='store_true',
+                                 help='trace the peak python memory of each stage, slows the run down')
+
+    export = subparsers.add_parser('export', help='sync the journal into expenses.db',
+                                   parents=[instrumentation])
+    export.add_argument('ledger_files', nargs='*', metavar='JOURNAL',
+                        help='journals to export, each kept under its file name as the trip')
+    export.add_argument('--days-toml', action='append',
+                        help='nights toml of each journal in order, repeat for several')
+    export.add_argument('--jobs', type=int, default=4, help='journals to parse at once')
+    export.add_argument('--database', default=database)
+    export.add_argument('--csv', default=None, help='also write the expenses to this csv')
+    export.add_argument('--archive', default=None, metavar='DIR',
+                        help='also refresh a parquet archive of the expenses in this directory')
+    export.add_argument('--full', action='store_true', help='rebuild instead of syncing changes')
+    export.add_argument('--stream', action='store_true',
+                        help='rebuild in batches with flat memory, for journals too big to parse at once')
+    export.add_argument('--backend', choices=['python', 'ledger', 'arrow'], default='python',
+                        help='read the journal in-process, or from the ledger csv command with the '
+                             'python or arrow csv reader, when streaming')
+    export.add_argument('--batch-rows', type=int, default=None,
+                        help='postings per batch when streaming, STREAM_BATCH_ROWS by default')
+    export.set_defaults(func=run_export)
+
+    moneywallet = subparsers.add_parser('import-moneywallet',
+                                        help='convert a MoneyWallet csv export to ledger',
+                                        parents=[instrumentation])
+    moneywallet.add_argument('csv_path', nargs='?', default=MONEYWALLET_CSV,
+                             help='an export, or a directory or glob of them to convert in parallel')
+    moneywallet.add_argument('--output', default=None,
+                             help='merged journal, or directory of journals with --per-wallet')
+    moneywallet.add_argument('--per-wallet', action='store_true',
+                             help='write a journal per wallet instead of one merged journal')
+    moneywallet.add_argument('--workers', type=int, default=None,
+                             help='processes to convert with, one per core by default')
+    moneywallet.add_argument('--database', default=database,
+                             help='database holding the fingerprints of transactions already imported')
+    moneywallet.set_defaults(func=run_import_moneywallet)
+
+    fingerprints = subparsers.add_parser('rebuild-fingerprints',
+                                         help='rebuild the duplicate import index from journals')
+    fingerprints.add_argument('journals', nargs='+')
+    fingerprints.add_argument('--database', default=database)
+    fingerprints.set_defaults(func=run_rebuild_fingerprints)
+
+    dashboard = subparsers.add_parser('dashboard', help='serve the expenses dashboard')
+    dashboard.add_argument('--database', default=database)
+    dashboard.add_argument('--streamlit', action='store_true',
+                           help='serve the streamlit dashboard instead of dash')
+    dashboard.set_defaults(func=run_dashboard)
+
+    travel_report = subparsers.add_parser('travel-report', help='plot the per day travel report')
+    travel_report.add_argument('--database', default=database)
+    travel_report.set_defaults(func=run_travel_report)
+
+    generate = subparsers.add_parser('generate', help='write synthetic data to benchmark with')
+    generate.add_argument('output_dir')
+    generate.add_argument('--postings', type=int, default=10000)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.set_defaults(func=run_generate)
+
+    # Only the defaults are needed here, benchmarks itself is imported when it runs
+    benchmark = subparsers.add_parser('benchmark', help='time the pipeline on synthetic data')
+    benchmark.add_argument('--scale', choices=['10k', '100k', '1m', '10m'], default='10k')
+    benchmark.add_argument('--repeat', type=int, default=5, help='timed runs of each benchmark')
+    benchmark.add_argument('--only', nargs='+', metavar='NAME', help='only run these benchmarks')
+    benchmark.add_argument('--tolerance', type=float, default=0.5,
+                           help='fraction slower or bigger than the baseline that counts as a regression')
+    benchmark.add_argument('--save-baseline', action='store_true',
+                           help='store the results as the baseline instead of comparing')
+    benchmark.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'benchmark_baseline.json'),
+                           help='baseline timings, only comparable on the machine that saved them')
+    benchmark.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(),
+                                                              'ledger-tools-benchmarks'),
+                           help='where the synthetic data of each scale is kept')
+    benchmark.set_defaults(func=run_benchmark)
+
+    return parser
+
+
+def main(argv=None):
+
+    args = make_parser().parse_args(argv)
+    args.func(args)
 
 
 if __name__ == "__main__":
 
     main()
-
@@ -1,10 +1,309 @@
 import pandas as pd
 
+import glob
+import itertools
 import os
+import re
 import subprocess
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 
+import expenses_storage
+import import_fingerprints
+import result_cache
+import stage_metrics
 
+
+# Replacements made anywhere in a line of ledger convert's output
+ACCOUNT_REWRITES = {'*': '',
+                    'Equity:Unknown': 'Assets:Cash',
+                    'Expenses:City Transit': 'Expenses:Transportation:City Transit',
+                    'Expenses:Train': 'Expenses:Transportation:Train'}
+
+# The category MoneyWallet exported, which ledger convert leaves as a comment
+ACCOUNT_COMMENT_RE = re.compile(r'^\s*;\s*Account:\s*(?P<account>.*?)\s*$')
+
+# How many lines above an Expenses:Unknown posting its Account comment can be
+ACCOUNT_LOOKBEHIND = 16
+
+# MoneyWallet columns kept as tags on the transaction, any other column
+# becomes a tag named after it like ledger convert did
+TAG_COLUMNS = {'wallet': 'Country', 'place': 'City'}
+
+# Columns that go into the transaction itself rather than a tag
+TRANSACTION_COLUMNS = ['datetime', 'category', 'money', 'currency', 'description', 'note']
+
+# Every expense is paid out of cash
+BALANCING_ACCOUNT = 'Assets:Cash'
+
+# Rows converted at a time, bounds the memory a large export needs
+CHUNK_ROWS = 10000
+
+
+def compile_rewrites(rewrites):
+    """Compile a rewrite table into one regex, longest key first so a rewrite never loses to its own prefix"""
+
+    return re.compile('|'.join(re.escape(k) for k in sorted(rewrites, key=len, reverse=True)))
+
+
+def expense_accounts(chunk, rewrites=ACCOUNT_REWRITES):
+    """Get the expense account of each row, its category renamed by the rewrite table"""
+
+    accounts = 'Expenses:' + chunk['category'].str.strip()
+    if rewrites:
+        accounts = accounts.str.replace(compile_rewrites(rewrites),
+                                        lambda match: rewrites[match.group(0)], regex=True)
+
+    return accounts
+
+
+def fingerprint_chunk(chunk, rewrites=ACCOUNT_REWRITES, repeats=None):
+    """Fingerprint each row of a chunk, numbering identical rows with the repeats of the file so far"""
+
+    empty = pd.Series('', index=chunk.index)
+    row_ids = next((chunk[c] for c in import_fingerprints.ROW_ID_COLUMNS if c in chunk), None)
+
+    return import_fingerprints.make_fingerprints(chunk['datetime'], chunk['money'], chunk['currency'],
+                                                 expense_accounts(chunk, rewrites),
+                                                 chunk.get('description', empty),
+                                                 chunk.get('note', empty),
+                                                 row_ids, repeats)
+
+
+def format_transactions(chunk, rewrites=ACCOUNT_REWRITES, fingerprints=None):
+    """Turn a chunk of MoneyWallet rows, read as strings, into a series of ledger transactions.
+
+    Fingerprints given are written to each transaction's FINGERPRINT_TAG tag.
+    """
+
+    chunk = chunk.apply(lambda column: column.str.strip())
+
+    # Header line with the description as the payee and the note as its comment
+    xacts = pd.to_datetime(chunk['datetime']).dt.strftime('%Y/%m/%d')
+    if 'description' in chunk:
+        xacts = xacts + ' ' + chunk['description']
+    if 'note' in chunk:
+        xacts = xacts + ('  ; ' + chunk['note']).where(chunk['note'] != '', '')
+
+    # A tag line for each non empty tag column
+    for column in chunk.columns:
+        if column in TRANSACTION_COLUMNS:
+            continue
+        tag = TAG_COLUMNS.get(column, column)
+        xacts = xacts + ('\n    ; ' + tag + ': ' + chunk[column]).where(chunk[column] != '', '')
+
+    if fingerprints is not None:
+        xacts = xacts + f'\n    ; {import_fingerprints.FINGERPRINT_TAG}: ' + fingerprints
+
+    # The category is the expense account, renamed by the same table as before
+    account = expense_accounts(chunk, rewrites)
+
+    return (xacts
+            + '\n    ' + account + '  ' + chunk['money'] + ' ' + chunk['currency']
+            + '\n    ' + BALANCING_ACCOUNT + '\n')
+
+
+def convert_moneywallet_csv(csv_path, output_path=None, chunksize=CHUNK_ROWS, database=None):
+    """Convert a MoneyWallet export into a ledger journal next to it, or at output_path.
+
+    The export is read and written a chunk of rows at a time, so memory
+    stays bounded however large it is. Identical rows in the export are
+    separate purchases and are all written. Rows already in the
+    fingerprint index of database are skipped if it is given, the new rows
+    are appended to the journal and then added to the index, so a journal
+    imported before is left as it is when nothing is new. Without a
+    database the journal is written from scratch. Returns the number of
+    transactions written and skipped.
+    """
+
+    # Change the filename from .csv to .ledger
+    if output_path is None:
+        output_path = os.path.splitext(csv_path)[0] + '.ledger'
+
+    seen = set()
+    if database is not None:
+        with stage_metrics.stage('load_fingerprints') as metrics:
+            connection = expenses_storage.get_connection(database)
+            seen = import_fingerprints.load_fingerprints(connection)
+            metrics['RowsOut'] = len(seen)
+
+    new_fingerprints = []
+    skipped = 0
+    repeats = {}
+
+    with stage_metrics.stage('convert') as metrics:
+        chunks = pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunksize)
+
+        # With an index the journal is only opened once there is something new to add
+        text_file = open(output_path, 'w') if database is None else None
+        bytes_written = 0
+        try:
+            for chunk in chunks:
+                fingerprints = fingerprint_chunk(chunk, repeats=repeats)
+                is_new = ~fingerprints.isin(seen)
+                new_fingerprints.extend(fingerprints[is_new])
+                skipped += int((~is_new).sum())
+
+                if is_new.any():
+                    if text_file is None:
+                        text_file = open(output_path, 'a')
+                    xacts = format_transactions(chunk[is_new], fingerprints=fingerprints[is_new])
+                    text = '\n'.join(xacts) + '\n'
+                    text_file.write(text)
+                    bytes_written += len(text.encode('utf-8'))
+        finally:
+            if text_file is not None:
+                text_file.close()
+
+        metrics['RowsIn'] = len(new_fingerprints) + skipped
+        metrics['RowsOut'] = len(new_fingerprints)
+        metrics['BytesRead'] = os.path.getsize(csv_path)
+        metrics['BytesWritten'] = bytes_written
+
+    if database is not None:
+        with stage_metrics.stage('add_fingerprints') as metrics:
+            import_fingerprints.add_fingerprints(connection, new_fingerprints, os.path.abspath(csv_path))
+            metrics['RowsIn'] = len(new_fingerprints)
+
+    return len(new_fingerprints), skipped
+
+
+def find_exports(exports):
+    """Expand a directory, glob or single path into a sorted list of export files"""
+
+    if os.path.isdir(exports):
+        exports = os.path.join(exports, '*.csv')
+
+    return sorted(glob.glob(os.path.expanduser(exports)))
+
+
+def convert_export(csv_path, chunksize=CHUNK_ROWS):
+    """Convert one export for the batch import.
+
+    Returns a row for the report, with the error instead of raising so one
+    bad file doesn't stop the batch, and a df of each transaction's File,
+    Date, Wallet, Fingerprint and ledger text.
+    """
+
+    start = time.perf_counter()
+    frames = []
+    error = None
+    repeats = {}
+
+    try:
+        for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunksize):
+            wallet = chunk['wallet'].str.strip() if 'wallet' in chunk else ''
+            fingerprints = fingerprint_chunk(chunk, repeats=repeats)
+            frames.append(pd.DataFrame({'File': csv_path,
+                                        'Date': pd.to_datetime(chunk['datetime'].str.strip()),
+                                        'Wallet': wallet,
+                                        'Fingerprint': fingerprints,
+                                        'Transaction': format_transactions(chunk,
+                                                                           fingerprints=fingerprints)}))
+    except Exception as exc:
+        frames = []
+        error = f'{type(exc).__name__}: {exc}'
+
+    seconds = time.perf_counter() - start
+    df = pd.concat(frames, ignore_index=True) if frames else None
+    rows = 0 if df is None else len(df)
+
+    report = {'File': csv_path,
+              'Rows': rows,
+              'MB': os.path.getsize(csv_path) / 1e6,
+              'Seconds': seconds,
+              'RowsPerSecond': rows / seconds if seconds else 0,
+              'Error': error}
+
+    return report, df
+
+
+def write_journal(df, output_path, append=False):
+    """Write the transaction texts of a df to a journal in date order, or after what it has with append"""
+
+    with stage_metrics.stage(f'write_journal {os.path.basename(output_path)}') as metrics:
+        metrics['RowsIn'] = len(df)
+
+        # Stable so transactions on the same date keep the order they were exported in
+        df = df.sort_values('Date', kind='stable')
+
+        text = '\n'.join(df['Transaction']) + '\n'
+        with open(output_path, 'a' if append else 'w') as text_file:
+            text_file.write(text)
+
+        metrics['BytesWritten'] = len(text.encode('utf-8'))
+
+
+def import_moneywallet_batch(exports, output_path, per_wallet=False, workers=None, database=None):
+    """Convert every export matched by a directory or glob on a process pool.
+
+    The transactions of all exports are merged into one journal at
+    output_path in date order, or with per_wallet into one journal per
+    wallet inside the output_path directory. Transactions in more than one
+    export are only written once, though identical rows in the same export
+    are separate purchases and all kept, and with a database, not at all if its
+    fingerprint index already has them. With a database the new
+    transactions are appended to the journals, and a journal with nothing
+    new is left untouched. Uses a worker per core unless
+    workers is given. Returns a df reporting each file's rows, duplicates
+    skipped, size, time, throughput and error if it failed.
+    """
+
+    paths = find_exports(exports)
+    if not paths:
+        raise FileNotFoundError(f'No MoneyWallet exports match {exports}')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        measured = list(executor.map(stage_metrics.call_in_stage,
+                                     [f'convert {os.path.basename(path)}' for path in paths],
+                                     itertools.repeat(convert_export), paths))
+
+    # Each export was converted in a worker, so its stage is recorded from here
+    results = []
+    for (file_report, df), metrics in measured:
+        metrics['RowsOut'] = file_report['Rows']
+        metrics['BytesRead'] = os.path.getsize(file_report['File'])
+        stage_metrics.record(metrics)
+        results.append((file_report, df))
+
+    report = pd.DataFrame([file_report for file_report, df in results])
+    frames = [df for file_report, df in results if df is not None]
+
+    report['Skipped'] = 0
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+
+        # Drop transactions imported before and the repeats of overlapping exports,
+        # identical rows within one export have their own fingerprints and stay
+        seen = set()
+        if database is not None:
+            connection = expenses_storage.get_connection(database)
+            seen = import_fingerprints.load_fingerprints(connection)
+        is_new = ~df['Fingerprint'].isin(seen) & ~df['Fingerprint'].duplicated()
+        report['Skipped'] = report['File'].map((~is_new).groupby(df['File']).sum()).fillna(0).astype(int)
+        df = df[is_new]
+
+        # The journals already hold what the index has, so only the new rows are added
+        append = database is not None
+        if per_wallet:
+            os.makedirs(output_path, exist_ok=True)
+            for wallet, wallet_df in df.groupby('Wallet'):
+                name = (wallet or 'No Wallet').replace(os.sep, '-')
+                write_journal(wallet_df, os.path.join(output_path, name + '.ledger'), append)
+        elif len(df) or not append:
+            write_journal(df, output_path, append)
+
+        if database is not None:
+            for csv_path, file_df in df.groupby('File'):
+                import_fingerprints.add_fingerprints(connection, file_df['Fingerprint'],
+                                                     os.path.abspath(csv_path))
+
+    return report
+
+
+# Converting through ledger convert, kept as a reference to check the native converter against
 def clean_csv(csv_path):
 
     # Read the csv into a df
@@ -39,70 +338,80 @@ def clean_csv(csv_path):
 
 
 def run_ledger_convert(tmp_clean_csv, csv_path):
-    convert_cmd = r'ledger convert -f' + r' /home/carson/Files/accounting/asia-trip.ledger ' + tmp_clean_csv.name + r' --input-date-format "%m/%d/%Y"'
+    journal = '/home/carson/Files/accounting/asia-trip.ledger'
+    convert_cmd = r'ledger convert -f ' + journal + ' ' + tmp_clean_csv.name + r' --input-date-format "%m/%d/%Y"'
 
-    ledger_file = subprocess.check_output(convert_cmd, shell=True).decode('utf-8')
+    tmp_clean_csv.flush()
 
-    final_ledger_file = clean_ledger_file(ledger_file)
+    # The tempfile name changes every run, so key the cache on its contents and the journal
+    ledger_file = result_cache.cached(
+        'ledger_convert', [convert_cmd.replace(tmp_clean_csv.name, '<csv>')],
+        lambda: subprocess.check_output(convert_cmd, shell=True).decode('utf-8'),
+        ledger_file=journal, files=[tmp_clean_csv.name])
 
     # Change the filename from .csv to .ledger
     output_dir = os.path.splitext(csv_path)[0]+'.ledger'
 
-    # Write the conversion output to the output_dir
+    # Clean and write the conversion output to the output_dir as it streams through
     with open(output_dir, "w") as text_file:
-        text_file.write(final_ledger_file)
+        for line in rewrite_ledger_lines(StringIO(ledger_file)):
+            text_file.write(line + '\n')
 
     # Close and delete the tempfile
     tmp_clean_csv.close()
     os.unlink(tmp_clean_csv.name)
 
 
-def clean_ledger_file(ledger_file):
+def rewrite_ledger_lines(lines, rewrites=ACCOUNT_REWRITES, lookbehind=ACCOUNT_LOOKBEHIND):
+    """Clean ledger convert output one line at a time.
 
-    split_file = ledger_file.splitlines()
+    Every line gets all the rewrites in one pass of a single regex. An
+    Expenses:Unknown posting takes its account from the ; Account: comment
+    at most lookbehind lines above it, and the comment is dropped. Lines
+    are yielded as soon as no later posting can need them.
+    """
 
-    # Remove all asterix
-    split_file = [s.replace('*', '') for s in split_file]
+    pattern = compile_rewrites(rewrites)
 
-    # Replace equity unknown with assets cash
-    split_file = [s.replace('Equity:Unknown', 'Assets:Cash') for s in split_file]
+    # An Account comment and the lines after it, waiting for their posting
+    held = []
 
-    # Replace Expenses:City Transit and Expenses:Train with Expenses:Transportation:x
-    split_file = [s.replace('Expenses:City Transit', 'Expenses:Transportation:City Transit') for s in split_file]
-    split_file = [s.replace('Expenses:Train', 'Expenses:Transportation:Train') for s in split_file]
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if rewrites:
+            line = pattern.sub(lambda match: rewrites[match.group(0)], line)
 
-    # Replace Expenses:Unknown with the proper account
-    for id_item, item in enumerate(split_file):
-        if 'Expenses:Unknown' in item:
-            # Get the string 3 items back if it contains Account:
-            x = 0
-            while 'Account:' not in split_file[id_item - x]:
-                x += 1
+        if 'Account:' in line and ACCOUNT_COMMENT_RE.match(line):
+            # A comment no posting used stays in the output
+            yield from held
+            held = [line]
+        elif held and 'Expenses:Unknown' in line:
+            account = ACCOUNT_COMMENT_RE.match(held[0])['account']
+            yield from held[1:]
+            held = []
+            yield line.replace('Expenses:Unknown', account)
+        elif held:
+            held.append(line)
+            if len(held) > lookbehind:
+                yield from held
+                held = []
+        else:
+            yield line
 
-            account = split_file[id_item - x]
-            account = account.replace('; Account: ', '')
-            account = account.strip()
+    yield from held
 
-            split_file[id_item] = item.replace("Expenses:Unknown", account)
-
-            # Pop the account line now that we don't need it
-            split_file.pop(id_item - x)
-
-    # Rejoin all the lines back together
-    clean_file = '\n'.join(split_file)
-
-    return clean_file
 
+def clean_ledger_file(ledger_file):
+    """Clean the ledger convert output string, see rewrite_ledger_lines"""
 
-def main():
+    return '\n'.join(rewrite_ledger_lines(ledger_file.splitlines()))
 
-    csv_path = "/home/carson/Downloads/MoneyWallet_export_2023-12-09_17-53-43.csv"
 
-    tmp_clean_csv = clean_csv(csv_path)
-    run_ledger_convert(tmp_clean_csv, csv_path)
+def main(csv_path="/home/carson/Downloads/MoneyWallet_export_2023-12-09_17-53-43.csv",
+         database='expenses.db'):
 
+    convert_moneywallet_csv(csv_path, database=database)
 
-main()
 
 if __name__ == "__main__":
 
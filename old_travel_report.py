@@ -1,105 +1,67 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-from tabulate import tabulate
 
-import tomllib
-import os
-from io import StringIO
-import subprocess
 # import argparse
 
+import account_tree
+import expense_rollups
+import expenses_storage
 
-def get_ledger_report(ledger_file):
-    """Run the ledger balance report on a ledger file
-    and return the output as a string"""
 
-    report_cmd = r"ledger -f " + ledger_file \
-                 + r" bal -X $ ^expenses --pivot City --balance-format '%A:%T\n'"
+def read_report_expenses(database_name):
+    """Sum the stored transactions of each city and category in sqlite, leaving a few hundred rows.
 
-    # Get the ledger csv output as a string
-    report_output = subprocess.check_output(report_cmd, shell=True).decode('utf-8')
+    Revaluations and adjustments aren't spending and are left out like
+    ledger's balance report does. Amounts stay in hundredths.
+    """
 
-    return report_output
+    connection = expenses_storage.get_connection(database_name)
 
+    return pd.read_sql_query(f"""SELECT "City", "Category", SUM("Amount") AS "Amount"
+                                 FROM ledger_expenses
+                                 WHERE {expense_rollups.REAL_EXPENSES}
+                                 GROUP BY "City", "Category"
+                              """, connection)
 
-def make_df_from_report(report):
-    """Create a pandas df from the report string"""
 
-    report_lines = report.splitlines()
+def read_nights(database_name):
+    """Get the nights spent in each city, summed over every trip exported"""
 
-    expenses_list = []
-    for line in report_lines:
-        # Split each line into the seperate account values
-        values = line.split(':')
-        count = 0
-        value_list = []
-        for value in values:
-            if value.startswith('$'):
-                # If its the final $ entry but not the 5th column yet
-                # fill with null until on the 5th column
-                while count < 5:
-                    value_list.append(None)
-                    count += 1
-            if value == 'Expenses' and count == 0:
-                # If expenses is the first value
-                # append a null and no city first
-                value_list.append(None)
-                value_list.append('No City')
-                count += 2
-            value_list.append(value)
-            count += 1
-        expenses_list.append(value_list)
+    nights_df = expenses_storage.read_city_nights(expenses_storage.get_connection(database_name))
 
-    # Turn the list into a df
-    transaction_df = pd.DataFrame(expenses_list)
-    return transaction_df
+    return nights_df.dropna(subset=['City']).set_index('City')['Nights']
 
 
-def clean_and_format_df(df):
-    """Choose and rename columns, replace none with totals,
-    convert currency to float"""
+def make_report_df(expenses_df):
+    """Build the city by category matrix of the report in one pivot.
 
-    # Remove unnecessary columns and rename the rest
-    df.drop(df.columns[[0, 2]], axis=1, inplace=True)
-    df.columns = ["City", "Category", "Sub-Category", "Amount"]
+    expenses_df has City, Category and Amount in hundredths, per transaction
+    or already summed. Every row counts towards its category and each
+    category above it at any depth, summed by account_tree.rollup_tree,
+    then the sums are pivoted to one row per city. Columns are Total then
+    every category by its full account name in tree order, like
+    Transportation followed by Transportation:Bus. Transactions without a
+    city are under No City and the last row is the Total of every city.
+    """
 
-    # Na values in City and Category are totals
-    df[['City', 'Category']] = \
-        df[['City', 'Category']].fillna('Total')
+    # Revaluations and adjustments aren't spending
+    df = expenses_df[~expenses_df['Category'].str.contains('<Revalued>|<Adjustment>')]
+    df = df.assign(City=df['City'].astype(object).fillna('No City'),
+                   Category=df['Category'].astype(object))
 
-    # Turn currency string into float data
-    df['Amount'] = df['Amount'].replace('[\$,]', '', regex=True).astype(float)
+    rollups = account_tree.rollup_tree(df, ['City'])
+    report_df = rollups.pivot(index='City', columns='Node', values='Amount')
 
-    subs_df = df.copy(deep=True)
+    # Put the categories in tree order, the total is the sum of the top level
+    tree = account_tree.build_account_tree(report_df.columns)
+    report_df = report_df[tree['Node']]
+    report_df.insert(0, 'Total', report_df[tree.loc[tree['Depth'] == 1, 'Node']].sum(axis=1))
+    report_df.loc['Total'] = report_df.sum()
 
-    # Pivot the df so there's 1 row per city, with all categories as columns
-    df = pd.pivot_table(df, index='City', columns=["Category"], values="Amount")
-    df = df.reset_index()
-
-    # Create another pivot df with the subcategories
-    subs_df = pd.pivot_table(subs_df, index='City', columns=["Category", "Sub-Category"], values="Amount")
-    subs_df.columns = subs_df.columns.map('_'.join)
-    subs_df = subs_df.reset_index()
-    
-    # Merge the two dfs
-    df = pd.merge(df, subs_df, how='left')
-
-    # Remove the index name
-    df = df.rename_axis(None, axis=1)
-
-    return df
-
-
-def read_days_toml(days_toml):
-    """Read the toml file to a list, fix place names, export to sqlite"""
+    # Amounts are summed in hundredths and only turned into dollars once
+    report_df = expenses_storage.from_minor_units(report_df)
 
-    with open(days_toml, "rb") as f:
-        nights_data = tomllib.load(f)['Nights']
-
-    # Replace - with a space in city names
-    nights_data = {k.replace('-', ' '): v for (k, v) in nights_data.items()}
-
-    return nights_data
+    return report_df.reset_index().rename_axis(None, axis=1)
 
 
 def make_per_day_df(df, nights_data):
@@ -128,8 +90,9 @@ def stacked_bar_report(df):
     # Remove total and nocity city values
     df = df[~df['City'].isin(['Total', 'No City', 'Transit'])]
 
-    # Remove transportation subcategories to avoid doubling amounts
-    df = df.drop(['Transportation_Train', 'Transportation_Plane', 'Transportation_Bus', 'Transportation_Boat', 'Transportation_City Transit', 'Activities_Tour'], axis=1)
+    # Only keep the top level of the account tree, the sub-category
+    # columns would count the same amounts twice
+    df = df[[c for c in df.columns if len(account_tree.account_parents(c)) == 1]]
 
     # Drop transportation to avoid doubling with subcategories
     #df = df.drop('Transportation', axis=1)
@@ -143,7 +106,7 @@ def stacked_bar_report(df):
 
     df = df.drop('Total', axis=1)
 
-    colors = ['#e6194b', '#3cb44b', '#ffe119', '#4363d8', '#f58231', '#911eb4', '#46f0f0', '#f032e6', '#bcf60c', '#fabebe', '#008080', '#e6beff', '#9a6324', '#fffac8', '#800000', '#aaffc3', '#808000', '#ffd8b1', '#000075', '#808080', '#ffffff', '#000000']
+    colors = [account_tree.node_color(c) for c in df.columns if c not in ('City', 'nights')]
 
     try:
         df.drop('nights', axis=1).plot.bar(stacked=True, x='City', color=colors).axhline(y=65, color='k', linestyle='-')
@@ -160,20 +123,11 @@ def create_report(expenses_df, per_day_df):
 
 
 
-def main():
-
-    ledger_file = "/home/carson/Files/accounting/asia-trip.ledger"
-    days_toml = "/home/carson/Files/accounting/city-days-asia-trip.toml"
-
-    csv_output = '/home/carson/Files/expenses.csv'
+def main(database_name='expenses.db'):
 
-    report = get_ledger_report(ledger_file)
+    expenses_df = make_report_df(read_report_expenses(database_name))
 
-    expenses_df = make_df_from_report(report)
-
-    expenses_df = clean_and_format_df(expenses_df)
-
-    nights_data = read_days_toml(days_toml)
+    nights_data = read_nights(database_name)
 
     per_day_df = make_per_day_df(expenses_df.copy(deep=True), nights_data)
 
@@ -190,8 +144,6 @@ def main():
     # csv_path = (args.accumulate(args.filepath))
 
 
-main()
-
 if __name__ == "__main__":
 
     main()
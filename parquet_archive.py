@@ -0,0 +1,64 @@
+import pandas as pd
+
+import os
+import shutil
+
+import expenses_storage
+
+
+PARTITION_COLUMNS = ['Trip', 'Year', 'Month']
+
+# Rows per row group, small enough that a month has several to skip between
+ROW_GROUP_ROWS = 2000
+
+
+def write_parquet_archive(df, archive_dir, trip, replace=True):
+    """Write a trip's transactions to a parquet dataset partitioned by trip, year and month.
+
+    The trip's partitions are replaced so rows removed from the journal don't
+    linger, unless replace is False which adds the rows as new files next
+    to the ones already written. Rows are sorted by Country, City and
+    Category inside each month and written in row groups of ROW_GROUP_ROWS,
+    so the row group statistics on them are tight enough to skip row groups.
+    """
+
+    # Remove the old partitions for this trip
+    trip_dir = os.path.join(archive_dir, f'Trip={trip}')
+    if replace and os.path.exists(trip_dir):
+        shutil.rmtree(trip_dir)
+
+    df = df.assign(Trip=trip,
+                   Year=df['Date'].dt.year,
+                   Month=df['Date'].dt.month)
+    df = df.sort_values(['Year', 'Month', 'Country', 'City', 'Category'])
+
+    df.to_parquet(archive_dir, partition_cols=PARTITION_COLUMNS, index=False,
+                  write_statistics=True, row_group_size=ROW_GROUP_ROWS)
+
+
+def read_parquet_archive(archive_dir, columns=None, filters=None):
+    """Read transactions from the parquet archive.
+
+    Only the columns given are read, and filters like [('Country', '==', 'Laos')]
+    are pushed down, skipping whole partitions for Trip, Year and Month and
+    row groups whose statistics rule them out for the other columns. Rows
+    come back in the compact schema of expenses_storage.
+    """
+
+    df = pd.read_parquet(archive_dir, columns=columns, filters=filters)
+
+    # Partition columns come back as categoricals, only keep them if asked for
+    if columns is None:
+        df = df.drop(PARTITION_COLUMNS, axis=1)
+
+    # Partitions written before amounts were kept in hundredths hold float dollars
+    for column in expenses_storage.AMOUNT_COLUMNS:
+        if column in df and pd.api.types.is_float_dtype(df[column]):
+            df[column] = expenses_storage.to_minor_units(df[column])
+
+    # and ones from schema version 1 native amounts in hundredths
+    for column in expenses_storage.DECIMAL_COLUMNS:
+        if column in df and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = expenses_storage.from_minor_units(df[column])
+
+    return expenses_storage.set_expenses_dtypes(df)
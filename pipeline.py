@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import stage_metrics
+
+
+def check_stages(stages):
+    """Raise a ValueError if a stage depends on a missing stage or the stages form a cycle"""
+
+    for name, (function, dependencies) in stages.items():
+        for dependency in dependencies:
+            if dependency not in stages:
+                raise ValueError(f'Stage "{name}" depends on unknown stage "{dependency}"')
+
+    # Peel off stages whose dependencies are all resolved until none are left
+    resolved = set()
+    remaining = dict(stages)
+    while remaining:
+        ready = [name for name, (function, dependencies) in remaining.items()
+                 if resolved.issuperset(dependencies)]
+        if not ready:
+            raise ValueError(f'Stages {sorted(remaining)} depend on each other in a cycle')
+        resolved.update(ready)
+        for name in ready:
+            del remaining[name]
+
+
+def run_stage(name, parent, function, *args):
+    """Run a stage of the pipeline measured by stage_metrics.
+
+    Results with a shape, like a df, count as the stage's rows out, and
+    those of its dependencies as its rows in.
+    """
+
+    with stage_metrics.stage(name, parent=parent) as metrics:
+        shapes = [getattr(arg, 'shape', None) for arg in args]
+        if any(shape is not None for shape in shapes):
+            metrics['RowsIn'] = sum(shape[0] for shape in shapes if shape is not None)
+
+        result = function(*args)
+
+        if getattr(result, 'shape', None) is not None:
+            metrics['RowsOut'] = result.shape[0]
+
+    return result
+
+
+def run_pipeline(stages, max_workers=4):
+    """Run a DAG of stages on a thread pool, each one as soon as its dependencies finish.
+
+    stages maps a stage name to (function, [dependency names]), the function
+    is called with the results of its dependencies in that order. Stages
+    that don't depend on each other run at the same time, so a run takes
+    as long as its slowest chain of stages. When a stage raises, every
+    stage downstream of it is skipped while the others still finish, then
+    a RuntimeError naming them is raised from the first error. Each stage
+    is measured as a stage_metrics stage inside the one running the pipeline.
+    Returns a dict of each stage's result.
+    """
+
+    check_stages(stages)
+    parent = stage_metrics.current_stage()
+
+    results = {}
+    errors = {}
+    skipped = []
+    pending = dict(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start every stage whose dependencies are done, skip the ones downstream of a failure
+            for name, (function, dependencies) in list(pending.items()):
+                if any(d in errors or d in skipped for d in dependencies):
+                    skipped.append(name)
+                    del pending[name]
+                elif all(d in results for d in dependencies):
+                    future = executor.submit(run_stage, name, parent, function,
+                                             *[results[d] for d in dependencies])
+                    running[future] = name
+                    del pending[name]
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as exc:
+                    errors[name] = exc
+
+    if errors:
+        name, exc = next(iter(errors.items()))
+        message = f'Stage "{name}" failed: {exc}'
+        if len(errors) > 1:
+            message += f', also failed: {", ".join(list(errors)[1:])}'
+        if skipped:
+            message += f', skipped: {", ".join(skipped)}'
+        raise RuntimeError(message) from exc
+
+    return results
@@ -0,0 +1,107 @@
+import pandas as pd
+
+import hashlib
+import json
+import os
+import pathlib
+
+import ledger_journal
+
+
+# Nothing is cached unless LEDGER_TOOLS_CACHE names a directory to keep results in
+CACHE_DIR = os.environ.get('LEDGER_TOOLS_CACHE') or None
+
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+# How each kind of result is stored, dfs as parquet and command output as is
+RESULT_FORMATS = {'.parquet': (pd.DataFrame, lambda path: pd.read_parquet(path)),
+                  '.bin': (bytes, lambda path: pathlib.Path(path).read_bytes()),
+                  '.txt': (str, lambda path: pathlib.Path(path).read_text(encoding='utf-8'))}
+
+
+def cache_key(name, args, ledger_file=None, files=()):
+    """Hash a stage name and its arguments with the contents of every file it reads.
+
+    The contents of ledger_file and all the files it includes are hashed, so
+    editing an included file changes the key while touching the journal doesn't.
+    """
+
+    hasher = hashlib.sha256(json.dumps([name, args], default=str).encode())
+
+    inputs = list(files)
+    if ledger_file is not None:
+        inputs += [ledger_file] + ledger_journal.include_files(ledger_file)
+
+    for path in inputs:
+        with open(path, 'rb') as f:
+            hasher.update(hashlib.file_digest(f, 'sha256').digest())
+
+    return f'{name}-{hasher.hexdigest()}'
+
+
+def cached(name, args, compute, ledger_file=None, files=(), cache_dir=None,
+           max_bytes=MAX_CACHE_BYTES):
+    """Return the result of compute() from the cache when none of its inputs changed.
+
+    The key covers name, the json-able args and the contents of ledger_file,
+    its includes and any other files given. Results can be a df, bytes or
+    str. A hit refreshes the entry's mtime, and the least recently used
+    entries are evicted once the cache is over max_bytes. With no cache_dir
+    given or set in CACHE_DIR, compute() just runs every time.
+    """
+
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if cache_dir is None:
+        return compute()
+
+    key = cache_key(name, args, ledger_file, files)
+
+    for extension, (result_type, read) in RESULT_FORMATS.items():
+        path = os.path.join(cache_dir, key + extension)
+        if os.path.exists(path):
+            os.utime(path)
+            return read(path)
+
+    result = compute()
+
+    for extension, (result_type, read) in RESULT_FORMATS.items():
+        if isinstance(result, result_type):
+            break
+    else:
+        raise TypeError(f'Can not cache a {type(result).__name__} result of {name}')
+
+    # Write to a temporary file first so readers never see half an entry
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + extension)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if extension == '.parquet':
+        result.to_parquet(tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.write(result.encode('utf-8') if extension == '.txt' else result)
+    os.replace(tmp_path, path)
+
+    evict(cache_dir, max_bytes)
+
+    return result
+
+
+def evict(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    """Delete the least recently used entries until the cache fits in max_bytes"""
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and os.path.splitext(entry.name)[1] in RESULT_FORMATS:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another process evicted it first
+            pass
+        total -= size
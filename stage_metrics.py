@@ -0,0 +1,335 @@
+import pandas as pd
+
+import contextlib
+import cProfile
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+
+# Metrics of a stage, in the order they are logged and exported
+STAGE_METRICS = {'WallSeconds': 'Wall clock time of the stage',
+                 'CpuSeconds': 'CPU time of the thread the stage ran on',
+                 'ChildCpuSeconds': 'CPU time of subprocesses the stage waited for',
+                 'RowsIn': 'Rows the stage read',
+                 'RowsOut': 'Rows the stage produced',
+                 'BytesRead': 'Bytes the stage read from files or subprocesses',
+                 'BytesWritten': 'Bytes the stage wrote to files',
+                 'MaxRssBytes': 'Peak resident memory of the process when the stage finished',
+                 'TracemallocPeakBytes': 'Peak memory traced while the stage ran'}
+
+# A stage run more than once keeps its highest memory peak, the rest is added up
+PEAK_METRICS = ['MaxRssBytes', 'TracemallocPeakBytes']
+
+PROMETHEUS_PREFIX = 'ledger_tools'
+
+# The run stages are recorded into, shared by every thread, None when no run is
+_run = None
+_lock = threading.Lock()
+
+# The stages open on each thread, innermost last
+_local = threading.local()
+
+
+def open_stages():
+    """Get the stack of stages open on this thread"""
+
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+
+    return _local.stages
+
+
+def open_profilers():
+    """Get the stack of profilers running on this thread, only the innermost one is enabled"""
+
+    if not hasattr(_local, 'profilers'):
+        _local.profilers = []
+
+    return _local.profilers
+
+
+def current_stage():
+    """Get the name of the innermost stage open on this thread, or None"""
+
+    stages = open_stages()
+
+    return stages[-1]['Stage'] if stages else None
+
+
+def max_rss_bytes():
+    """Get the peak resident memory of the process, ru_maxrss is in KiB except on macOS"""
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def child_cpu_seconds():
+    """Get the CPU time used by every subprocess waited for so far"""
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def fold_tracemalloc_peak():
+    """Give every open stage the traced peak so far, then start a new peak.
+
+    Called whenever a stage starts or finishes, so each stage keeps the
+    highest peak of the time it was open, even while other stages open and
+    close around it. Stages running at the same time share their peaks.
+    """
+
+    if not tracemalloc.is_tracing():
+        return
+
+    with _lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        for metrics in _run['Open']:
+            metrics['TracemallocPeakBytes'] = max(metrics['TracemallocPeakBytes'] or 0, peak)
+        tracemalloc.reset_peak()
+
+
+def profile_path(run, name):
+    """Name the cProfile dump of a stage after the run and the stage, numbered if the stage repeats"""
+
+    base = os.path.join(run['ProfileDir'], f'{run["Run"]}-{re.sub(r"[^A-Za-z0-9_.-]+", "_", name)}')
+    with _lock:
+        repeat = run['Profiles'][base] = run['Profiles'].get(base, 0) + 1
+
+    return f'{base}.prof' if repeat == 1 else f'{base}-{repeat}.prof'
+
+
+@contextlib.contextmanager
+def stage(name, parent=None):
+    """Measure the block as a stage of the current run.
+
+    Yields a dict of the stage's metrics, set its RowsIn, RowsOut,
+    BytesRead and BytesWritten in the block when they are known. Wall,
+    CPU and child CPU time, peak RSS and the tracemalloc peak are measured,
+    and the block is profiled when the run has a profile directory, leaving
+    out the stages nested in it which get profiles of their own. With no
+    run being recorded the block runs unmeasured. The stage's parent is the
+    stage open around it on this thread, give parent for a stage run on
+    another thread than the one it belongs to.
+    """
+
+    metrics = {'Stage': name, 'Parent': None, 'Started': None, 'Error': None, 'Profile': None,
+               **{metric: None for metric in STAGE_METRICS}}
+
+    run = _run
+    if run is None:
+        yield metrics
+        return
+
+    stages = open_stages()
+    metrics['Parent'] = parent or current_stage()
+    metrics['Started'] = datetime.now(timezone.utc).isoformat()
+
+    with _lock:
+        run['Open'].append(metrics)
+    fold_tracemalloc_peak()
+    stages.append(metrics)
+
+    # Only one profiler can run on a thread, so the outer stage's is paused
+    profiler = None
+    profilers = open_profilers()
+    if run['ProfileDir'] is not None:
+        if profilers:
+            profilers[-1].disable()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            metrics['Profile'] = profile_path(run, name)
+            profilers.append(profiler)
+        except ValueError:
+            # Newer pythons only allow one profiler in the process at a time
+            profiler = None
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    start_child_cpu = child_cpu_seconds()
+    try:
+        yield metrics
+    except BaseException as exc:
+        metrics['Error'] = f'{type(exc).__name__}: {exc}'
+        raise
+    finally:
+        metrics['WallSeconds'] = time.perf_counter() - start_wall
+        metrics['CpuSeconds'] = time.thread_time() - start_cpu
+        metrics['ChildCpuSeconds'] = child_cpu_seconds() - start_child_cpu
+        metrics['MaxRssBytes'] = max_rss_bytes()
+
+        if profiler is not None:
+            profiler.disable()
+            profilers.pop()
+            os.makedirs(run['ProfileDir'], exist_ok=True)
+            profiler.dump_stats(metrics['Profile'])
+        if run['ProfileDir'] is not None and profilers:
+            profilers[-1].enable()
+
+        stages.pop()
+        fold_tracemalloc_peak()
+        with _lock:
+            run['Open'].remove(metrics)
+        record(metrics)
+
+
+def record(metrics):
+    """Add the metrics of a stage measured elsewhere, like in a worker process, to the current run"""
+
+    if _run is None:
+        return
+
+    if metrics['Parent'] is None:
+        metrics['Parent'] = current_stage()
+
+    with _lock:
+        _run['Stages'].append(metrics)
+
+
+def call_in_stage(name, function, *args):
+    """Call function as a stage and return its result with the stage's metrics.
+
+    For worker processes, where the stage can't be added to the run in the
+    parent, so the parent passes the metrics to record instead. Profiling
+    and tracing follow the run the worker was forked from, if any.
+    """
+
+    global _run
+
+    outer = _run
+    _run = new_run(outer['Command'] if outer else name,
+                   outer['ProfileDir'] if outer else None)
+    _run['Run'] = outer['Run'] if outer else _run['Run']
+    outer_stages, outer_profilers = open_stages(), open_profilers()
+    _local.stages, _local.profilers = [], []
+    try:
+        with stage(name) as metrics:
+            result = function(*args)
+    finally:
+        _run = outer
+        _local.stages, _local.profilers = outer_stages, outer_profilers
+
+    metrics['Parent'] = None
+
+    return result, metrics
+
+
+def new_run(command, profile_dir=None):
+    """Make an empty run of command for stages to be recorded into"""
+
+    started = datetime.now(timezone.utc)
+
+    return {'Run': f'{command}-{started:%Y%m%dT%H%M%S}-{os.getpid()}',
+            'Command': command,
+            'Started': started.isoformat(),
+            'ProfileDir': profile_dir,
+            'Stages': [],
+            'Open': [],
+            'Profiles': {}}
+
+
+@contextlib.contextmanager
+def record_run(command, run_log=None, textfile=None, profile_dir=None, trace_memory=False):
+    """Record every stage run in the block, the whole block as a stage named after command.
+
+    When the block finishes, even by raising, the run is appended to the
+    json lines run_log and written to the Prometheus textfile if they are
+    given. profile_dir gets a cProfile dump of each stage. trace_memory
+    turns on tracemalloc for the run, it is off by default since it slows
+    down everything allocated while it is on.
+    """
+
+    global _run
+
+    run = new_run(command, profile_dir)
+    _run = run
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    try:
+        with stage(command):
+            yield run
+    finally:
+        _run = None
+        if started_tracing:
+            tracemalloc.stop()
+        del run['Open'], run['Profiles']
+
+        if run_log is not None:
+            write_run_log(run, run_log)
+        if textfile is not None:
+            write_textfile(run, textfile)
+
+
+def stages_df(run):
+    """Get the stages of a run as a df, one row per stage in the order they finished"""
+
+    return pd.DataFrame(run['Stages'], columns=['Stage', 'Parent', 'Started', 'Error', 'Profile',
+                                                *STAGE_METRICS])
+
+
+def write_run_log(run, run_log):
+    """Append a run to the json lines run log"""
+
+    with open(run_log, 'a') as f:
+        f.write(json.dumps(run, default=str) + '\n')
+
+
+def prometheus_label(value):
+    """Escape a label value for the Prometheus text format"""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_name(metric):
+    """Turn a metric like WallSeconds into ledger_tools_stage_wall_seconds"""
+
+    return f'{PROMETHEUS_PREFIX}_stage_{re.sub(r"(?<!^)(?=[A-Z])", "_", metric).lower()}'
+
+
+def write_textfile(run, textfile):
+    """Write the stages of a run in the Prometheus text format, for the node exporter textfile collector.
+
+    A stage run more than once in the run is added up, except for the
+    memory peaks where the highest is kept. The file is replaced in one
+    step so the collector never reads half of it.
+    """
+
+    df = stages_df(run)
+    command = prometheus_label(run['Command'])
+
+    aggregations = {metric: 'max' if metric in PEAK_METRICS else 'sum' for metric in STAGE_METRICS}
+    totals = df.groupby('Stage', sort=False).agg(aggregations)
+    measured = df.groupby('Stage', sort=False)[list(STAGE_METRICS)].count()
+
+    failed = int(df.loc[df['Stage'] == run['Command'], 'Error'].notna().any())
+    lines = [f'# HELP {PROMETHEUS_PREFIX}_last_run_timestamp_seconds When the last run started',
+             f'# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge',
+             f'{PROMETHEUS_PREFIX}_last_run_timestamp_seconds{{command="{command}"}} '
+             f'{datetime.fromisoformat(run["Started"]).timestamp()}',
+             f'# HELP {PROMETHEUS_PREFIX}_last_run_success Whether the last run finished without an error',
+             f'# TYPE {PROMETHEUS_PREFIX}_last_run_success gauge',
+             f'{PROMETHEUS_PREFIX}_last_run_success{{command="{command}"}} {1 - failed}']
+
+    for metric, help_text in STAGE_METRICS.items():
+        name = prometheus_name(metric)
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        for stage_name, value in totals[metric].items():
+            # Metrics no stage of this name measured are left out rather than reported as 0
+            if measured.loc[stage_name, metric]:
+                lines.append(f'{name}{{command="{command}",stage="{prometheus_label(stage_name)}"}} {value:g}')
+
+    tmp_path = f'{textfile}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, textfile)
@@ -0,0 +1,294 @@
+import numpy as np
+import pandas as pd
+
+import os
+
+import currency_conversion
+import moneywallet_csv_import
+
+
+TRIP_START = pd.Timestamp('2023-06-21')
+TRIP_DAYS = 183
+
+# Countries in trip order with their currency, its price in dollars and their cities
+COUNTRIES = [('Japan', 'JPY', 0.0070, ['Tokyo', 'Kyoto', 'Osaka']),
+             ('Vietnam', 'VND', 0.000042, ['Hanoi', 'Ha Long', 'Hue', 'Hoi An', 'Da Lat',
+                                           'Ho Chi Minh City']),
+             ('Cambodia', '$', 1.0, ['Phnom Penh', 'Siem Reap']),
+             ('Laos', 'LAK', 0.000052, ['Vientiane', 'Luang Prabang']),
+             ('Thailand', 'THB', 0.028, ['Chiang Mai', 'Bangkok', 'Krabi'])]
+
+# Flights are booked in euros and land in the International city without a country
+FLIGHT_COMMODITY = 'EUR'
+FLIGHT_PRICE = 1.08
+
+# Decimal places each commodity is written with
+COMMODITY_DECIMALS = {'JPY': 0, 'VND': 0, 'LAK': 0, 'THB': 2, '$': 2, 'EUR': 2}
+
+# Categories with how often they come up and a typical amount in dollars
+CATEGORIES = {'Accomodation': (0.12, 20),
+              'Food & Drink': (0.38, 6),
+              'Activities': (0.08, 15),
+              'Activities:Tour': (0.02, 40),
+              'Transportation:Plane': (0.01, 120),
+              'Transportation:Boat': (0.01, 25),
+              'Transportation:Bus': (0.04, 12),
+              'Transportation:Train': (0.03, 20),
+              'Transportation:City Transit': (0.10, 2),
+              'Untracked Cash': (0.04, 10),
+              'ATM Fees': (0.02, 5),
+              'Visa Fees': (0.005, 30),
+              'Insurance': (0.005, 50),
+              'Purchases': (0.06, 15),
+              'Misc': (0.07, 5)}
+
+PAYEES = ['Street stall', 'Pho shop', 'Guesthouse', 'Hostel', '7-Eleven', 'Grab', 'Market',
+          'Cafe', 'Temple', 'Ticket office', 'Pharmacy', 'Night market']
+
+NOTES = ['window seat', 'shared with Bob', 'tip included', 'two nights', 'late checkout',
+         'split the bill', 'receipt lost']
+
+# How often a note is written, a posting is missing its City tag, is
+# missing both tags, or is a revaluation row ledger -X would report
+NOTE_RATE = 0.3
+MISSING_CITY_RATE = 0.02
+MISSING_TAGS_RATE = 0.01
+REVALUED_RATE = 0.005
+
+# Rows generated at a time, bounds the memory a large journal needs
+CHUNK_ROWS = 100000
+
+
+def make_itinerary():
+    """Split the trip days between the cities in order, giving a Country and City for each day"""
+
+    cities = [(country, city) for country, commodity, price, names in COUNTRIES for city in names]
+    days = np.array_split(np.arange(TRIP_DAYS), len(cities))
+
+    return pd.DataFrame({'Country': np.repeat([c for c, _ in cities], [len(d) for d in days]),
+                         'City': np.repeat([c for _, c in cities], [len(d) for d in days])})
+
+
+def make_prices(seed=0):
+    """Make a P directive for every commodity at the trip start and the first of every month.
+
+    The prices drift from month to month, so ledger -X reports revaluations.
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(TRIP_START, periods=TRIP_DAYS, freq='D')
+    dates = dates[(dates == TRIP_START) | (dates.day == 1)]
+
+    commodities = [(commodity, price) for country, commodity, price, names in COUNTRIES if commodity != '$']
+    commodities.append((FLIGHT_COMMODITY, FLIGHT_PRICE))
+
+    frames = []
+    for commodity, price in commodities:
+        drift = np.cumprod(1 + rng.normal(0, 0.02, len(dates)))
+        frames.append(pd.DataFrame({'Date': dates, 'Commodity': commodity,
+                                    'Price': price * drift, 'PriceCommodity': '$'}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_expenses(start, stop, postings, seed=0, prices=None):
+    """Make rows start to stop of a synthetic trip of postings expenses, in ledger_expenses columns.
+
+    Rows are spread evenly over the trip in date order, so any range of
+    them can be made on its own and they always come out the same.
+    """
+
+    rng = np.random.default_rng([seed, start])
+    prices = make_prices(seed) if prices is None else prices
+    rows = stop - start
+
+    # Each row's day decides where it was spent
+    day = np.arange(start, stop) * TRIP_DAYS // postings
+    itinerary = make_itinerary().iloc[day].reset_index(drop=True)
+    commodity_of = {country: commodity for country, commodity, price, names in COUNTRIES}
+
+    names = list(CATEGORIES)
+    weights = np.array([weight for weight, amount in CATEGORIES.values()])
+    category = rng.choice(len(names), rows, p=weights / weights.sum())
+    dollars = np.array([amount for weight, amount in CATEGORIES.values()])[category] \
+        * rng.lognormal(0, 0.6, rows)
+
+    df = pd.DataFrame({'Date': TRIP_START + pd.to_timedelta(day, unit='D'),
+                       'Payee': np.array(PAYEES)[rng.integers(0, len(PAYEES), rows)],
+                       'Category': np.array(names)[category],
+                       'Country': itinerary['Country'],
+                       'City': itinerary['City']})
+    df['Commodity'] = df['Country'].map(commodity_of)
+
+    flights = df['Category'] == 'Transportation:Plane'
+    df.loc[flights, 'Commodity'] = FLIGHT_COMMODITY
+    df.loc[flights, 'City'] = 'International'
+    df.loc[flights, 'Country'] = None
+
+    # Amounts are paid in the local currency, rounded the way it is written
+    rates = currency_conversion.make_rate_table(prices)
+    rate = currency_conversion.rates_as_of(df['Date'], df['Commodity'], rates)
+    decimals = df['Commodity'].map(COMMODITY_DECIMALS).to_numpy()
+    native = dollars / rate
+    df['NativeAmount'] = np.where(decimals == 0, native.round(0), native.round(2))
+    df['Amount'] = (df['NativeAmount'] * rate).round(2)
+
+    notes = np.array(NOTES)[rng.integers(0, len(NOTES), rows)]
+    df['Note'] = np.where(rng.random(rows) < NOTE_RATE, notes, None)
+
+    # Some postings were entered without their place
+    missing = rng.random(rows)
+    df.loc[missing < MISSING_CITY_RATE + MISSING_TAGS_RATE, 'City'] = None
+    df.loc[missing < MISSING_TAGS_RATE, 'Country'] = None
+
+    revalued = rng.random(rows) < REVALUED_RATE
+    df.loc[revalued, ['Payee', 'Category', 'Commodity']] = ['Commodities revalued', '<Revalued>', '$']
+    df.loc[revalued, ['Note', 'Country', 'City']] = None
+    df.loc[revalued, 'Amount'] = rng.normal(0, 1, revalued.sum()).round(2)
+    df.loc[revalued, 'NativeAmount'] = df.loc[revalued, 'Amount']
+
+    return df[['Date', 'Payee', 'Category', 'Amount', 'NativeAmount', 'Commodity',
+               'Note', 'Country', 'City']]
+
+
+def iter_expenses(postings, seed=0, chunk_rows=CHUNK_ROWS):
+    """Yield the rows of a synthetic trip a chunk at a time"""
+
+    prices = make_prices(seed)
+    for start in range(0, postings, chunk_rows):
+        yield make_expenses(start, min(start + chunk_rows, postings), postings, seed, prices)
+
+
+def format_amounts(df):
+    """Write each native amount the way ledger does, $12.50 or 50000 VND"""
+
+    amounts = pd.Series('', index=df.index)
+    for commodity, decimals in COMMODITY_DECIMALS.items():
+        is_commodity = df['Commodity'] == commodity
+        if not is_commodity.any():
+            continue
+        text = df.loc[is_commodity, 'NativeAmount'].map(f'{{:.{decimals}f}}'.format)
+        amounts[is_commodity] = '$' + text if commodity == '$' else text + ' ' + commodity
+
+    return amounts
+
+
+def format_journal(df):
+    """Turn synthetic expenses into ledger transactions like the MoneyWallet converter writes.
+
+    Revaluation rows are left out, ledger makes them itself from the
+    prices. Flights are written with their total cost in dollars.
+    """
+
+    df = df[df['Category'] != '<Revalued>']
+
+    xacts = (df['Date'].dt.strftime('%Y/%m/%d') + ' ' + df['Payee']
+             + ('  ; ' + df['Note']).fillna('')
+             + ('\n    ; Country: ' + df['Country']).fillna('')
+             + ('\n    ; City: ' + df['City']).fillna('')
+             + '\n    Expenses:' + df['Category'] + '  ' + format_amounts(df))
+
+    flights = df['Commodity'] == FLIGHT_COMMODITY
+    xacts[flights] = xacts[flights] + ' @@ $' + df.loc[flights, 'Amount'].map('{:.2f}'.format)
+
+    return xacts + '\n    ' + moneywallet_csv_import.BALANCING_ACCOUNT + '\n'
+
+
+def format_convert_output(df):
+    """Turn synthetic expenses into the output of ledger convert, for clean_ledger_file"""
+
+    df = df[df['Category'] != '<Revalued>']
+
+    return (df['Date'].dt.strftime('%Y/%m/%d') + ' * ' + df['Payee']
+            + ('\n    ; Country: ' + df['Country']).fillna('')
+            + '\n    ; Account: Expenses:' + moneywallet_categories(df['Category'])
+            + ('\n    ; City: ' + df['City']).fillna('')
+            + ('\n    ; Note: ' + df['Note']).fillna('')
+            + '\n    Expenses:Unknown  ' + format_amounts(df)
+            + '\n    Equity:Unknown\n')
+
+
+def moneywallet_categories(categories):
+    """Name categories the way MoneyWallet exports them, before the converter renames them"""
+
+    renames = {new.removeprefix('Expenses:'): old.removeprefix('Expenses:')
+               for old, new in moneywallet_csv_import.ACCOUNT_REWRITES.items()
+               if old.startswith('Expenses:')}
+
+    return categories.replace(renames)
+
+
+def format_moneywallet(df):
+    """Turn synthetic expenses into the rows of a MoneyWallet csv export"""
+
+    df = df[df['Category'] != '<Revalued>']
+
+    return pd.DataFrame({'wallet': df['Country'].fillna(''),
+                         'currency': df['Commodity'].replace({'$': 'USD'}),
+                         'category': moneywallet_categories(df['Category']),
+                         'datetime': df['Date'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+                         'money': format_amounts(df).str.split(' ').str[0].str.lstrip('$'),
+                         'description': df['Payee'],
+                         'event': '',
+                         'people': '',
+                         'place': df['City'].fillna(''),
+                         'note': df['Note'].fillna('')})
+
+
+def format_days_toml():
+    """Write the nights spent in each city and country in trip order, as read_days_toml reads them"""
+
+    itinerary = make_itinerary()
+    lines = ['[City]', 'International = 1']
+    for place, nights in itinerary['City'].value_counts(sort=False).items():
+        lines.append(f'{place.replace(" ", "-")} = {nights}')
+    lines.append('[Country]')
+    for place, nights in itinerary['Country'].value_counts(sort=False).items():
+        lines.append(f'{place.replace(" ", "-")} = {nights}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def generate(output_dir, postings, seed=0, overwrite=False):
+    """Write a synthetic journal, MoneyWallet export, ledger convert output and nights toml.
+
+    Files are named after postings and seed and kept if they already
+    exist, so a scale is only generated once. Everything is written a
+    chunk at a time, so 10 million postings fit in memory. Returns a
+    dict of the paths written.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.join(output_dir, f'synthetic-{postings}-{seed}')
+    paths = {'journal': name + '.ledger',
+             'moneywallet_csv': name + '.csv',
+             'convert_output': name + '-convert.ledger',
+             'days_toml': name + '.toml'}
+
+    if not overwrite and all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    # Write to temporary files first so a run that stops part way is never reused
+    tmp_paths = {kind: f'{path}.{os.getpid()}.tmp' for kind, path in paths.items()}
+
+    with open(tmp_paths['journal'], 'w') as journal, \
+            open(tmp_paths['moneywallet_csv'], 'w', newline='') as moneywallet_csv, \
+            open(tmp_paths['convert_output'], 'w') as convert_output:
+
+        prices = make_prices(seed)
+        for row in prices.itertuples():
+            journal.write(f'P {row.Date:%Y/%m/%d} {row.Commodity} ${row.Price:.10f}\n')
+        journal.write('\n')
+
+        for i, df in enumerate(iter_expenses(postings, seed)):
+            journal.write('\n'.join(format_journal(df)) + '\n')
+            convert_output.write('\n'.join(format_convert_output(df)) + '\n')
+            format_moneywallet(df).to_csv(moneywallet_csv, index=False, header=i == 0)
+
+    with open(tmp_paths['days_toml'], 'w') as days_toml:
+        days_toml.write(format_days_toml())
+
+    for kind, path in paths.items():
+        os.replace(tmp_paths[kind], path)
+
+    return paths
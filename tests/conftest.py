@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The modules live flat at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+import account_tree
+
+
+def make_rollups():
+    df = pd.DataFrame({'City': ['Hue', 'Hue', 'Hue', 'Hue', 'Hoi An'],
+                       'Category': ['Transportation', 'Transportation:Bus', 'Transportation:Train:Sleeper',
+                                    'Food & Drink', 'Transportation:Bus'],
+                       'Amount': [3.0, 5.0, 20.0, 7.0, 4.0]})
+    return account_tree.rollup_tree(df, ['City'])
+
+
+@pytest.mark.parametrize('depth', [None, 1, 2, 3])
+def test_every_level_adds_up_to_the_total(depth):
+    level = account_tree.rollup_level(make_rollups(), depth)
+
+    assert level.groupby('City')['Amount'].sum().to_dict() == pytest.approx({'Hue': 35.0, 'Hoi An': 4.0})
+
+
+def test_a_parents_own_postings_go_to_other():
+    level = account_tree.rollup_level(make_rollups(), 2)
+    hue = level[level['City'] == 'Hue']
+
+    assert list(hue['Node']) == ['Food & Drink', 'Transportation:Bus', 'Transportation:Train',
+                                 'Transportation:(other)']
+    assert list(hue['Amount']) == [7.0, 5.0, 20.0, 3.0]
+    assert 'Transportation:(other)' not in set(level.loc[level['City'] == 'Hoi An', 'Node'])
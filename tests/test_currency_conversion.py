@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+import currency_conversion
+import expenses_storage
+
+
+def make_rates():
+    return currency_conversion.make_rate_table(pd.DataFrame({
+        'Date': pd.to_datetime(['2023-06-01', '2023-06-01']),
+        'Commodity': ['EUR', '$'],
+        'Price': [1.25, 25000.0],
+        'PriceCommodity': ['$', 'VND']}))
+
+
+def test_amounts_without_a_price_are_not_converted():
+    converted = currency_conversion.convert_amounts([10.0, 50000.0, 3.0], ['EUR', 'VND', 'THB'],
+                                                    pd.to_datetime(['2023-06-22'] * 3), make_rates(), '$')
+
+    assert converted[:2].tolist() == [12.5, 2.0]
+    assert np.isnan(converted[2])
+
+
+def test_rows_without_native_amounts_convert_from_dollars(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    connection = expenses_storage.get_connection(database)
+    expenses_storage.insert_rows(connection, 'ledger_expenses', expenses_storage.compact_expenses(pd.DataFrame({
+        'Date': pd.to_datetime(['2023-06-22'] * 3),
+        'Payee': 'Shop',
+        'Category': 'Misc',
+        'Amount': [2.0, 10.0, 1.0],
+        'NativeAmount': [50000.0, None, 3.0],
+        'Commodity': ['VND', None, 'THB'],
+        'City': 'Hue'})))
+    connection.execute('INSERT INTO ledger_prices VALUES (\'2023-06-01 00:00:00\', \'$\', 25000, \'VND\', 0, NULL)')
+    connection.commit()
+
+    df = currency_conversion.read_expenses_in(database, 'test', 'VND')
+
+    assert sorted(df['Amount'].tolist()) == [50000 * 100, 250000 * 100]
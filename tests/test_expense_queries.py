@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+import expense_queries
+import expenses_storage
+
+
+COLUMNS = ['Date', 'Category', 'Amount', 'NativeAmount', 'City']
+
+
+def make_database(path):
+    database = str(path / 'expenses.db')
+    connection = expenses_storage.get_connection(database)
+    expenses_storage.insert_rows(connection, 'ledger_expenses', expenses_storage.compact_expenses(pd.DataFrame({
+        'Date': pd.to_datetime(['2023-06-21 23:00', '2023-06-22 00:00', '2023-06-23 00:00']),
+        'Payee': 'Shop',
+        'Category': ['Food & Drink', 'Food & Drink', 'Misc'],
+        'Amount': [1.5, 2.0, 9.0],
+        'NativeAmount': [1.5, 20.0, 9.0],
+        'Commodity': '$',
+        'City': ["Xi'an", 'Hue', None]})))
+    return database
+
+
+def test_values_are_bound_as_parameters():
+    value = "Hue' OR 1=1 --"
+    sql, params = expense_queries.compile_query('ledger_expenses', COLUMNS, select=['City'],
+                                                filters=[('City', '==', value), ('Amount', 'in', [1, 2])])
+
+    assert value not in sql
+    assert sql.endswith('WHERE ("City" = ?) AND ("Amount" IN (?, ?))')
+    assert params == [value, 1, 2]
+
+
+@pytest.mark.parametrize('filters', [[('Payee', '==', 'Shop')], [('City', 'like', 'Hue')]])
+def test_unknown_columns_and_operators_are_refused(filters):
+    with pytest.raises(ValueError):
+        expense_queries.compile_query('ledger_expenses', COLUMNS, filters=filters)
+
+
+def test_none_and_empty_lists_need_no_parameters():
+    assert expense_queries.compile_filter('City', '==', None, COLUMNS) == ('"City" IS NULL', [])
+    assert expense_queries.compile_filter('City', '!=', None, COLUMNS) == ('"City" IS NOT NULL', [])
+    assert expense_queries.compile_filter('City', 'in', [], COLUMNS) == ('0', [])
+
+
+def test_bound_values_filter_the_rows(tmp_path):
+    database = make_database(tmp_path)
+
+    df = expense_queries.query_expenses(database, ['City', 'Amount'], [('City', '==', "Xi'an")])
+    assert df['Amount'].tolist() == [150]
+
+    # Dates bind as the text the exporter stores, so times on the first day count
+    df = expense_queries.query_expenses(database, ['Amount'], start='2023-06-21', end='2023-06-23')
+    assert df['Amount'].tolist() == [150, 200]
+
+    # Native amounts are decimal text, compared as numbers rather than as text
+    df = expense_queries.query_expenses(database, ['NativeAmount'], [('NativeAmount', '>', 9)])
+    assert df['NativeAmount'].tolist() == [20.0]
+
+
+def test_grouped_sums(tmp_path):
+    database = make_database(tmp_path)
+
+    df = expense_queries.query_expenses(database, group_by=['Category'],
+                                        aggregates={'Amount': ('sum', 'Amount'), 'Rows': ('count', 'Amount')})
+
+    assert df.set_index('Category')[['Amount', 'Rows']].astype(int).to_dict('index') == {
+        'Food & Drink': {'Amount': 350, 'Rows': 2}, 'Misc': {'Amount': 900, 'Rows': 1}}
@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+
+import expenses_storage
+
+
+def make_expenses(native_amounts, commodities):
+    return expenses_storage.compact_expenses(pd.DataFrame({
+        'Date': pd.to_datetime(['2023-06-22'] * len(native_amounts)),
+        'Payee': 'Shop',
+        'Category': 'Misc',
+        'Amount': [1.25] * len(native_amounts),
+        'NativeAmount': native_amounts,
+        'Commodity': commodities}))
+
+
+def test_native_amounts_keep_every_decimal(tmp_path):
+    connection = expenses_storage.get_connection(str(tmp_path / 'expenses.db'))
+    df = make_expenses([0.00012345, 1.2345, 20999999.12345678, 1500.0], ['BTC', 'EUR', 'BTC', 'JPY'])
+
+    expenses_storage.insert_rows(connection, 'ledger_expenses', df)
+
+    stored = [r[0] for r in connection.execute('SELECT "NativeAmount" FROM ledger_expenses ORDER BY "Id"')]
+    assert stored == ['0.00012345', '1.2345', '20999999.12345678', '1500']
+
+    read = expenses_storage.read_expenses(connection)
+    assert read['NativeAmount'].tolist() == [0.00012345, 1.2345, 20999999.12345678, 1500.0]
+    assert read['Amount'].tolist() == [125] * 4
+
+
+def make_old_database(path, version, amount, native_amount):
+    """Write a ledger_expenses table the way schema version 0 or 1 did"""
+
+    connection = sqlite3.connect(path)
+    amount_type = 'REAL' if version == 0 else 'INTEGER'
+    connection.executescript(f"""
+        CREATE TABLE ledger_expenses ("Id" INTEGER PRIMARY KEY, "Date" TIMESTAMP NOT NULL, "Payee" TEXT,
+                                      "Category" TEXT NOT NULL, "Amount" {amount_type} NOT NULL,
+                                      "NativeAmount" {amount_type}, "Commodity" TEXT, "Note" TEXT,
+                                      "Country" TEXT, "City" TEXT, "Trip" TEXT);
+        CREATE TABLE ledger_sync ("Journal" TEXT PRIMARY KEY);
+        INSERT INTO ledger_sync VALUES ('trip.ledger');
+        PRAGMA user_version = {version};
+        """)
+    connection.execute('INSERT INTO ledger_expenses ("Id", "Date", "Category", "Amount", "NativeAmount", '
+                       '"Commodity") VALUES (7, \'2023-06-22 00:00:00\', \'Misc\', ?, ?, \'BTC\')',
+                       (amount, native_amount))
+    connection.commit()
+    connection.close()
+
+
+def test_migrating_real_amounts_keeps_native_decimals(tmp_path):
+    path = str(tmp_path / 'expenses.db')
+    make_old_database(path, 0, 12.34, 0.00012345)
+
+    connection = expenses_storage.get_connection(path)
+
+    assert connection.execute('SELECT "Id", "Amount", "NativeAmount" FROM ledger_expenses').fetchall() == \
+        [(7, 1234, '0.00012345')]
+    assert connection.execute('SELECT COUNT(*) FROM ledger_sync').fetchone()[0] == 1
+
+
+def test_migrating_hundredths_resyncs_the_journals(tmp_path):
+    path = str(tmp_path / 'expenses.db')
+    make_old_database(path, 1, 1234, 1234)
+
+    connection = expenses_storage.get_connection(path)
+
+    assert connection.execute('SELECT "Amount", "NativeAmount" FROM ledger_expenses').fetchall() == \
+        [(1234, '12.34')]
+    # The decimals lost in hundredths come back from the journals on the next export
+    assert connection.execute('SELECT COUNT(*) FROM ledger_sync').fetchone()[0] == 0
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == expenses_storage.SCHEMA_VERSION
+
+
+def test_threads_do_not_share_transactions(tmp_path):
+    path = str(tmp_path / 'expenses.db')
+    df = make_expenses([1.0], ['EUR'])
+    in_transaction = threading.Event()
+    other_done = threading.Event()
+
+    def roll_back():
+        connection = expenses_storage.get_connection(path)
+        try:
+            with expenses_storage.transaction(connection):
+                expenses_storage.insert_rows(connection, 'ledger_expenses', df.assign(Payee='Rolled back'))
+                in_transaction.set()
+                other_done.wait(1)
+                raise ValueError
+        except ValueError:
+            pass
+
+    def write():
+        in_transaction.wait()
+        connection = expenses_storage.get_connection(path)
+        with expenses_storage.transaction(connection):
+            expenses_storage.insert_rows(connection, 'ledger_expenses', df.assign(Payee='Kept'))
+        other_done.set()
+
+    expenses_storage.get_connection(path)
+    threads = [threading.Thread(target=roll_back), threading.Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The second write waited for the first transaction instead of joining it
+    connection = expenses_storage.get_connection(path)
+    assert [r[0] for r in connection.execute('SELECT "Payee" FROM ledger_expenses')] == ['Kept']
+
+
+def test_a_transaction_left_open_is_not_joined(tmp_path):
+    connection = expenses_storage.get_connection(str(tmp_path / 'expenses.db'))
+    connection.execute('BEGIN')
+    try:
+        with pytest.raises(RuntimeError):
+            with expenses_storage.transaction(connection):
+                pass
+    finally:
+        connection.execute('ROLLBACK')
+
+
+def test_closing_a_thread_connection_leaves_the_pool(tmp_path):
+    path = str(tmp_path / 'expenses.db')
+    opened = []
+
+    def run():
+        opened.append(expenses_storage.get_connection(path))
+        expenses_storage.close_connection(path)
+
+    pooled = len(expenses_storage.connection_pool)
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    # The thread's connection is closed and no longer held by the pool
+    assert len(expenses_storage.connection_pool) == pooled
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute('SELECT 1')
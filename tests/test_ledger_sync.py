@@ -0,0 +1,153 @@
+import os
+import sys
+
+import pytest
+
+import clean_and_export_ledger_data
+import expenses_storage
+import ledger_journal
+import result_cache
+
+
+DAYS_TOML = '[City]\nKyoto = 2\n[Country]\nJapan = 2\n'
+
+
+def transaction(date, payee, amount):
+    return f'{date} {payee}\n    ; City: Kyoto\n    Expenses:Food  ${amount}\n    Assets:Cash\n\n'
+
+
+def write_journal(directory, name, text):
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f'city-days-{name}.toml').write_text(DAYS_TOML)
+    journal = directory / f'{name}.ledger'
+    journal.write_text(text)
+    return str(journal)
+
+
+def read_payees(database):
+    connection = expenses_storage.get_connection(database)
+    return sorted(r[0] for r in connection.execute('SELECT "Payee" FROM ledger_expenses'))
+
+
+def test_journals_with_the_same_name_are_rejected(tmp_path):
+    first = write_journal(tmp_path / 'a', 'trip', transaction('2023/06/22', 'Ramen', '5.00'))
+    second = write_journal(tmp_path / 'b', 'trip', transaction('2023/06/23', 'Sushi', '9.00'))
+    journals = {first: clean_and_export_ledger_data.journal_days_toml(first),
+                second: clean_and_export_ledger_data.journal_days_toml(second)}
+
+    with pytest.raises(ValueError, match='trip "trip"'):
+        clean_and_export_ledger_data.export_ledger(journals, str(tmp_path / 'expenses.db'))
+
+
+def test_a_journal_cannot_replace_another_trips_rows(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    first = write_journal(tmp_path / 'a', 'trip', transaction('2023/06/22', 'Ramen', '5.00'))
+    second = write_journal(tmp_path / 'b', 'trip', transaction('2023/06/23', 'Sushi', '9.00'))
+
+    clean_and_export_ledger_data.sync_ledger_sqlite(
+        first, clean_and_export_ledger_data.journal_days_toml(first), database)
+    with pytest.raises(ValueError, match='already exported'):
+        clean_and_export_ledger_data.sync_ledger_sqlite(
+            second, clean_and_export_ledger_data.journal_days_toml(second), database)
+
+    assert read_payees(database) == ['Ramen']
+
+
+def test_a_moved_journal_takes_over_its_trip(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    old = write_journal(tmp_path / 'a', 'trip', transaction('2023/06/22', 'Ramen', '5.00'))
+    clean_and_export_ledger_data.sync_ledger_sqlite(old, clean_and_export_ledger_data.journal_days_toml(old),
+                                                    database)
+
+    new = write_journal(tmp_path / 'b', 'trip', transaction('2023/06/22', 'Ramen', '5.00'))
+    (tmp_path / 'a' / 'trip.ledger').unlink()
+    clean_and_export_ledger_data.sync_ledger_sqlite(new, clean_and_export_ledger_data.journal_days_toml(new),
+                                                    database)
+
+    assert read_payees(database) == ['Ramen']
+
+
+def read_rows(database):
+    connection = expenses_storage.get_connection(database)
+    return sorted(connection.execute('SELECT "Date", "Payee", "Amount" FROM ledger_expenses'))
+
+
+def test_appending_syncs_the_same_rows_as_a_full_rebuild(tmp_path):
+    journal = write_journal(tmp_path, 'trip', 'year 2019\n\n' + transaction('06/22', 'Ramen', '5.00'))
+    days_toml = clean_and_export_ledger_data.journal_days_toml(journal)
+    incremental = str(tmp_path / 'incremental.db')
+    clean_and_export_ledger_data.sync_ledger_sqlite(journal, days_toml, incremental)
+
+    with open(journal, 'a') as f:
+        f.write(transaction('06/23', 'Sushi', '9.00') + transaction('2019/06/24', 'Udon', '4.50'))
+    assert clean_and_export_ledger_data.sync_ledger_sqlite(journal, days_toml, incremental) == 3
+
+    rebuilt = str(tmp_path / 'rebuilt.db')
+    clean_and_export_ledger_data.sync_ledger_sqlite(journal, days_toml, rebuilt, full=True)
+
+    assert read_rows(incremental) == read_rows(rebuilt)
+    assert [r[0][:10] for r in read_rows(incremental)] == ['2019-06-22', '2019-06-23', '2019-06-24']
+
+
+def test_year_directives_inside_comments_are_ignored(tmp_path):
+    journal = tmp_path / 'trip.ledger'
+    journal.write_text('year 2019\ncomment\nyear 2020\nend comment\n' + transaction('06/22', 'Ramen', '5.00'))
+
+    offset = journal.read_bytes().index(b'06/22')
+    assert ledger_journal.year_before(str(journal), offset) == 2019
+    assert ledger_journal.year_before(str(journal), 0) is None
+
+
+def test_a_rebuild_of_an_unchanged_journal_loads_the_cached_parse(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    (tmp_path / 'extra.ledger').write_text(transaction('2023/06/23', 'Sushi', '9.00'))
+    journal = write_journal(tmp_path, 'trip', 'P 2023/06/01 JPY $0.007\n\n'
+                            + transaction('2023/06/22', 'Ramen', '5.00') + 'include extra.ledger\n')
+    days_toml = clean_and_export_ledger_data.journal_days_toml(journal)
+    first = str(tmp_path / 'first.db')
+    clean_and_export_ledger_data.sync_ledger_sqlite(journal, days_toml, first)
+
+    def parse(*args, **kwargs):
+        raise AssertionError('the journal was parsed again')
+
+    monkeypatch.setattr(ledger_journal, 'read_journal', parse)
+    monkeypatch.setattr(ledger_journal, 'read_prices', parse)
+    second = str(tmp_path / 'second.db')
+    clean_and_export_ledger_data.sync_ledger_sqlite(journal, days_toml, second)
+
+    assert read_rows(second) == read_rows(first)
+    state = clean_and_export_ledger_data.read_sync_state(expenses_storage.get_connection(second), journal)
+    assert list(state['Includes']) == [str(tmp_path / 'extra.ledger')]
+    connection = expenses_storage.get_connection(second)
+    assert connection.execute('SELECT COUNT(*) FROM ledger_prices').fetchone()[0] == 1
+
+
+LEDGER_OUTPUT = ('2023-06-22\x1fRamen\x1fExpenses:Food\x1f5\x1fLunch\\nCity: Kyoto\\nCountry: Japan\n'
+                 '2023-06-23\x1fSushi\x1fExpenses:Food\x1f9.5\x1fCity: Osaka\n'
+                 '2023-06-24\x1fTrain\x1fExpenses:Transportation:Train\x1f30\x1f\n')
+
+
+def fake_ledger(directory, monkeypatch):
+    """Put a ledger on the PATH that prints LEDGER_OUTPUT whatever it is asked"""
+
+    directory.mkdir()
+    script = directory / 'ledger'
+    script.write_text(f'#!{sys.executable}\nimport sys\nsys.stdout.write({LEDGER_OUTPUT!r})\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{directory}{os.pathsep}{os.environ["PATH"]}')
+
+
+def test_streaming_through_the_arrow_reader(tmp_path, monkeypatch):
+    fake_ledger(tmp_path / 'bin', monkeypatch)
+    journal = write_journal(tmp_path, 'trip', transaction('2023/06/22', 'Ramen', '5.00'))
+    database = str(tmp_path / 'expenses.db')
+
+    rows = clean_and_export_ledger_data.stream_ledger_sqlite(
+        journal, clean_and_export_ledger_data.journal_days_toml(journal), database, backend='arrow', batch_rows=2)
+
+    assert rows == 3
+    connection = expenses_storage.get_connection(database)
+    assert list(connection.execute('SELECT "Payee", "Category", "Amount", "City", "Note" FROM ledger_expenses '
+                                   'ORDER BY "Id"')) == [('Ramen', 'Food', 500, 'Kyoto', 'Lunch'),
+                                                         ('Sushi', 'Food', 950, 'Osaka', None),
+                                                         ('Train', 'Transportation:Train', 3000, None, None)]
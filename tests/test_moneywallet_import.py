@@ -0,0 +1,141 @@
+import pandas as pd
+
+import expenses_storage
+import import_fingerprints
+import moneywallet_csv_import
+
+
+HEADER = 'wallet,currency,category,datetime,money,description,event,people,place,note\n'
+BUS_MORNING = 'Japan,JPY,Transportation:Bus,2023-06-22 09:00:00,200,Bus,,,Kyoto,\n'
+BUS_EVENING = 'Japan,JPY,Transportation:Bus,2023-06-22 18:00:00,200,Bus,,,Kyoto,\n'
+
+
+def write_export(path, rows):
+    path.write_text(HEADER + ''.join(rows))
+    return str(path)
+
+
+def test_identical_purchases_on_the_same_day_are_all_written(tmp_path):
+    csv_path = write_export(tmp_path / 'export.csv', [BUS_MORNING, BUS_EVENING])
+    database = str(tmp_path / 'expenses.db')
+
+    written, skipped = moneywallet_csv_import.convert_moneywallet_csv(
+        csv_path, str(tmp_path / 'export.ledger'), database=database)
+
+    assert (written, skipped) == (2, 0)
+    assert (tmp_path / 'export.ledger').read_text().count('Expenses:Transportation:Bus') == 2
+
+
+def test_identical_rows_at_the_same_time_are_separate_purchases(tmp_path):
+    csv_path = write_export(tmp_path / 'export.csv', [BUS_MORNING, BUS_MORNING])
+
+    written, skipped = moneywallet_csv_import.convert_moneywallet_csv(
+        csv_path, str(tmp_path / 'export.ledger'), chunksize=1, database=str(tmp_path / 'expenses.db'))
+
+    assert (written, skipped) == (2, 0)
+
+
+def test_reimporting_skips_only_what_the_index_has(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    first = write_export(tmp_path / 'first.csv', [BUS_MORNING, BUS_MORNING])
+    moneywallet_csv_import.convert_moneywallet_csv(first, str(tmp_path / 'first.ledger'), database=database)
+
+    # A later export repeats both fares and has a third identical one
+    later = write_export(tmp_path / 'later.csv', [BUS_MORNING, BUS_MORNING, BUS_MORNING, BUS_EVENING])
+    written, skipped = moneywallet_csv_import.convert_moneywallet_csv(
+        later, str(tmp_path / 'later.ledger'), database=database)
+
+    assert (written, skipped) == (2, 2)
+
+
+def test_batch_writes_overlapping_exports_once(tmp_path):
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    write_export(exports / 'a.csv', [BUS_MORNING, BUS_MORNING])
+    write_export(exports / 'b.csv', [BUS_MORNING, BUS_MORNING, BUS_EVENING])
+    output = tmp_path / 'moneywallet.ledger'
+
+    report = moneywallet_csv_import.import_moneywallet_batch(str(exports), str(output), workers=1,
+                                                             database=str(tmp_path / 'expenses.db'))
+
+    assert report['Rows'].sum() - report['Skipped'].sum() == 3
+    assert output.read_text().count('Expenses:Transportation:Bus') == 3
+    assert pd.isna(report['Error']).all()
+
+
+def test_reimporting_an_export_leaves_its_journal_alone(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    csv_path = write_export(tmp_path / 'export.csv', [BUS_MORNING])
+    journal = tmp_path / 'export.ledger'
+    moneywallet_csv_import.convert_moneywallet_csv(csv_path, database=database)
+    first = journal.read_text()
+
+    assert moneywallet_csv_import.convert_moneywallet_csv(csv_path, database=database) == (0, 1)
+    assert journal.read_text() == first
+
+    # A later export with one more fare only adds that one
+    write_export(tmp_path / 'export.csv', [BUS_MORNING, BUS_EVENING])
+    assert moneywallet_csv_import.convert_moneywallet_csv(csv_path, database=database) == (1, 1)
+    assert journal.read_text().startswith(first)
+    assert journal.read_text().count('Expenses:Transportation:Bus') == 2
+
+
+def test_rerunning_a_batch_leaves_its_journal_alone(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    write_export(exports / 'a.csv', [BUS_MORNING, BUS_EVENING])
+    output = tmp_path / 'moneywallet.ledger'
+
+    moneywallet_csv_import.import_moneywallet_batch(str(exports), str(output), workers=1, database=database)
+    first = output.read_text()
+    report = moneywallet_csv_import.import_moneywallet_batch(str(exports), str(output), workers=1,
+                                                             database=database)
+
+    assert report['Skipped'].tolist() == [2]
+    assert output.read_text() == first
+
+
+LEGACY_CONVERT = '''2023/06/22 * Bus
+    ; Country: Japan
+    ; Account: Expenses:Transportation:Bus
+    ; City: Kyoto
+    ; UUID: 1111111111111111111111111111111111111111
+    Expenses:Unknown  200 JPY
+    Equity:Unknown
+
+2023/06/22 * Bus
+    ; Country: Japan
+    ; Account: Expenses:Transportation:Bus
+    ; City: Kyoto
+    ; UUID: 2222222222222222222222222222222222222222
+    Expenses:Unknown  200 JPY
+    Equity:Unknown
+'''
+
+
+def test_rebuilding_from_a_ledger_convert_journal_matches_a_reimport(tmp_path):
+    database = str(tmp_path / 'expenses.db')
+    journal = tmp_path / 'legacy.ledger'
+    journal.write_text(moneywallet_csv_import.clean_ledger_file(LEGACY_CONVERT) + '\n')
+    import_fingerprints.rebuild_fingerprints(expenses_storage.get_connection(database), [str(journal)])
+
+    csv_path = write_export(tmp_path / 'export.csv', [BUS_MORNING, BUS_EVENING])
+    written, skipped = moneywallet_csv_import.convert_moneywallet_csv(
+        csv_path, str(tmp_path / 'export.ledger'), database=database)
+
+    assert (written, skipped) == (0, 2)
+
+
+def test_rebuilding_from_a_converted_journal_matches_a_reimport(tmp_path):
+    csv_path = write_export(tmp_path / 'export.csv', [BUS_MORNING, BUS_MORNING, BUS_EVENING])
+    moneywallet_csv_import.convert_moneywallet_csv(csv_path)
+
+    database = str(tmp_path / 'expenses.db')
+    count = import_fingerprints.rebuild_fingerprints(expenses_storage.get_connection(database),
+                                                     [str(tmp_path / 'export.ledger')])
+    written, skipped = moneywallet_csv_import.convert_moneywallet_csv(
+        csv_path, str(tmp_path / 'again.ledger'), database=database)
+
+    assert count == 3
+    assert (written, skipped) == (0, 3)
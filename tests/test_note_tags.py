@@ -0,0 +1,40 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import clean_and_export_ledger_data
+import ledger_arrow
+import ledger_journal
+
+
+NOTES = ['Lunch\nCity: Hanoi\nCountry: Vietnam',
+         'City: Hue\nBanh mi and coffee',
+         'Dinner with friends\n:shared:\nCity: Hoi An',
+         'Bus']
+
+
+def python_tags(note):
+    text, tags = ledger_journal.split_note(note.split('\n'))
+    return {'Note': text or None, **tags}
+
+
+@pytest.mark.parametrize('note', NOTES)
+def test_escaped_notes_split_like_the_arrow_and_python_backends(note):
+    escaped = pd.Series([note.replace('\n', '\\n')])
+
+    pandas_row = ledger_journal.extract_note_tags(escaped, line_sep='\\n').iloc[0].dropna().to_dict()
+    arrow_note, arrow_tags = ledger_arrow.extract_note_tags_arrow(pa.array(escaped.tolist(), pa.string()))
+    arrow_row = {'Note': arrow_note[0].as_py(), **{k: v[0].as_py() for k, v in arrow_tags.items()}}
+    arrow_row = {k: v for k, v in arrow_row.items() if v is not None}
+    python_row = {k: v for k, v in python_tags(note).items() if v is not None}
+
+    assert pandas_row == arrow_row == python_row
+
+
+def test_ledger_csv_keeps_the_city_of_a_one_word_note():
+    csv_text = '"2023/06/22"␟ "Pho"␟ "Expenses:Food"␟ "5"␟ "Lunch\\nCity: Hanoi\\nCountry: Vietnam"\n'
+
+    df = clean_and_export_ledger_data.clean_ledger_csv(csv_text)
+
+    assert df[['Note', 'City', 'Country']].astype(object).iloc[0].tolist() == ['Lunch', 'Hanoi', 'Vietnam']
+    assert not any('\\' in column for column in df.columns)
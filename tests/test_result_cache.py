@@ -0,0 +1,30 @@
+import pandas as pd
+
+import result_cache
+
+
+def test_nothing_is_cached_without_a_cache_dir(monkeypatch):
+    monkeypatch.setattr(result_cache, 'CACHE_DIR', None)
+    calls = []
+
+    for _ in range(2):
+        result_cache.cached('stage', [], lambda: calls.append(1) or 'output')
+
+    assert len(calls) == 2
+
+
+def test_a_hit_reads_the_stored_frame(tmp_path):
+    journal = tmp_path / 'trip.ledger'
+    journal.write_text('2023/06/22 Ramen\n')
+    df = pd.DataFrame({'Payee': ['Ramen'], 'Amount': [500]})
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return df
+
+    for _ in range(2):
+        result = result_cache.cached('stage', [], compute, ledger_file=str(journal), cache_dir=str(tmp_path / 'cache'))
+
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(result, df)